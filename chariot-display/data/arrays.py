@@ -1,5 +1,4 @@
 """Interfaces for loading arrays, supporting parallel processing."""
-import multiprocessing
 import operator
 
 import numpy as np
@@ -41,49 +40,123 @@ class ArraysSource(object):
 # PARALLEL LOADING
 
 class SynchronizedBuffer(object):
+    """An array in a named shared memory segment.
+    Pickling only saves the name of the segment, so an unpickled copy in another
+    process shares the same array.
+    """
     def __init__(self):
         self.__shared_base = None
-        self.array = None
+        self.buffer = None
 
     def initialize(self, ctype, shape):
-        num_elements = reduce(operator.mul, shape, 1)
-        self.__shared_base = multiprocessing.Array(ctype, num_elements)
-        self.buffer = np.ctypeslib.as_array(self.__shared_base.get_obj()).reshape(*shape)
-
-class DoubleBuffer(parallelism.DoubleBuffer):
-    def __init__(self):
-        super(DoubleBuffer, self).__init__()
-        self._arrays = [SynchronizedBuffer(), SynchronizedBuffer()]
+        dtype = np.dtype(ctype)
+        self.__shared_base = parallelism.SharedMemory(
+            dtype.itemsize * reduce(operator.mul, shape, 1))
+        self.buffer = self.__shared_base.as_array(dtype, shape)
+
+    def __getstate__(self):
+        if self.buffer is None:
+            return None
+        return (self.__shared_base, self.buffer.dtype, self.buffer.shape)
+
+    def __setstate__(self, state):
+        self.__init__()
+        if state is not None:
+            (self.__shared_base, dtype, shape) = state
+            self.buffer = self.__shared_base.as_array(dtype, shape)
+
+class MultipleBuffer(parallelism.MultipleBuffer):
+    def __init__(self, num_slots):
+        super(MultipleBuffer, self).__init__(num_slots)
+        self._arrays = [SynchronizedBuffer() for _ in range(num_slots)]
 
     def initialize(self, ctype, shape):
         for array in self._arrays:
             array.initialize(ctype, shape)
 
-    # From parallelism.DoubleBuffer
+    # From parallelism.MultipleBuffer
 
     def get_buffer(self, buffer_id):
         return self._arrays[buffer_id].buffer
 
+class DoubleBuffer(parallelism.DoubleBuffer, MultipleBuffer):
+    """A MultipleBuffer of two arrays with double-buffering semantics."""
+    pass
+
+class ArrayWorkset(parallelism.Workset, ArraySource):
+    """A Workset whose work units each write an array into one shared output array.
+    The output array is allocated in named shared memory before the work is executed,
+    with one array of shape array_shape and ctype array_ctype for each of num_outputs
+    outputs. Workers attach to it by name and write their arrays directly into it, so
+    results don't need to be pickled back to the parent.
+    Implementation requires implementing work_array, array_ctype and array_shape.
+    """
+    def __init__(self):
+        self._output = SynchronizedBuffer()
+
+    @property
+    def num_outputs(self):
+        """The number of arrays in the output array.
+        Override this if work_ids doesn't have a length."""
+        return len(self.work_ids())
+
+    @property
+    def output(self):
+        """The output array, or None if it hasn't been allocated yet."""
+        return self._output.buffer
+
+    def output_index(self, work_id):
+        """The index of the array in the output array written by the work unit.
+        Override this if the work_ids aren't the integers from 0 to num_outputs - 1."""
+        return work_id
+
+    def initialize_output(self):
+        """Allocates the output array, if its shape has changed."""
+        shape = (self.num_outputs,) + tuple(self.array_shape)
+        if self.output is None or self.output.shape != shape:
+            self._output.initialize(self.array_ctype, shape)
+
+    def work_array(self, work_id, output_array):
+        """Write the array for the work_id into output_array.
+        Implement this."""
+        pass
+
+    # From Workset
+
+    def work(self, work_id):
+        self.work_array(work_id, self.output[self.output_index(work_id)])
+
+    def execute_sequential(self, *args, **kwargs):
+        self.initialize_output()
+        return super(ArrayWorkset, self).execute_sequential(*args, **kwargs)
+
+    def execute_stream(self, *args, **kwargs):
+        self.initialize_output()
+        return super(ArrayWorkset, self).execute_stream(*args, **kwargs)
+
 class ParallelLoader(parallelism.LoaderGeneratorProcess, ArraySource):
     """Loads numpy arrays sequentially in a separate process into shared memory.
     ArraySourceLoaderGeneratorFactory should return an object which is a Loader,
     a Generator, and also an ArraySource. This object should generate an array of
     constant shape.
+    num_slots is the number of arrays in shared memory, so the child can load up to
+    num_slots - 1 arrays ahead of the parent.
     """
-    def __init__(self, ArraySourceLoaderGeneratorFactory, *args, **kwargs):
+    def __init__(self, ArraySourceLoaderGeneratorFactory, num_slots=2, *args, **kwargs):
         super(ParallelLoader, self).__init__(
-            ArraySourceLoaderGeneratorFactory, DoubleBuffer, *args, **kwargs)
-        self.double_buffer.initialize(self.loader.array_ctype,
-                                      self.loader.array_shape)
+            ArraySourceLoaderGeneratorFactory, lambda: MultipleBuffer(num_slots),
+            *args, **kwargs)
+        self.multiple_buffer.initialize(self.loader.array_ctype,
+                                        self.loader.array_shape)
 
-    # From DoubleBufferedProcess
+    # From MultipleBufferedProcess
 
     def on_write_to_buffer(self, data, write_buffer):
         np.copyto(write_buffer, data)
 
     # From LoaderGeneratorProcess
 
-    def unmarshal_output(self, marshalled, read_buffer):
+    def on_read_from_buffer(self, read_buffer):
         return read_buffer
 
     # From ArraySource
@@ -1,28 +1,460 @@
 """Classes for loading chunked data from HDF5 chunk archives."""
 import ctypes
+import threading
+import pickle
+import bisect
+import collections
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import h5py
 
-from utilities import util
+from utilities import util, concurrency, parallelism
 import data
 import arrays
 import concurrent
 
+# SAVING
+
+class ChunkWriter(object):
+    """Writes chunks into an hdf5 chunk archive, keeping the archive open between chunks.
+    Chunks are written to the 'chunks' group in batches of batch_size chunks, and the
+    archive is flushed to disk after each batch rather than after each chunk. A chunk
+    replaces any chunk of the same index already in the archive. Each batch increments
+    the group's 'generation' attribute, which marks stored ArchiveMetadata as stale. Use
+    this as a context manager, or call open and close.
+
+    Arguments:
+        compression: None, 'lzf' (fast), or 'gzip' (small), applied to each chunk.
+        compression_level: the gzip compression level from 0 to 9.
+        shuffle: whether to apply the shuffle filter before compression, which often
+        makes multi-byte data more compressible.
+        frame_chunking: whether to store each frame (index along the first axis of the
+        chunk) as a separate hdf5 chunk, so that single frames can be read without
+        decompressing the whole chunk. Compression always needs hdf5 chunks. Without
+        either, each chunk is stored contiguously, so that a Loader can memory-map it.
+        write_metadata: whether to update the archive's ArchiveMetadata upon closing.
+    """
+    def __init__(self, archive_path, batch_size=16, compression=None, compression_level=None,
+                 shuffle=False, frame_chunking=True, write_metadata=True):
+        self.archive_path = archive_path
+        self.write_metadata = write_metadata
+        self.batch_size = batch_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shuffle = shuffle
+        self.frame_chunking = frame_chunking
+        self._hf = None
+        self._chunks = None
+        self._pending_chunks = []
+
+    def _dataset_options(self, chunk):
+        options = {}
+        if self.compression is not None:
+            options['compression'] = self.compression
+            if self.compression_level is not None:
+                options['compression_opts'] = self.compression_level
+        if self.shuffle:
+            options['shuffle'] = True
+        if chunk.ndim and (options or self.frame_chunking):
+            options['chunks'] = (1,) + chunk.shape[1:]
+        return options
+
+    def _write_batch(self):
+        for (chunk_index, chunk, chunk_attributes) in self._pending_chunks:
+            if str(chunk_index) in self._chunks:
+                del self._chunks[str(chunk_index)]
+            dataset = self._chunks.create_dataset(
+                str(chunk_index), data=chunk, **self._dataset_options(chunk))
+            for (name, value) in chunk_attributes.items():
+                dataset.attrs[name] = value
+        if self._pending_chunks:
+            self._chunks.attrs['generation'] = chunks_generation(self._hf) + 1
+        self._pending_chunks = []
+        self._hf.flush()
+
+    def open(self):
+        if self._hf is not None:
+            print(self.__class__.__name__ + ' Warning: Already open. Doing nothing.')
+            return
+        self._hf = h5py.File(self.archive_path, 'a')
+        self._chunks = self._hf.require_group('chunks')
+
+    def write(self, chunk_index, chunk, chunk_attributes=None):
+        """Queues the chunk to be written in the next batch."""
+        if self._hf is None:
+            raise RuntimeError(self.__class__.__name__ + ' Error: You need to call the open method first!')
+        if chunk_attributes is None:
+            chunk_attributes = {}
+        self._pending_chunks.append((chunk_index, chunk, chunk_attributes))
+        if len(self._pending_chunks) >= self.batch_size:
+            self._write_batch()
+
+    def flush(self):
+        """Writes all queued chunks and flushes the archive to disk."""
+        self._write_batch()
+
+    def close(self):
+        if self._hf is None:
+            return
+        self._write_batch()
+        if self.write_metadata and len(self._chunks):
+            ArchiveMetadata.scan(self._hf).write(self._hf)
+        self._hf.close()
+        self._hf = None
+        self._chunks = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ChunkWriterProcess(parallelism.Process):
+    """Writes chunks into an hdf5 chunk archive from a separate writer process.
+    Chunks can be passed to write from the parent and from any producer process forked
+    after the ChunkWriterProcess was created, and they're written in the order in which
+    they're received. Producers block in write while max_queue_size chunks are waiting
+    to be written. Producers should finish writing before close is called.
+    Use this as a context manager, or call open and close. Other keyword arguments are
+    passed to the ChunkWriter.
+    """
+    def __init__(self, archive_path, max_queue_size=16, **kwargs):
+        super(ChunkWriterProcess, self).__init__(max_queue_size, 1)
+        self.archive_path = archive_path
+        self._writer_kwargs = kwargs
+        self._writer = None
+
+    def write(self, chunk_index, chunk, chunk_attributes=None):
+        self.send_input((chunk_index, chunk, chunk_attributes))
+
+    def open(self):
+        self.run_parallel()
+
+    def close(self):
+        self.terminate()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # From Process
+
+    def on_run_start(self):
+        self._writer = ChunkWriter(self.archive_path, **self._writer_kwargs)
+        self._writer.open()
+
+    def execute(self, next_input):
+        self._writer.write(*next_input)
+
+    def on_run_finish(self):
+        self._writer.close()
+
+def export_contiguous(archive_path, contiguous_archive_path, batch_size=16):
+    """Copies an hdf5 chunk archive into a new archive of uncompressed contiguous chunks.
+    Chunks in such an archive can be memory-mapped by a Loader instead of being read
+    through the hdf5 filter pipeline."""
+    with h5py.File(archive_path, 'r') as hf:
+        with ChunkWriter(contiguous_archive_path, batch_size, frame_chunking=False) as writer:
+            for (chunk_name, chunk) in hf['chunks'].items():
+                writer.write(chunk_name, chunk[()], dict(chunk.attrs))
+
 def save_chunk(path, chunk, chunk_index, chunk_attributes):
-    hf = h5py.File(path, 'a')
-    chunks = hf.require_group('chunks')
-    chunk = chunks.create_dataset(str(chunk_index), data=chunk)
-    for (name, value) in chunk_attributes.items():
-        chunk.attrs[name] = value
-    hf.close()
-
-def load_chunk_array(chunk):
-    loaded = chunk[()]
+    """Writes a single chunk into an hdf5 chunk archive.
+    To write many chunks, use a ChunkWriter instead, which keeps the archive open and
+    updates the archive's metadata."""
+    with ChunkWriter(path, frame_chunking=False, write_metadata=False) as writer:
+        writer.write(chunk_index, chunk, chunk_attributes)
+
+class ChunkingWorkset(parallelism.Workset):
+    """Packs a sequence of frames into the chunks of an hdf5 chunk archive.
+    Frames are loaded by load_frame(frame_id) on the workers of a WorkerPool, and the
+    chunks are written by a single ChunkWriter in the parent as they finish. Each chunk
+    has chunk_size frames (except possibly the last one) and attributes 'id' (the chunk
+    index) and 'size' (the number of frames in the chunk), in addition to
+    chunk_attributes. Chunks which are
+    already in the archive are skipped, so an interrupted conversion can be resumed by
+    running it again.
+
+    Arguments:
+        frame_ids: the ids passed to load_frame, in frame order. load_frame needs to be
+        picklable, e.g. a module-level function or a functools.partial of one.
+        frame_length: if not None, each frame is zero-padded along its first axis to
+        frame_length, and each chunk gets a 'frame_lengths' attribute with the original
+        lengths. This is for frames of varying length, e.g. point clouds.
+    Other keyword arguments are passed to the ChunkWriter.
+    """
+    def __init__(self, archive_path, frame_ids, load_frame, chunk_size=32,
+                 chunk_attributes=None, frame_length=None, **kwargs):
+        self.archive_path = archive_path
+        self.frame_ids = list(frame_ids)
+        self.load_frame = load_frame
+        self.chunk_size = chunk_size
+        self.chunk_attributes = {} if chunk_attributes is None else chunk_attributes
+        self.frame_length = frame_length
+        self._writer_kwargs = kwargs
+        self._num_frames_converted = 0
+
+    def __getstate__(self):
+        # Workers get the frame ids of their chunks from the work ids
+        state = dict(self.__dict__)
+        state['frame_ids'] = None
+        return state
+
+    @property
+    def num_chunks(self):
+        return (len(self.frame_ids) + self.chunk_size - 1) // self.chunk_size
+
+    def written_chunks(self):
+        """Returns the indices of the chunks which are already in the archive."""
+        try:
+            with h5py.File(self.archive_path, 'r') as hf:
+                return set(int(chunk_name) for chunk_name in hf.get('chunks', {}).keys())
+        except IOError:
+            return set()
+
+    def convert(self, pool, chunksize=1, progress_interval=1):
+        """Loads and writes all chunks which aren't in the archive yet.
+        Chunks which were finished before an interruption are still written."""
+        self._num_frames_converted = 0
+        with ChunkWriter(self.archive_path, **self._writer_kwargs) as writer:
+            for ((chunk_index, _), (chunk, frame_lengths)) in self.execute_stream(
+                    pool, chunksize, False, progress_interval):
+                self._num_frames_converted += len(chunk)
+                chunk_attributes = dict(self.chunk_attributes)
+                chunk_attributes.update({'id': chunk_index, 'size': len(chunk)})
+                if self.frame_length is not None:
+                    chunk_attributes['frame_lengths'] = frame_lengths
+                writer.write(chunk_index, chunk, chunk_attributes)
+        return self.failed_work_ids
+
+    # From Workset
+
+    def work_ids(self):
+        written_chunks = self.written_chunks()
+        return [(chunk_index, tuple(self.frame_ids[chunk_index * self.chunk_size:
+                                                   (chunk_index + 1) * self.chunk_size]))
+                for chunk_index in range(self.num_chunks) if chunk_index not in written_chunks]
+
+    def work(self, work_id):
+        (_, frame_ids) = work_id
+        frames = [self.load_frame(frame_id) for frame_id in frame_ids]
+        frame_lengths = [len(frame) for frame in frames]
+        if self.frame_length is None:
+            return (np.stack(frames), frame_lengths)
+        chunk = np.zeros((len(frames), self.frame_length) + frames[0].shape[1:],
+                         dtype=frames[0].dtype)
+        for (padded, frame) in zip(chunk, frames):
+            padded[:len(frame)] = frame
+        return (chunk, frame_lengths)
+
+    def handle_exception(self, work_id, e):
+        print('Failed to load chunk ' + str(work_id[0]) + ': ' + repr(e))
+
+    def handle_progress(self, num_finished, num_work_units, elapsed_time):
+        num_frames = self._num_frames_converted
+        throughput = num_frames / elapsed_time if elapsed_time else 0
+        print('Finished ' + str(num_finished) + ' of ' + str(num_work_units) + ' chunks (' +
+              '{:.1f}'.format(throughput) + ' frames/s).')
+
+def load_chunk_array(chunk, out=None):
+    """Loads the data of the chunk into a new array, or directly into out if it's not None.
+    out should be a C-contiguous array whose first axis is at least as long as the chunk's;
+    only the part of out which was filled is returned."""
+    if out is None:
+        loaded = chunk[()]
+        return loaded
+    loaded = out[:chunk.shape[0]]
+    chunk.read_direct(loaded)
     return loaded
 
+class FrameIndex(object):
+    """Maps global frame indices to the chunks of an hdf5 chunk archive in constant time.
+    Frames are numbered consecutively across the chunks in chunk order, and the frames of
+    each chunk are indexed along the first axis of the chunk.
+    """
+    def __init__(self, chunk_names, chunk_lengths):
+        self.chunk_names = list(chunk_names)
+        chunk_lengths = np.asarray(chunk_lengths, dtype=int)
+        self.chunk_starts = np.concatenate(([0], np.cumsum(chunk_lengths)))
+        self._frame_chunks = np.repeat(np.arange(len(self.chunk_names)), chunk_lengths)
+
+    def __len__(self):
+        return len(self._frame_chunks)
+
+    def locate(self, frame):
+        """Returns the position of the chunk containing the frame, in chunk order, and
+        the offset of the frame in that chunk."""
+        if frame < 0:
+            frame += len(self)
+        if not 0 <= frame < len(self):
+            raise IndexError('FrameIndex: frame index out of range!', frame)
+        chunk_position = int(self._frame_chunks[frame])
+        return (chunk_position, frame - int(self.chunk_starts[chunk_position]))
+
+# METADATA
+
+def sort_chunk_names(chunk_names):
+    """Sorts chunk names in natural order.
+    Names which are all integers are sorted numerically without the regex of natural_keys."""
+    chunk_names = list(chunk_names)
+    if all(chunk_name.isdigit() for chunk_name in chunk_names):
+        return sorted(chunk_names, key=int)
+    return sorted(chunk_names, key=util.natural_keys)
+
+def chunks_generation(hf):
+    """Returns the number of batches of chunks which a ChunkWriter has written into the
+    open archive, which is 0 for archives written before this was counted."""
+    return int(hf['chunks'].attrs.get('generation', 0))
+
+class ArchiveMetadata(object):
+    """The listing of the chunks of an hdf5 chunk archive.
+    This is stored in the archive's 'metadata' group, so that it can be read in a single
+    access instead of by listing, sorting and opening every chunk. chunk_names are in
+    natural order, and chunk_lengths are the lengths of the chunks along their first axis.
+    chunk_shape, dtype, and chunk_attributes are those of the first chunk.
+    """
+    def __init__(self, chunk_names, chunk_lengths, chunk_shape, dtype, chunk_attributes):
+        self.chunk_names = list(chunk_names)
+        self.chunk_lengths = np.asarray(chunk_lengths, dtype=np.int64)
+        self.chunk_shape = tuple(chunk_shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_attributes = dict(chunk_attributes)
+
+    @property
+    def num_chunks(self):
+        return len(self.chunk_names)
+
+    @property
+    def max_chunk_shape(self):
+        """The shape of an array which can hold any chunk of the archive."""
+        return (int(self.chunk_lengths.max()),) + self.chunk_shape[1:]
+
+    @classmethod
+    def scan(cls, hf):
+        """Builds the metadata by listing the chunks of the open archive."""
+        chunks = hf['chunks']
+        chunk_names = sort_chunk_names(chunks.keys())
+        first_chunk = chunks[chunk_names[0]]
+        return cls(chunk_names, [chunks[chunk_name].shape[0] for chunk_name in chunk_names],
+                   first_chunk.shape, first_chunk.dtype, first_chunk.attrs)
+
+    @classmethod
+    def read(cls, hf):
+        """Reads the metadata stored in the open archive.
+        Returns None if there is no metadata, or if it's stale because chunks were
+        written or removed after it was written. Chunks written by a ChunkWriter or
+        save_chunk are detected by the chunks_generation of the archive, which is checked
+        in constant time; chunks added or removed by other means are detected by the
+        number of chunks."""
+        if 'metadata' not in hf:
+            return None
+        metadata = hf['metadata']
+        if (metadata.attrs['num_chunks'] != len(hf['chunks'])
+                or metadata.attrs.get('generation') != chunks_generation(hf)):
+            return None
+        return cls(metadata['chunk_names'][()].astype(str), metadata['chunk_lengths'][()],
+                   metadata.attrs['chunk_shape'], metadata.attrs['dtype'],
+                   metadata['chunk_attributes'].attrs)
+
+    def write(self, hf):
+        """Replaces the metadata stored in the open archive."""
+        if 'metadata' in hf:
+            del hf['metadata']
+        metadata = hf.create_group('metadata')
+        metadata.attrs['num_chunks'] = self.num_chunks
+        metadata.attrs['generation'] = chunks_generation(hf)
+        metadata.attrs['chunk_shape'] = self.chunk_shape
+        metadata.attrs['dtype'] = self.dtype.str
+        metadata.create_dataset('chunk_names', data=np.array(self.chunk_names, dtype=bytes))
+        metadata.create_dataset('chunk_lengths', data=self.chunk_lengths)
+        chunk_attributes = metadata.create_group('chunk_attributes')
+        for (name, value) in self.chunk_attributes.items():
+            chunk_attributes.attrs[name] = value
+
+def load_metadata(archive_path):
+    """Returns the ArchiveMetadata of the archive.
+    If the archive has no metadata or stale metadata, scans the archive instead and tries
+    to write the metadata back, so that the next load is fast."""
+    with h5py.File(archive_path, 'r') as hf:
+        metadata = ArchiveMetadata.read(hf)
+        if metadata is not None:
+            return metadata
+        metadata = ArchiveMetadata.scan(hf)
+    try:
+        with h5py.File(archive_path, 'a') as hf:
+            metadata.write(hf)
+    except (IOError, OSError):
+        pass  # e.g. a read-only archive, or one which is open in another process
+    return metadata
+
+# CACHING
+
+class ChunkCache(object):
+    """A least-recently-used cache of loaded chunk arrays, limited to max_bytes in total.
+    Chunks are keyed by archive path and chunk name, so one cache can be shared by the
+    Loaders of several archives, e.g. within a SynchronizedLoaders. Cached arrays are
+    made read-only, since they're shared by everything which loads the chunk. Chunks
+    larger than max_bytes are never cached. The cache is thread-safe.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunk_arrays = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chunk_arrays)
+
+    def __contains__(self, key):
+        return key in self._chunk_arrays
+
+    def get(self, key):
+        """Returns the cached chunk array, or None if it isn't cached."""
+        with self._lock:
+            chunk_array = self._chunk_arrays.pop(key, None)
+            if chunk_array is None:
+                self.misses += 1
+                return None
+            self._chunk_arrays[key] = chunk_array
+            self.hits += 1
+            return chunk_array
+
+    def put(self, key, chunk_array):
+        if chunk_array.nbytes > self.max_bytes:
+            return
+        chunk_array.flags.writeable = False
+        with self._lock:
+            previous = self._chunk_arrays.pop(key, None)
+            if previous is not None:
+                self.num_bytes -= previous.nbytes
+            while self.num_bytes + chunk_array.nbytes > self.max_bytes:
+                (_, evicted) = self._chunk_arrays.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.evictions += 1
+            self._chunk_arrays[key] = chunk_array
+            self.num_bytes += chunk_array.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._chunk_arrays.clear()
+            self.num_bytes = 0
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
 # LOADING
 
-class Loader(data.DataLoader, data.DataGenerator, data.ArraySource):
+class Loader(data.DataLoader, data.DataGenerator, arrays.ArraySource):
     """Loads chunks of data stored in an hdf5 chunk archive.
 
     Arguments:
@@ -31,26 +463,108 @@ class Loader(data.DataLoader, data.DataGenerator, data.ArraySource):
         lazy: whether to defer loading of chunk data from disk. If True, next() returns
         just the chunk; otherwise, next() returns both the chunk and the chunk data
         loaded from disk.
+        cache: a ChunkCache through which chunk data is loaded, or None to always load
+        chunk data from disk.
+        memory_map: whether to load the data of chunks which are stored contiguously and
+        uncompressed as read-only np.memmap views of the archive, without copying. Other
+        chunks are still loaded normally. Memory-mapped chunks bypass the cache, since
+        the operating system's page cache already keeps them in memory.
     """
-    def __init__(self, archive_path, lazy=False):
+    def __init__(self, archive_path, lazy=False, cache=None, memory_map=False):
         self.archive_path = archive_path
+        self.cache = cache
+        self.memory_map = memory_map
+        self._archive_map = None
         self._hf = None
+        self._metadata = None
         self._all_chunks = None
         self._chunks = None
+        self._frame_index = None
         self.lazy = lazy
 
+    @property
+    def metadata(self):
+        """The ArchiveMetadata of the archive, which is read upon first access."""
+        if self._metadata is None:
+            self._metadata = load_metadata(self.archive_path)
+        return self._metadata
+
     def __getitem__(self, chunk_id):
         return self._hf['chunks'][str(chunk_id)]
 
+    def _mapped_chunk_array(self, chunk):
+        """Returns a view of the chunk's data in the memory-mapped archive.
+        Returns None if the chunk isn't stored contiguously and uncompressed."""
+        offset = chunk.id.get_offset()
+        if offset is None:
+            return None
+        if self._archive_map is None:
+            self._archive_map = np.memmap(self.archive_path, np.uint8, 'r')
+        return (self._archive_map[offset:offset + chunk.id.get_storage_size()]
+                .view(chunk.dtype).reshape(chunk.shape))
+
+    def load_chunk(self, chunk_id, out=None):
+        """Returns the data of the chunk, from the cache if possible.
+        If out is not None, the data is loaded into out as in load_chunk_array; without a
+        cache, it's read from disk directly into out with no intermediate array."""
+        if self.memory_map:
+            chunk_array = self._mapped_chunk_array(self[chunk_id])
+            if chunk_array is not None and out is None:
+                return chunk_array
+            elif chunk_array is not None:
+                loaded = out[:chunk_array.shape[0]]
+                np.copyto(loaded, chunk_array)
+                return loaded
+        if self.cache is None:
+            return load_chunk_array(self[chunk_id], out)
+        key = (self.archive_path, str(chunk_id))
+        chunk_array = self.cache.get(key)
+        if chunk_array is None:
+            chunk_array = load_chunk_array(self[chunk_id])
+            self.cache.put(key, chunk_array)
+        if out is None:
+            return chunk_array
+        loaded = out[:chunk_array.shape[0]]
+        np.copyto(loaded, chunk_array)
+        return loaded
+
+    def allocate_chunk_buffer(self):
+        """Returns a new array which can be passed as out to load any chunk of the archive."""
+        return np.empty(self.metadata.max_chunk_shape, dtype=self.metadata.dtype)
+
+    @property
+    def frame_index(self):
+        """The FrameIndex of the archive, which is built upon first access."""
+        if self._frame_index is None:
+            self._frame_index = FrameIndex(self.metadata.chunk_names, self.metadata.chunk_lengths)
+        return self._frame_index
+
+    def seek(self, frame):
+        """Makes next return the chunk containing the frame, followed by the chunks after it.
+        Returns the offset of the frame in that chunk."""
+        (chunk_position, offset) = self.frame_index.locate(frame)
+        self._chunks = iter(self._all_chunks[chunk_position:])
+        return offset
+
+    def load_frame(self, frame):
+        """Reads just the frame from disk, regardless of the current chunk."""
+        (chunk_position, offset) = self.frame_index.locate(frame)
+        chunk_name = self._all_chunks[chunk_position]
+        if self.memory_map or (self.cache is not None and
+                               (self.archive_path, chunk_name) in self.cache):
+            return self.load_chunk(chunk_name)[offset]
+        return self._hf['chunks'][chunk_name][offset]
+
     def _load_next(self):
         try:
-            next_chunk = self._hf['chunks'][next(self._chunks)]
+            chunk_name = next(self._chunks)
         except StopIteration:
             return None
+        next_chunk = self._hf['chunks'][chunk_name]
         if self.lazy:
             return next_chunk
         else:
-            return (next_chunk, load_chunk_array(next_chunk))
+            return (next_chunk, self.load_chunk(chunk_name))
 
     # From DataLoader
 
@@ -58,9 +572,11 @@ class Loader(data.DataLoader, data.DataGenerator, data.ArraySource):
         if self._hf is not None:
             print(self.__class__.__name__ + ' Warning: Already loading. Doing nothing.')
             return
+        self._metadata = load_metadata(self.archive_path)
         self._hf = h5py.File(self.archive_path, 'r')
-        self._all_chunks = sorted(self._hf['chunks'].keys(), key=util.natural_keys)
+        self._all_chunks = self._metadata.chunk_names
         self._chunks = iter(self._all_chunks)
+        self._frame_index = None
 
     def stop_loading(self):
         if self._hf is None:
@@ -68,6 +584,7 @@ class Loader(data.DataLoader, data.DataGenerator, data.ArraySource):
             return
         self._hf.close()
         self._hf = None
+        self._archive_map = None  # views of the map keep it open until they're deleted
 
     # From DataGenerator
 
@@ -85,14 +602,13 @@ class Loader(data.DataLoader, data.DataGenerator, data.ArraySource):
 
     # From ArraySource
 
-    def get_array_ctype(self):
-        return ctypes.c_ubyte
+    @property
+    def array_ctype(self):
+        return np.ctypeslib.as_ctypes_type(self.metadata.dtype)
 
-    def get_array_shape(self, cache={}):
-        if self.archive_path not in cache:
-            with h5py.File(self.archive_path, 'r') as hf:
-                cache[self.archive_path] = hf['chunks']['0'].shape
-        return cache[self.archive_path]
+    @property
+    def array_shape(self):
+        return self.metadata.chunk_shape
 
 class PreloadingLoader(Loader):
     def __init__(self, *args, **kwargs):
@@ -124,29 +640,171 @@ class PreloadingLoader(Loader):
             raise RuntimeError(self.__class__.__name__ + ' Error: You need to call the load method first!')
         return next(self._loaded_chunks)
 
-class SynchronizedLoaders(data.DataLoader, data.DataGenerator, data.ArraySource):
+class ArchiveReaderProcess(parallelism.Process):
+    """Reads chunks of an hdf5 chunk archive in a separate process.
+    Each chunk is read directly into a buffer in shared memory which can hold any chunk
+    of the archive, so only the length of the chunk is sent back to the parent.
+    """
+    def __init__(self, archive_path, chunk_buffer_shape, dtype):
+        super(ArchiveReaderProcess, self).__init__(1, 1)
+        self.archive_path = archive_path
+        dtype = np.dtype(dtype)
+        self._shared_memory = parallelism.SharedMemory(
+            int(np.prod(chunk_buffer_shape)) * dtype.itemsize)
+        self.chunk_buffer = self._shared_memory.as_array(dtype, chunk_buffer_shape)
+        self._loader = None
+
+    def request(self, chunk_id):
+        """Starts reading the chunk in the child."""
+        self.send_input(str(chunk_id))
+
+    def receive(self):
+        """Blocks until the requested chunk has been read.
+        Returns a view of the chunk in shared memory, which is only valid until the next
+        chunk is requested."""
+        return self.chunk_buffer[:self.receive_output()]
+
+    # From Process
+
+    def on_run_start(self):
+        self._loader = Loader(self.archive_path)
+        self._loader.load()
+
+    def execute(self, chunk_id):
+        self.send_output(self._loader.load_chunk(chunk_id, self.chunk_buffer).shape[0])
+
+    def on_run_finish(self):
+        self._loader.stop_loading()
+
+def _load_chunk(chunk_loader_chunk_id_out):
+    (chunk_loader, chunk_id, out) = chunk_loader_chunk_id_out
+    return chunk_loader.load_chunk(chunk_id, out)
+
+class SynchronizedLoaders(data.DataLoader, data.DataGenerator, arrays.ArraySource):
     """Loads chunks of data split across multiple hdf5 chunk archives.
     Archives should have the chunks and chunk contents indexed identically.
+    If cache_bytes is not None, the chunk loaders share a ChunkCache of that size.
+
+    Arguments:
+        read_concurrency: how the chunk data of the archives is read in each step. If
+        None, the archives are read one after another. If 'threads', they're read
+        concurrently in a thread pool, which only helps if h5py releases the GIL while
+        reading. If 'processes', each archive is read in parallel in its own
+        ArchiveReaderProcess.
     """
-    def __init__(self, archive_paths, lazy=False, ChunkLoader=Loader, *args, **kwargs):
+    def __init__(self, archive_paths, lazy=False, ChunkLoader=Loader, cache_bytes=None,
+                 read_concurrency=None, *args, **kwargs):
+        if read_concurrency not in (None, 'threads', 'processes'):
+            raise ValueError('Unknown read concurrency!', read_concurrency)
         if isinstance(archive_paths, str):
             archive_paths = [archive_paths]
         self.archive_paths = archive_paths
-        self._chunk_loaders = [ChunkLoader(archive_path, *args, lazy=False, **kwargs)
+        self.cache = None if cache_bytes is None else ChunkCache(cache_bytes)
+        self.read_concurrency = read_concurrency
+        self._chunk_loaders = [ChunkLoader(archive_path, *args,
+                                           lazy=lazy or read_concurrency is not None,
+                                           cache=self.cache, **kwargs)
                                for archive_path in archive_paths]
-        self.lazy = self._chunk_loaders[0].lazy
+        self.lazy = lazy
+        self._thread_pool = None
+        self._readers = None
+        self._readers_lock = threading.Lock()
+
+    def _read_chunks(self, chunk_ids, out):
+        if out is None:
+            out = [None for _ in self._chunk_loaders]
+        if self.read_concurrency == 'threads':
+            return self._thread_pool.map(_load_chunk, zip(self._chunk_loaders, chunk_ids, out))
+        with self._readers_lock:  # so that threads don't interleave their requests
+            return self._read_chunks_in_processes(chunk_ids, out)
+
+    def _read_chunks_in_processes(self, chunk_ids, out):
+        chunk_arrays = []
+        for (chunk_loader, reader, chunk_id) in zip(self._chunk_loaders, self._readers, chunk_ids):
+            chunk_array = None
+            if chunk_loader.cache is not None:
+                chunk_array = chunk_loader.cache.get((chunk_loader.archive_path, str(chunk_id)))
+            if chunk_array is None:
+                reader.request(chunk_id)
+            chunk_arrays.append(chunk_array)
+        loaded = []
+        for (chunk_loader, reader, chunk_id, chunk_array, chunk_out) in zip(
+                self._chunk_loaders, self._readers, chunk_ids, chunk_arrays, out):
+            if chunk_array is None:
+                chunk_array = reader.receive()
+                if chunk_out is None or chunk_loader.cache is not None:
+                    chunk_array = chunk_array.copy()
+                if chunk_loader.cache is not None:
+                    chunk_loader.cache.put((chunk_loader.archive_path, str(chunk_id)), chunk_array)
+            if chunk_out is None:
+                loaded.append(chunk_array)
+            else:
+                loaded.append(chunk_out[:chunk_array.shape[0]])
+                np.copyto(loaded[-1], chunk_array)
+        return loaded
 
     def __getitem__(self, chunk_id):
         return [chunk_loader[chunk_id]
                 for chunk_loader in self._chunk_loaders]
 
+    @property
+    def metadata(self):
+        return self._chunk_loaders[0].metadata
+
+    @property
+    def archives_metadata(self):
+        """The ArchiveMetadata of each archive."""
+        return [chunk_loader.metadata for chunk_loader in self._chunk_loaders]
+
+    @property
+    def frame_index(self):
+        return self._chunk_loaders[0].frame_index
+
+    def seek(self, frame):
+        return [chunk_loader.seek(frame) for chunk_loader in self._chunk_loaders][0]
+
+    def load_chunk(self, chunk_id, out=None):
+        """Returns the data of the chunk from each archive.
+        If out is not None, it should be a list with one buffer for each archive."""
+        if self.read_concurrency is not None:
+            return self._read_chunks([chunk_id for _ in self._chunk_loaders], out)
+        if out is None:
+            out = [None for _ in self._chunk_loaders]
+        return [chunk_loader.load_chunk(chunk_id, chunk_out)
+                for (chunk_loader, chunk_out) in zip(self._chunk_loaders, out)]
+
+    def allocate_chunk_buffers(self):
+        return [chunk_loader.allocate_chunk_buffer() for chunk_loader in self._chunk_loaders]
+
+    def load_frame(self, frame):
+        return [chunk_loader.load_frame(frame) for chunk_loader in self._chunk_loaders]
+
     # From DataLoader
 
     def load(self):
+        if self.read_concurrency == 'threads':
+            self._thread_pool = ThreadPool(len(self._chunk_loaders))
+        elif self.read_concurrency == 'processes':
+            # Readers are forked before we open the archives, so they don't share hdf5 state
+            self._readers = []
+            for chunk_loader in self._chunk_loaders:
+                metadata = chunk_loader.metadata
+                reader = ArchiveReaderProcess(chunk_loader.archive_path,
+                                              metadata.max_chunk_shape, metadata.dtype)
+                reader.run_parallel()
+                self._readers.append(reader)
         for chunk_loader in self._chunk_loaders:
             chunk_loader.load()
 
     def stop_loading(self):
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+        if self._readers is not None:
+            for reader in self._readers:
+                reader.terminate()
+            self._readers = None
         for chunk_loader in self._chunk_loaders:
             chunk_loader.stop_loading()
 
@@ -157,10 +815,117 @@ class SynchronizedLoaders(data.DataLoader, data.DataGenerator, data.ArraySource)
             chunk_loader.reset()
 
     def next(self):
-        return [next(chunk_loader) for chunk_loader in self._chunk_loaders]
+        if self.read_concurrency is None or self.lazy:
+            return [next(chunk_loader) for chunk_loader in self._chunk_loaders]
+        chunks = [next(chunk_loader) for chunk_loader in self._chunk_loaders]
+        chunk_ids = [chunk.name.split('/')[-1] for chunk in chunks]
+        return list(zip(chunks, self._read_chunks(chunk_ids, None)))
+
+    # From ArraySource
+
+    @property
+    def array_ctype(self):
+        return self._chunk_loaders[0].array_ctype
+
+    @property
+    def array_shape(self):
+        return self._chunk_loaders[0].array_shape
 
 # CONCURRENT LOADING
 
+class ChunkReadAhead(concurrency.Thread):
+    """Reads chunks of a SynchronizedLoaders ahead of playback in a separate thread.
+    Playback reads the frames at indices, which should be in ascending order, and reports
+    its position in indices with advance_to. Once playback has passed the specified
+    fraction of the frames it reads from a chunk, the chunk of the next frame it'll read
+    after that chunk is read in the background. So strided indices, which may skip chunks
+    or read only a few frames from each chunk, are read ahead by the chunk they'll need.
+    Only the most recently read-ahead chunk is kept.
+    Reading only overlaps with playback if h5py releases the GIL, or if the archives are
+    read in separate processes (with read_concurrency='processes').
+    """
+    def __init__(self, chunk_loaders, indices, fraction=0.5):
+        super(ChunkReadAhead, self).__init__()
+        self._chunk_loaders = chunk_loaders
+        self._indices = list(indices)
+        self.fraction = fraction
+        self._requested_position = None
+        self._read_ahead = None  # (chunk position, chunk data)
+        self._last_chunk_position = None
+        self._request_notifier = concurrency.Notifier()
+        self._read_notifier = concurrency.Notifier()
+
+    def _frame_positions(self, chunk_position):
+        """Returns the range of positions in indices of the frames in the chunk."""
+        chunk_starts = self._chunk_loaders.frame_index.chunk_starts
+        return (bisect.bisect_left(self._indices, chunk_starts[chunk_position]),
+                bisect.bisect_left(self._indices, chunk_starts[chunk_position + 1]))
+
+    def advance_to(self, position):
+        """Reports that playback has reached the frame at the position in indices."""
+        frame_index = self._chunk_loaders.frame_index
+        (chunk_position, _) = frame_index.locate(self._indices[position])
+        if chunk_position == self._last_chunk_position:
+            return
+        (first_position, end_position) = self._frame_positions(chunk_position)
+        if position - first_position < int(self.fraction * (end_position - first_position)):
+            return
+        self._last_chunk_position = chunk_position
+        if end_position < len(self._indices):
+            self.request(frame_index.locate(self._indices[end_position])[0])
+
+    def request(self, chunk_position):
+        """Starts reading the chunk in the background."""
+        self._requested_position = chunk_position
+        self._request_notifier.notify()
+
+    def get(self, chunk_position):
+        """Returns the data of the chunk from each archive.
+        Waits for the chunk if it's being read ahead, and reads it directly otherwise."""
+        while self._requested_position == chunk_position and self._thread is not None:
+            self._read_notifier.clear()
+            read_ahead = self._read_ahead
+            if read_ahead is not None and read_ahead[0] == chunk_position:
+                return read_ahead[1]
+            self._read_notifier.wait(1)
+        read_ahead = self._read_ahead
+        if read_ahead is not None and read_ahead[0] == chunk_position:
+            return read_ahead[1]
+        chunk_name = self._chunk_loaders.frame_index.chunk_names[chunk_position]
+        return self._chunk_loaders.load_chunk(chunk_name)
+
+    def reset(self):
+        """Forgets the read-ahead chunk, e.g. when playback jumps to another position."""
+        self._requested_position = None
+        self._read_ahead = None
+        self._last_chunk_position = None
+
+    # From Thread
+
+    def execute(self):
+        self._request_notifier.wait()
+        self._request_notifier.clear()
+        chunk_position = self._requested_position
+        if not self._run or chunk_position is None:
+            return
+        read_ahead = self._read_ahead
+        if read_ahead is None or read_ahead[0] != chunk_position:
+            chunk_name = self._chunk_loaders.frame_index.chunk_names[chunk_position]
+            self._read_ahead = (chunk_position, self._chunk_loaders.load_chunk(chunk_name))
+        self._read_notifier.notify()
+
+    def on_run_parent_start(self):
+        self._request_notifier.open()
+        self._read_notifier.open()
+
+    def on_terminate(self):
+        self._run = False
+        self._request_notifier.notify()
+
+    def on_terminate_finish(self):
+        self._request_notifier.close()
+        self._read_notifier.close()
+
 class ConcurrentLoader(concurrent.Loader, Loader):
     """Loads chunks of data stored in an hdf5 chunk archive in a separate thread."""
     def __init__(self, archive_path, max_size=2, *args, **kwargs):
@@ -183,17 +948,132 @@ class FakeChunk():
     def __getitem__(self, key):
         return self._array.__getitem__(key)
 
-class ParallelLoader(arrays.ParallelLoader):
-    def __init__(self, *args, **kwargs):
-        super(ParallelLoader, self).__init__(data.ConcurrentDataChunkLoader, *args, **kwargs)
-        self.lazy = False
+_ALIGNMENT = 64  # bytes, so that each array in a shared segment starts on a cache line
+
+class SynchronizedBuffer(object):
+    """The chunks of several synchronized archives in a named shared memory segment.
+    The length of each chunk and the size of the pickled attributes of the chunks are
+    stored at the start of the segment, followed by the pickled attributes and then the
+    array of each chunk. Each array can hold the longest chunk of its archive. Pickling
+    only saves the name of the segment, so an unpickled copy in another process shares
+    the same chunks.
+    """
+    def __init__(self):
+        self.__shared_base = None
+        self.__layout = None
+        self.chunk_lengths = None
+        self.arrays = None
+        self._header = None
+        self._attributes_buffer = None
+
+    def initialize(self, dtypes, shapes, max_attributes_size=65536):
+        num_chunks = len(shapes)
+        attributes_offset = 8 * (num_chunks + 1)
+        attributes_offset += -attributes_offset % _ALIGNMENT
+        size = attributes_offset + max_attributes_size
+        size += -size % _ALIGNMENT
+        arrays_layout = []
+        for (dtype, shape) in zip(dtypes, shapes):
+            dtype = np.dtype(dtype)
+            arrays_layout.append((dtype, shape, size))
+            size += dtype.itemsize * int(np.prod(shape))
+            size += -size % _ALIGNMENT
+        self.__attach(parallelism.SharedMemory(size),
+                      (attributes_offset, max_attributes_size, arrays_layout))
+
+    def __attach(self, shared_base, layout):
+        self.__shared_base = shared_base
+        self.__layout = layout
+        (attributes_offset, max_attributes_size, arrays_layout) = layout
+        self._header = shared_base.as_array(np.int64, (len(arrays_layout) + 1,))
+        self.chunk_lengths = self._header[:-1]
+        self._attributes_buffer = shared_base.as_array(
+            np.uint8, (max_attributes_size,), attributes_offset)
+        self.arrays = [shared_base.as_array(dtype, shape, offset)
+                       for (dtype, shape, offset) in arrays_layout]
+
+    def write_attributes(self, attributes):
+        pickled = pickle.dumps(attributes, pickle.HIGHEST_PROTOCOL)
+        if len(pickled) > len(self._attributes_buffer):
+            raise ValueError('Chunk attributes are too large for the shared buffer!',
+                             len(pickled), len(self._attributes_buffer))
+        self._attributes_buffer[:len(pickled)] = np.frombuffer(pickled, np.uint8)
+        self._header[-1] = len(pickled)
+
+    def read_attributes(self):
+        return pickle.loads(self._attributes_buffer[:self._header[-1]].tostring())
+
+    def __getstate__(self):
+        if self.__shared_base is None:
+            return None
+        return (self.__shared_base, self.__layout)
+
+    def __setstate__(self, state):
+        self.__init__()
+        if state is not None:
+            self.__attach(*state)
+
+class MultipleBuffer(parallelism.MultipleBuffer):
+    def __init__(self, num_slots):
+        super(MultipleBuffer, self).__init__(num_slots)
+        self._chunks = [SynchronizedBuffer() for _ in range(num_slots)]
+
+    def initialize(self, dtypes, shapes, max_attributes_size=65536):
+        for chunks in self._chunks:
+            chunks.initialize(dtypes, shapes, max_attributes_size)
+
+    # From parallelism.MultipleBuffer
+
+    def get_buffer(self, buffer_id):
+        return self._chunks[buffer_id]
+
+class DoubleBuffer(parallelism.DoubleBuffer, MultipleBuffer):
+    pass
+
+class ParallelLoader(parallelism.LoaderGeneratorProcess, arrays.ArraysSource):
+    """Loads chunks of synchronized hdf5 chunk archives in a separate process into shared memory.
+    Like a SynchronizedLoaders which isn't lazy, next() returns a list with a tuple of
+    the chunk and the chunk data for each archive; each chunk is a FakeChunk whose attrs
+    are a dict copied from the archive. Chunk data is read from disk (and decompressed)
+    directly into shared memory by the child, so the parent never touches the archives.
+    Chunks returned by next() remain valid until next() is called again.
+    num_slots is the number of chunks in shared memory, so the child can load up to
+    num_slots - 1 chunks ahead of the parent. Other keyword arguments are passed to the
+    child's SynchronizedLoaders, e.g. cache_bytes.
+    """
+    def __init__(self, archive_paths, num_slots=2, lookahead=None,
+                 max_attributes_size=65536, **kwargs):
+        super(ParallelLoader, self).__init__(
+            lambda: SynchronizedLoaders(archive_paths, lazy=True, **kwargs),
+            lambda: MultipleBuffer(num_slots), lookahead)
+        # The archives are only opened by the child, so only their metadata is read here
+        archives_metadata = self.loader.archives_metadata
+        self.multiple_buffer.initialize(
+            [metadata.dtype for metadata in archives_metadata],
+            [metadata.max_chunk_shape for metadata in archives_metadata], max_attributes_size)
+
+    # From MultipleBufferedProcess
+
+    def on_write_to_buffer(self, chunks, write_buffer):
+        # Chunks are indexed identically across the archives
+        self.loader.load_chunk(chunks[0].name.split('/')[-1], write_buffer.arrays)
+        write_buffer.chunk_lengths[:] = [chunk.shape[0] for chunk in chunks]
+        write_buffer.write_attributes([dict(chunk.attrs) for chunk in chunks])
+
+    # From LoaderGeneratorProcess
+
+    def on_read_from_buffer(self, read_buffer):
+        chunk_arrays = [array[:chunk_length] for (array, chunk_length)
+                        in zip(read_buffer.arrays, read_buffer.chunk_lengths)]
+        return [(FakeChunk(chunk_array, attrs), chunk_array)
+                for (chunk_array, attrs) in zip(chunk_arrays, read_buffer.read_attributes())]
 
-    def _on_load(self, loaded_next, target_buffer):
-        super(ParallelLoader, self)._on_load(loaded_next[1], target_buffer)
-        attrs = loaded_next[0].attrs
-        return dict(attrs)
+    # From ArraysSource
 
-    def _process_result(self, result):
-        array = self._buffer.current_array
-        return (FakeChunk(array, result), array)
+    @property
+    def array_ctypes(self):
+        return [np.ctypeslib.as_ctypes_type(array.dtype) for array in self.read_buffer.arrays]
 
+    @property
+    def array_shapes(self):
+        return [array.shape for array in self.read_buffer.arrays]
@@ -5,20 +5,25 @@ try:
 except ImportError:
         from queue import Queue, Empty, Full
 
-from utilities import concurrency, parallelism
+from utilities import concurrency, profiling
 import data
 
-class Loader(data.DataLoader, data.DataGenerator, concurrency.Thread):
+class Loader(data.DataLoader, data.DataGenerator, concurrency.Thread, profiling.Profiled):
     """Mix-in for loading data in a separate thread.
     For proper multiple inheritance MRO, this should be the leftmost base class.
 
     Method load_next(self) needs to be implemented somewhere. It should return
     the next data, or None if the next data does not exist. If it returns an
     empty tuple instead of None, next() will never return None.
+    The thread records the load_next and enqueue stages.
     """
+    profiled_stages = ('load_next', 'enqueue')
+
     def __init__(self, max_size, *args, **kwargs):
         super(Loader, self).__init__(*args, **kwargs)
         self._data_queue = Queue(max_size)
+        self._data_available = concurrency.Notifier()
+        self._space_available = concurrency.Notifier()
         self._run = False
         self._load = False
 
@@ -27,28 +32,62 @@ class Loader(data.DataLoader, data.DataGenerator, concurrency.Thread):
         Implement this."""
         pass
 
-    def _enqueue(self, next_data, block=True, timeout=1):
-        while self._run and self._load:
+    def _open_notifiers(self):
+        self._data_available.open()
+        self._space_available.open()
+
+    def _enqueue(self, next_data):
+        while True:
+            # Clear before checking, so that a notification sent after the check isn't lost
+            self._space_available.clear()
+            if not (self._run and self._load):
+                return
             try:
-                self._data_queue.put(next_data, block, timeout)
-                break
+                self._data_queue.put_nowait(next_data)
+                self._data_available.notify()
+                return
             except Full:
+                self._space_available.wait()  # until next() or terminate() wakes us
+
+    def _dequeue(self, block=True, timeout=None):
+        while True:
+            self._data_available.clear()
+            try:
+                next_data = self._data_queue.get_nowait()
+                self._space_available.notify()
+                return next_data
+            except Empty:
                 pass
+            if not block or not self._data_available.wait(timeout):
+                raise Empty
 
     # From Thread
 
     def on_run_start(self):
         print(self.__class__.__name__ + ': Loading...')
 
-    def execute(self, block=True, timeout=1):
+    def execute(self):
         if not self._load:
             return
         self._on_load()
-        next_data = self.load_next()
-        self._enqueue(next_data, block, timeout)
+        with self.profiler.time('load_next'):
+            next_data = self.load_next()
+        with self.profiler.time('enqueue'):
+            self._enqueue(next_data)
         if next_data is None:
             self._run = False
 
+    def on_run_parent_start(self):
+        self._open_notifiers()
+
+    def on_terminate(self):
+        self._run = False
+        self._space_available.notify()
+
+    def on_terminate_finish(self):
+        self._data_available.close()
+        self._space_available.close()
+
     # From DataLoader
 
     def load(self):
@@ -71,15 +110,16 @@ class Loader(data.DataLoader, data.DataGenerator, concurrency.Thread):
         if self._thread is not None:
             self.stop_loading()
         super(Loader, self).reset()
+        self._open_notifiers()
         self._load = True
 
-    def next(self, block=True, timeout=1):
+    def next(self, block=True, timeout=None):
         """Gets the next loaded data and returns it.
-        If no data is loaded, raises StopIteration."""
+        If no data is loaded, raises StopIteration.
+        Waiting for data can be interrupted by KeyboardInterrupts."""
         if not self._load:
             raise StopIteration
-        next_data = parallelism.get_queue_poll(
-            self._data_queue, block, timeout)  # Allow KeyboardInterrupts to interrupt get
+        next_data = self._dequeue(block, timeout)
         if next_data is None:
             self._load = False
             raise StopIteration
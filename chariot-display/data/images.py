@@ -1,61 +1,298 @@
+import os
+import errno
 import warnings
 import ctypes
+import bisect
+import collections
+import multiprocessing
+import hashlib
 
 import numpy as np
 import scipy.misc
 import skimage
 import skimage.transform
+import PIL.Image
+import cv2
 
-from utilities import util
+from utilities import util, parallelism
 import data
+import arrays
+import concurrent
+import chunks
 
 # Image Loading Functions
 
+def downscale_local_mean(image, downsampling):
+    """Downsamples a uint8 image by the mean of each downsampling x downsampling block.
+    Matches skimage.transform.downscale_local_mean, including its zero padding of the
+    incomplete blocks at the bottom and right edges, followed by skimage.img_as_ubyte,
+    except that means halfway between two integers may be rounded up by 1. Block sums are
+    computed in uint16 (uint32 for factors larger than 16) rather than in float64, and are
+    rounded to means with a shift when downsampling is a power of 2.
+    """
+    block_size = downsampling * downsampling
+    (height, width) = image.shape[:2]
+    padding = (-height % downsampling, -width % downsampling)
+    if any(padding):
+        image = np.pad(image, ((0, padding[0]), (0, padding[1])) +
+                       ((0, 0),) * (image.ndim - 2), 'constant')
+    (height, width) = (image.shape[0] // downsampling, image.shape[1] // downsampling)
+    if np.iinfo(np.uint8).max * block_size + block_size // 2 <= np.iinfo(np.uint16).max:
+        sum_dtype = np.uint16
+    else:
+        sum_dtype = np.uint32
+
+    rows = image.reshape(height, downsampling, -1)
+    row_sums = rows[:, 0].astype(sum_dtype)
+    for i in range(1, downsampling):
+        row_sums += rows[:, i]
+    columns = row_sums.reshape(height, width, downsampling, -1)
+    sums = columns[:, :, 0].copy()
+    for i in range(1, downsampling):
+        sums += columns[:, :, i]
+
+    sums += block_size // 2
+    if block_size & (block_size - 1):
+        sums //= block_size
+    else:
+        sums >>= int(block_size).bit_length() - 1
+    return sums.astype(np.uint8).reshape((height, width) + image.shape[2:])
+
+def decode_image(image_path, downsampling=1):
+    """Loads an image from path as a numpy array, decoding JPEG images at a reduced resolution.
+    The JPEG decoder can scale images down by 2, 4, or 8 while decoding, which is much faster
+    than decoding at full resolution; this uses the largest such scale which divides
+    downsampling. Other image formats are decoded at full resolution.
+
+    Returns:
+        The image and the remaining integer factor by which it should be downsampled.
+    """
+    image = PIL.Image.open(image_path)
+    if image.format != 'JPEG' or downsampling == 1:
+        return (scipy.misc.imread(image_path), downsampling)
+    max_scale = min(downsampling & -downsampling, 8)
+    (width, height) = image.size
+    image.draft(image.mode, (max(width // max_scale, 1), max(height // max_scale, 1)))
+    scale = int(round(float(width) / image.size[0]))
+    return (np.array(image), downsampling // scale)
+
 def load_image(image_path, downsampling=1, downsampling_mode='downscale_local_mean'):
     """Loads an image from path as a numpy array. Downsamples by the specified power of 2.
 
     Args:
         downsampling: an integer factor by which to reduce the image size.
-        downsampling_mode: the name of the skimage function to use. Options:
-        'rescale' (fast) or 'downscale_local_mean' (accurate)
+        downsampling_mode: how to downsample the image. Options:
+        'rescale' (skimage.transform.rescale), 'downscale_local_mean' (accurate; computed
+        in integer arithmetic for 8-bit images), or 'decode' (fastest; JPEG images are
+        decoded at a reduced resolution before any remaining block means are computed, so
+        they don't exactly match 'downscale_local_mean')
     """
-    image = scipy.misc.imread(image_path)
+    if downsampling_mode == 'decode':
+        (image, downsampling) = decode_image(image_path, downsampling)
+        downsampling_mode = 'downscale_local_mean'
+    else:
+        image = scipy.misc.imread(image_path)
     if downsampling == 1:
         rescaled = image
+    elif downsampling_mode == 'downscale_local_mean' and image.dtype == np.uint8:
+        return downscale_local_mean(image, downsampling)
     elif downsampling_mode == 'rescale':
         rescaled = skimage.transform.rescale(image, 1.0 / downsampling, mode='constant')
     elif downsampling_mode == 'downscale_local_mean':
         rescaled = skimage.transform.downscale_local_mean(
-            skimage.img_as_float(image), (downsampling, downsampling, 1))
+            skimage.img_as_float(image),
+            (downsampling, downsampling) + (1,) * (image.ndim - 2))
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
         rescaled = skimage.img_as_ubyte(rescaled)
     return rescaled
 
+class ImageCache(object):
+    """A directory of decoded and downsampled images saved as .npy files, which persists
+    across runs. Images are keyed by the path, modification time and size of the image
+    file and by the downsampling factor and mode, so images are decoded again if their
+    files change. If max_bytes is not None, the least recently used images are removed
+    whenever the cache grows larger than max_bytes. The size of the cache is only
+    rescanned on eviction, so several processes sharing a cache can exceed max_bytes by
+    the images which the others have added since.
+    Images are written to temporary files and then renamed, so several processes can
+    share a cache.
+    """
+    def __init__(self, cache_path, max_bytes=None):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.num_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        try:
+            os.makedirs(cache_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _entry_path(self, image_path, downsampling, downsampling_mode):
+        image_stat = os.stat(image_path)
+        key = repr((os.path.abspath(image_path), image_stat.st_mtime, image_stat.st_size,
+                    downsampling, downsampling_mode))
+        return os.path.join(self.cache_path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _entries(self):
+        """Returns a list of the last use time, size and path of each cached image."""
+        entries = []
+        for file_name in os.listdir(self.cache_path):
+            if not file_name.endswith('.npy'):
+                continue
+            entry_path = os.path.join(self.cache_path, file_name)
+            try:
+                entry_stat = os.stat(entry_path)
+            except OSError:  # evicted by another process
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        return entries
+
+    def get(self, image_path, downsampling=1, downsampling_mode='downscale_local_mean'):
+        """Returns the cached image, or None if it isn't cached."""
+        entry_path = self._entry_path(image_path, downsampling, downsampling_mode)
+        try:
+            image = np.load(entry_path)
+            os.utime(entry_path, None)  # so that it's evicted last
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image
+
+    def put(self, image_path, image, downsampling=1, downsampling_mode='downscale_local_mean'):
+        entry_path = self._entry_path(image_path, downsampling, downsampling_mode)
+        temporary_path = entry_path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary_path, 'wb') as entry_file:
+            np.save(entry_file, image)
+        entry_size = os.path.getsize(temporary_path)
+        os.rename(temporary_path, entry_path)
+        if self.max_bytes is None:
+            return
+        if self.num_bytes is None:
+            self.num_bytes = sum(size for (_, size, _) in self._entries())
+        else:
+            self.num_bytes += entry_size
+        if self.num_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used images until the cache fits in max_bytes."""
+        entries = sorted(self._entries())
+        self.num_bytes = sum(size for (_, size, _) in entries)
+        for (_, size, entry_path) in entries:
+            if self.num_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:  # evicted by another process
+                pass
+            self.num_bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        for (_, _, entry_path) in self._entries():
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+        self.num_bytes = 0
+
+    def load_image(self, image_path, downsampling=1, downsampling_mode='downscale_local_mean'):
+        """Returns the cached image, or loads it with load_image and caches it."""
+        image = self.get(image_path, downsampling, downsampling_mode)
+        if image is None:
+            image = load_image(image_path, downsampling, downsampling_mode)
+            self.put(image_path, image, downsampling, downsampling_mode)
+        return image
+
+class ImageRotation(object):
+    """Rotates images counterclockwise about their centers by angle degrees, keeping their shapes.
+    This matches cv2.warpAffine with a cv2.getRotationMatrix2D matrix, but the cv2.remap
+    maps for each image shape are only computed for its first image, so rotating each
+    image only needs the interpolation. If out is not None, the rotated image is written
+    into it, so that output buffers can be reused. Only the angle is pickled, so the
+    loaders give it to each of their worker processes once, when the worker starts, and
+    each worker then computes its own maps once.
+    """
+    def __init__(self, angle):
+        self.angle = angle
+        self._maps = {}
+
+    def maps(self, shape):
+        """Returns the pair of fixed-point cv2.remap maps for images of the shape."""
+        (height, width) = shape[:2]
+        if (height, width) not in self._maps:
+            rotation = cv2.getRotationMatrix2D(
+                ((width - 1) / 2.0, (height - 1) / 2.0), self.angle, 1)
+            inverse = cv2.invertAffineTransform(rotation)
+            (xs, ys) = np.meshgrid(np.arange(width, dtype=np.float32),
+                                   np.arange(height, dtype=np.float32))
+            map_x = (inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]).astype(np.float32)
+            map_y = (inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]).astype(np.float32)
+            self._maps[(height, width)] = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        return self._maps[(height, width)]
+
+    def __call__(self, image, out=None):
+        (map_xy, map_interpolation) = self.maps(image.shape)
+        return cv2.remap(image, map_xy, map_interpolation, cv2.INTER_LINEAR, dst=out)
+
+    def __getstate__(self):
+        return self.angle
+
+    def __setstate__(self, angle):
+        self.__init__(angle)
+
 # Image Sequence Loading Classes
 
 class ImageLoader(data.DataLoader, data.DataGenerator):
     """Abstract base class for various image loaders.
-    Image loaders load images into memory and allow images to be retrieved from memory."""
-    def __init__(self, all_file_paths, downsampling):
-        self._load = True
+    Image loaders load images into memory and allow images to be retrieved from memory.
+    If image_cache is not None, images are loaded through that ImageCache, so that they're
+    only decoded if they aren't cached.
+    If image_transform is not None, it's applied to each loaded image in the loader. It's
+    called with the image and an optional output array of the same shape, and it must
+    return an image of the same shape, like an ImageRotation. Loaders with worker
+    processes give it to each worker once, when the worker starts."""
+    downsampling_mode = 'downscale_local_mean'
+
+    def __init__(self, all_file_paths, downsampling, image_cache=None, image_transform=None):
+        super(ImageLoader, self).__init__()
         self._all_file_paths = all_file_paths
         self._file_paths_generator = iter(self._all_file_paths)
         self.downsampling = downsampling
-
-    def _load_next(self):
+        self.image_cache = image_cache
+        self.image_transform = image_transform
+
+    def _decode_image(self, file_path):
+        if self.image_cache is None:
+            return load_image(file_path, self.downsampling, self.downsampling_mode)
+        return self.image_cache.load_image(file_path, self.downsampling, self.downsampling_mode)
+
+    def _load_image(self, file_path, out=None):
+        """Loads the image and applies the image_transform.
+        If out is not None, the image_transform writes the transformed image into it."""
+        image = self._decode_image(file_path)
+        if self.image_transform is not None:
+            image = self.image_transform(image, out)
+        return image
+
+    def _load_next(self, outs=None):
         """Loads the next image specified by the generator into memory and returns it.
-        If there is no image to load, returns None.
+        If there is no image to load, returns None. If outs is not None, the image_transform
+        writes each image of the frame into the corresponding array of outs.
         """
         file_paths = next(self._file_paths_generator, None)
         if file_paths is None:
-            self._load = False
             return None
-        if isinstance(file_paths, tuple):
-            images = [load_image(file_path, self.downsampling) for file_path in file_paths]
-        else:
-            images = [load_image(file_paths, self.downsampling)]
-        return images
+        if not isinstance(file_paths, tuple):
+            file_paths = (file_paths,)
+        if outs is None:
+            outs = [None] * len(file_paths)
+        return [self._load_image(file_path, out) for (file_path, out) in zip(file_paths, outs)]
 
     # From DataLoader
     def next(self):
@@ -73,127 +310,422 @@ class ImageLoader(data.DataLoader, data.DataGenerator):
     def __len__(self):
         return len(self._all_file_paths)
 
+def physical_memory_bytes():
+    """Returns the size of the physical memory, or None if it can't be determined."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
 class PreloadingImageLoader(ImageLoader):
     """Loads all specified images into RAM and allows fast sequential retrieval.
-    Images are saved in RAM upon retrieval for later retrieval.
-    Caution: if you load too many images, you may crash the system.
+    The images are stored in one contiguous preallocated frames array of shape
+    (num_frames, num_views, height, width, channels), where each frame is a single image
+    or a tuple of images of the same shape, such as a stereo pair. next() returns each
+    frame as a list of views into the array, so nothing is copied.
+    If the frames array would be larger than max_bytes, which defaults to half of the
+    physical memory, images are instead loaded from disk by next() as with a plain
+    ImageLoader. If num_processes is greater than 1, the images are loaded in parallel
+    by a pool of worker processes, and the frames array is put in shared memory for them
+    to write to. The frames array can also be put in shared memory with shared, or be
+    backed by a file at memmap_path.
     """
-    def __init__(self, file_paths_generator, downsampling=2):
+    def __init__(self, file_paths_generator, downsampling=2, image_cache=None,
+                 max_bytes=None, num_processes=1, shared=False, memmap_path=None,
+                 image_transform=None):
         all_file_paths = list(file_paths_generator)
-        super(PreloadingImageLoader, self).__init__(all_file_paths, downsampling)
-        self._images = None
-        self._all_images = None
+        super(PreloadingImageLoader, self).__init__(
+            all_file_paths, downsampling, image_cache, image_transform)
+        if max_bytes is None:
+            max_bytes = physical_memory_bytes()
+            if max_bytes is not None:
+                max_bytes //= 2
+        self.max_bytes = max_bytes
+        self.num_processes = num_processes
+        self.shared = shared or num_processes > 1
+        self.memmap_path = memmap_path
+        self.frames = None
+        self.streaming = False
+        self._frames_storage = None
+        self._position = None
+
+    def _frame_file_paths(self, frame_id):
+        file_paths = self._all_file_paths[frame_id]
+        if not isinstance(file_paths, tuple):
+            file_paths = (file_paths,)
+        return file_paths
+
+    def _allocate_frames(self, dtype, shape):
+        if self.memmap_path is not None:
+            self._frames_storage = self.memmap_path
+            return np.memmap(self.memmap_path, dtype, 'w+', shape=shape)
+        if self.shared:
+            self._frames_storage = parallelism.SharedMemory(
+                np.dtype(dtype).itemsize * int(np.prod(shape)))
+            return self._frames_storage.as_array(dtype, shape)
+        return np.empty(shape, dtype)
+
+    def _fill_frames(self):
+        """Loads every frame after the first into the frames array."""
+        if self.num_processes <= 1:
+            for frame_id in range(1, len(self.frames)):
+                for (view_id, file_path) in enumerate(self._frame_file_paths(frame_id)):
+                    image = self._decode_image(file_path)
+                    if image.shape != self.frames.shape[2:]:
+                        raise ValueError('Image has a different shape from the first image!',
+                                         file_path, image.shape, self.frames.shape[2:])
+                    if self.image_transform is None:
+                        self.frames[frame_id, view_id] = image
+                    else:
+                        self.image_transform(image, self.frames[frame_id, view_id])
+            return
+        image_shape = self.frames.shape[2:]
+        image_nbytes = self.frames[0, 0].nbytes
+        with parallelism.WorkerPool(self.num_processes, _init_image_worker,
+                                    (self.image_transform,)) as pool:
+            results = [
+                pool.apply_async(
+                    _decode_image_into, self._frames_storage, self.frames.dtype, image_shape,
+                    file_path, self.downsampling, self.downsampling_mode, self.image_cache,
+                    (frame_id * self.frames.shape[1] + view_id) * image_nbytes)
+                for frame_id in range(1, len(self.frames))
+                for (view_id, file_path) in enumerate(self._frame_file_paths(frame_id))
+            ]
+            for result in results:
+                parallelism.get_async_poll(result)
 
     # From DataLoader
 
     def load(self):
-        if self._all_images is not None:
+        if self.frames is not None or self.streaming:
             print('PreloadingImageLoader: Images are already loaded into memory. Doing nothing.')
             return
         super(PreloadingImageLoader, self).reset()
-        num_images = len(self._all_file_paths)
-        print('PreloadingImageLoader: Loading ' + str(num_images) + ' images...')
-        if num_images > 500:
-            print('PreloadingImageLoader Warning: Loading this many images may fill your RAM, proceed with care!')
-        self._all_images = [self._load_next() for _ in range(num_images)]
-        self._images = iter(self._all_images)
+        num_frames = len(self._all_file_paths)
+        first_frame = [self._load_image(file_path) for file_path in self._frame_file_paths(0)]
+        if any(image.shape != first_frame[0].shape for image in first_frame):
+            raise ValueError('PreloadingImageLoader needs the images of each frame to have the same shape!')
+        shape = (num_frames, len(first_frame)) + first_frame[0].shape
+        num_bytes = first_frame[0].nbytes * int(np.prod(shape[:2]))
+        if self.max_bytes is not None and num_bytes > self.max_bytes:
+            print('PreloadingImageLoader Warning: ' + str(num_frames) + ' frames need ' +
+                  str(num_bytes) + ' bytes, more than the budget of ' + str(self.max_bytes) +
+                  ' bytes. Images will be loaded from disk as they are needed instead.')
+            self.streaming = True
+            return
+        print('PreloadingImageLoader: Loading ' + str(num_frames) + ' frames...')
+        self.frames = self._allocate_frames(first_frame[0].dtype, shape)
+        self.frames[0] = first_frame
+        self._fill_frames()
+        self._position = 0
 
     # From DataGenerator
 
     def reset(self):
-        if self._all_images is None:
+        if self.streaming:
+            super(PreloadingImageLoader, self).reset()
+            return
+        if self.frames is None:
             print('PreloadingImageLoader Warning: Nothing to reset. Doing nothing.')
             return  # Nothing to reset
-        self._images = iter(self._all_images)
+        self._position = 0
 
     def next(self):
-        if self._all_images is None:
+        if self.streaming:
+            images = self._load_next()
+            if images is None:
+                raise StopIteration
+            return images
+        if self.frames is None:
             raise RuntimeError('PreloadingImageLoader Error: You need to call the load method first!')
-        return next(self._images)
+        if self._position >= len(self.frames):
+            raise StopIteration
+        self._position += 1
+        return list(self.frames[self._position - 1])
 
-class ConcurrentImageLoader(data.ConcurrentDataLoader, ImageLoader):
+class ConcurrentImageLoader(concurrent.Loader, ImageLoader):
     """Loads all specified images into RAM in a separate thread.
-    Note that, because image loading is slow, this gives only a small performance boost.
+    Note that, because image loading is slow, this gives only a small performance boost;
+    ParallelImageLoader decodes images in parallel across processes instead.
+    If image_transform is not None, the images are transformed into a ring of output
+    arrays, with one frame for each frame in the queue, for the frame being loaded, and
+    for the frame which next() last returned. So the images returned by next() are only
+    valid until next() is called again; copy them to keep them longer.
     """
-    def __init__(self, file_paths_generator, downsampling=2, max_size=500):
+    def __init__(self, file_paths_generator, downsampling=2, max_size=500, image_cache=None,
+                 image_transform=None):
         all_file_paths = list(file_paths_generator)
-        super(ConcurrentImageLoader, self).__init__(max_size, discard_upon_none=False,
-                                                    all_file_paths=all_file_paths, downsampling=downsampling)
+        super(ConcurrentImageLoader, self).__init__(
+            max_size, all_file_paths=all_file_paths, downsampling=downsampling,
+            image_cache=image_cache, image_transform=image_transform)
+        self._outputs = [None] * (max_size + 2)  # allocated by the transform upon first use
+        self._output_id = 0
+
+    def load_next(self):
+        if self.image_transform is None:
+            return self._load_next()
+        images = self._load_next(self._outputs[self._output_id])
+        if images is None:
+            return None
+        self._outputs[self._output_id] = images
+        self._output_id = (self._output_id + 1) % len(self._outputs)
+        return images
 
-class PreloadingConcurrentImageLoader(data.PreloadingConcurrentDataLoader, ImageLoader):
+class PreloadingConcurrentImageLoader(concurrent.PreloadingLoader, ConcurrentImageLoader):
     """Blocks in the parent thread until the images buffer in the RAM is initially filled.
     This behaves like the PreloadingImageLoader but doesn't require that all files be loaded in RAM.
 
     Note that, because image loading is slow, performance will eventually degrade
     to that of ConcurrentImageLoader - we just get a faster start.
     """
-    def __init__(self, file_paths_generator, downsampling=2, max_size=500):
-        all_file_paths = list(file_paths_generator)
+    def __init__(self, file_paths_generator, downsampling=2, max_size=500, image_cache=None,
+                 image_transform=None):
         super(PreloadingConcurrentImageLoader, self).__init__(
-            max_size, all_file_paths, downsampling)
+            file_paths_generator, downsampling, max_size, image_cache, image_transform)
+
+# The image_transform of the loader which started the worker process, so that it's sent
+# to each worker once instead of with every image
+_worker_image_transform = None
+
+def _init_image_worker(image_transform):
+    """Initializes a worker process of a ParallelImageLoader or PreloadingImageLoader."""
+    global _worker_image_transform
+    _worker_image_transform = image_transform
+
+def _decode_image_into(storage, dtype, shape, image_path, downsampling, downsampling_mode,
+                       image_cache=None, offset=0):
+    """Loads an image into the array of the specified dtype and shape at the offset in the
+    storage, which is a SharedMemory or the path of a file to memory-map. If the worker's
+    image transform is not None, it writes the transformed image directly into the array.
+    This is executed by the workers of a ParallelImageLoader or PreloadingImageLoader."""
+    if image_cache is None:
+        image = load_image(image_path, downsampling, downsampling_mode)
+    else:
+        image = image_cache.load_image(image_path, downsampling, downsampling_mode)
+    if image.shape != shape:
+        raise ValueError('Image has a different shape from the first image of its sequence!',
+                         image_path, image.shape, shape)
+    if isinstance(storage, parallelism.SharedMemory):
+        array = storage.as_array(dtype, shape, offset)
+    else:
+        array = np.memmap(storage, dtype, 'r+', offset, shape)
+    if _worker_image_transform is None:
+        array[...] = image
+    else:
+        _worker_image_transform(image, array)
+    if isinstance(array, np.memmap):
+        array.flush()
+
+class ParallelImageLoader(ImageLoader):
+    """Loads images in a pool of worker processes, so that decoding isn't limited by the GIL.
+    Each image of the upcoming frames, including each image of a stereo pair, is decoded
+    by a separate worker directly into one of num_slots frame slots in shared memory, so
+    up to num_slots - 1 frames are decoded ahead of the frame which next() last returned.
+    next() returns the frames in order. Each image must have the shape of the
+    corresponding image of the first frame, which is decoded in the parent by load().
+    The images returned by next() are backed by their slot, so they're only valid until
+    next() is called again; copy them to keep them longer.
+    num_slots defaults to one more than the number of worker processes.
+    """
+    def __init__(self, file_paths_generator, downsampling=2,
+                 num_processes=(multiprocessing.cpu_count() - 1), num_slots=None,
+                 downsampling_mode='downscale_local_mean', image_cache=None,
+                 image_transform=None):
+        all_file_paths = list(file_paths_generator)
+        super(ParallelImageLoader, self).__init__(
+            all_file_paths, downsampling, image_cache, image_transform)
+        self.downsampling_mode = downsampling_mode
+        self._pool = parallelism.WorkerPool(num_processes, _init_image_worker,
+                                            (self.image_transform,))
+        if num_slots is None:
+            num_slots = self._pool.num_processes + 1
+        if num_slots < 2:
+            raise ValueError('ParallelImageLoader needs at least two slots!')
+        self.num_slots = num_slots
+        self._slots = None
+        self._pending = collections.deque()
+        self._write_slot_id = 0
+        self._read_slot_id = None
+
+    def _allocate_slots(self):
+        file_paths = self._all_file_paths[0]
+        if not isinstance(file_paths, tuple):
+            file_paths = (file_paths,)
+        images = [self._load_image(file_path) for file_path in file_paths]
+        self._slots = []
+        for _ in range(self.num_slots):
+            shared_memories = [parallelism.SharedMemory(image.nbytes) for image in images]
+            self._slots.append([(shared_memory, shared_memory.as_array(image.dtype, image.shape))
+                                for (shared_memory, image) in zip(shared_memories, images)])
+
+    def _request_next(self):
+        """Starts decoding the next frame into the next slot, unless there are no more frames."""
+        file_paths = next(self._file_paths_generator, None)
+        if file_paths is None:
+            return
+        if not isinstance(file_paths, tuple):
+            file_paths = (file_paths,)
+        slot_id = self._write_slot_id
+        self._write_slot_id = (slot_id + 1) % self.num_slots
+        results = [
+            self._pool.apply_async(
+                _decode_image_into, shared_memory, image.dtype, image.shape, file_path,
+                self.downsampling, self.downsampling_mode, self.image_cache)
+            for ((shared_memory, image), file_path) in zip(self._slots[slot_id], file_paths)
+        ]
+        self._pending.append((slot_id, results))
+
+    def _discard_pending(self):
+        """Waits for the workers to finish writing to the slots and forgets those frames."""
+        for (_, results) in self._pending:
+            for result in results:
+                result.wait()
+        self._pending.clear()
+        self._write_slot_id = 0
+        self._read_slot_id = None
+
+    # From DataLoader
+
+    def load(self):
+        if self._slots is None:
+            self._allocate_slots()
+        self.reset()
+
+    def stop_loading(self):
+        self._pending.clear()
+        self._write_slot_id = 0
+        self._read_slot_id = None
+        self._pool.terminate()
+
+    # From DataGenerator
+
+    def reset(self):
+        self._discard_pending()
+        super(ParallelImageLoader, self).reset()
+        if self._slots is None:
+            return
+        for _ in range(self.num_slots - 1):
+            self._request_next()
+
+    def next(self):
+        if self._slots is None:
+            raise RuntimeError('ParallelImageLoader Error: You need to call the load method first!')
+        if self._read_slot_id is not None:
+            self._request_next()  # into the slot of the previously returned frame
+        if not self._pending:
+            raise StopIteration
+        (slot_id, results) = self._pending.popleft()
+        for result in results:
+            parallelism.get_async_poll(result)
+        self._read_slot_id = slot_id
+        return [image for (_, image) in self._slots[slot_id]]
 
 class ChunkedImageLoader(data.DataLoader, data.DataGenerator):
+    """Loads the images with the specified frame indices from synchronized chunk archives.
+    Only the chunks containing the requested frames are read, and the most recently read
+    chunk is kept in memory, so frames can also be read in any order with __getitem__.
+    If cache_bytes is not None, up to that many bytes of chunks are cached, so that
+    replaying frames doesn't read their chunks from disk again.
+    If read_ahead is not None, next() reads the next chunk it'll need in a background
+    ChunkReadAhead thread once it has passed the read_ahead fraction of the frames it
+    reads from the current chunk. To overlap the reading with playback, pass
+    read_concurrency='processes'.
+    If image_transform is not None, it's applied to each image as in an ImageLoader, and
+    the transformed images are written into reused buffers, so they're only valid until
+    the next image is read.
+    """
     def __init__(self, archive_paths, indices, downsampling=1,
-                 ChunkLoader=data.DataChunkLoader, *args, **kwargs):
-        self._chunk_loaders = data.SynchronizedDataChunkLoaders(
-            archive_paths, lazy=True, ChunkLoader=ChunkLoader,
+                 ChunkLoader=chunks.Loader, cache_bytes=None, read_ahead=None,
+                 image_transform=None, *args, **kwargs):
+        self._chunk_loaders = chunks.SynchronizedLoaders(
+            archive_paths, lazy=True, ChunkLoader=ChunkLoader, cache_bytes=cache_bytes,
             *args, **kwargs)
-        self._chunks = None
+        self._chunk_position = None
         self._chunks_data = None
         self._all_indices = list(indices)
-        self._indices = iter(self._all_indices)
+        self._position = 0
         self.downsampling = downsampling
-
-    def _get_attrs(self):
-        if self._chunk_loaders.lazy:
-            return self._chunks[0].attrs
+        self.image_transform = image_transform
+        self._transformed_images = None
+        self._read_ahead = None
+        if read_ahead is not None:
+            self._read_ahead = chunks.ChunkReadAhead(
+                self._chunk_loaders, self._all_indices, read_ahead)
+
+    def _load_chunks(self, chunk_position):
+        if chunk_position == self._chunk_position:
+            return
+        if self._read_ahead is not None:
+            self._chunks_data = self._read_ahead.get(chunk_position)
         else:
-            return self._chunks[0][0].attrs
-
-    def _advance_chunks_to(self, index):
-        if index < self._get_attrs()['id']:
-            raise ValueError('ChunkedImageLoader: requested index is before the current chunk!',
-                             index, self._get_attrs()['id'])
-        while index >= (self._get_attrs()['id'] + 1) * self._get_attrs()['size']:
-            self._chunks = next(self._chunk_loaders)
-            self._chunks_data = None
-        if self._chunks_data is None:
-            self._chunks_data = [data.load_chunk_array(chunk) if self._chunk_loaders.lazy else chunk[1]
-                                 for chunk in self._chunks]
+            chunk_name = self._chunk_loaders.frame_index.chunk_names[chunk_position]
+            self._chunks_data = self._chunk_loaders.load_chunk(chunk_name)
+        self._chunk_position = chunk_position
+
+    def __getitem__(self, index):
+        (chunk_position, local_index) = self._chunk_loaders.frame_index.locate(index)
+        self._load_chunks(chunk_position)
+        images = [chunk_data[local_index] for chunk_data in self._chunks_data]
+        if self.image_transform is None:
+            return images
+        if self._transformed_images is None:
+            self._transformed_images = [np.empty_like(image) for image in images]
+        return [self.image_transform(image, transformed_image)
+                for (image, transformed_image) in zip(images, self._transformed_images)]
+
+    def __len__(self):
+        return len(self._all_indices)
+
+    def seek(self, index):
+        """Makes next continue from the first requested index at or after index."""
+        self._position = bisect.bisect_left(self._all_indices, index)
+        if self._read_ahead is not None:
+            self._read_ahead.reset()
 
     # From DataLoader
 
     def load(self):
         self._chunk_loaders.load()
-        self._chunks = next(self._chunk_loaders)
-        if self.downsampling != self._get_attrs()['downsampling']:
+        attrs = self._chunk_loaders.metadata.chunk_attributes
+        if self.downsampling != attrs['downsampling']:
             raise ValueError('Chunk archive(s) have chunks with a different downsampling factor!',
-                             self._get_attrs()['downsampling'], self.downsampling)
+                             attrs['downsampling'], self.downsampling)
+        if self._read_ahead is not None:
+            self._read_ahead.run_concurrent()
 
     def stop_loading(self):
+        if self._read_ahead is not None:
+            self._read_ahead.terminate()
+            self._read_ahead.reset()
         self._chunk_loaders.stop_loading()
+        self._chunk_position = None
+        self._chunks_data = None
 
     # From DataGenerator
 
     def reset(self):
-        self._chunk_loaders.reset()
-        self._chunks_data = None
-        self._indices = iter(self._all_indices)
+        self._position = 0
+        if self._read_ahead is not None:
+            self._read_ahead.reset()
 
     def next(self):
-        index = next(self._indices)
-        self._advance_chunks_to(index)
-        local_index = index - self._get_attrs()['id'] * self._get_attrs()['size']
-        return [chunk_data[local_index] for chunk_data in self._chunks_data]
+        if self._position >= len(self._all_indices):
+            raise StopIteration
+        images = self[self._all_indices[self._position]]
+        if self._read_ahead is not None:
+            self._read_ahead.advance_to(self._position)
+        self._position += 1
+        return images
 
-class ImageLoaderClient(data.DataLoader, data.DataGenerator, data.ArraySource):
+class ImageLoaderClient(data.DataLoader, data.DataGenerator, arrays.ArraySource):
     def __init__(self, dataset, sequences, time_range=None, reference_timestamps=None,
                  downsampling=2, ImageLoader=ConcurrentImageLoader,
-                 ChunkLoader=data.DataChunkLoader):
+                 ChunkLoader=chunks.Loader, image_transform=None):
         self._dataset = dataset
         self.sequences = sequences
         self.load_preprocessed = sequences[0][0].endswith('preprocessed')
         self.downsampling = downsampling
+        self.image_transform = image_transform
 
         time_range = dataset.get_time_range(sequences[0], time_range)
         self.time_range = time_range
@@ -225,13 +757,15 @@ class ImageLoaderClient(data.DataLoader, data.DataGenerator, data.ArraySource):
                           for sequence in self.sequences)
 
         self._image_loader = ChunkedImageLoader(
-            paths, indices, self.downsampling, ChunkLoader=ChunkLoader)
+            paths, indices, self.downsampling, ChunkLoader=ChunkLoader,
+            image_transform=self.image_transform)
 
     def _init_image_loader(self, ImageLoader):
         if self.sequences[0][0].startswith('stereo'):
             (stereo_file_paths, timestamps) = self._dataset.stereo_sequences_by_timestamp(
                 time_range=self.time_range, preprocessed=self.load_preprocessed)
-            self._image_loader = ImageLoader(stereo_file_paths, self.downsampling)
+            self._image_loader = ImageLoader(stereo_file_paths, self.downsampling,
+                                             image_transform=self.image_transform)
             self._timestamps = list(timestamps)
         else:
             raise NotImplementedError('Non-chunked loading of non-stereo image sequences is not implemented!')
@@ -2,11 +2,13 @@
 import multiprocessing
 import ctypes
 import operator
+import functools
 
 import scipy.io
 import numpy as np
 
 from utilities import util, parallelism
+import data
 import arrays
 
 class PointCloud(arrays.ArraysSource):
@@ -42,47 +44,82 @@ class Sequence(object):
 
 # PARALLEL LOADING
 
+_ALIGNMENT = 64  # bytes, so that each array in a shared segment starts on a cache line
+
 class SynchronizedBuffer(object):
+    """A point cloud in a named shared memory segment.
+    The number of points is stored at the start of the segment, followed by each array
+    of point properties. Pickling only saves the name of the segment, so an unpickled
+    copy in another process shares the same point cloud.
+    """
     def __init__(self, num_components=2):
-        self.lock = multiprocessing.RLock()
-        self.num_points = multiprocessing.Value(ctypes.c_int, 0, lock=self.lock)
-        self.__shared_bases = [None for _ in range(num_components)]
+        self.__shared_base = None
+        self.__layout = None
+        self.num_points = None
         self.point_properties = [None for _ in range(num_components)]
 
     def initialize(self, ctypes, shapes):
-        self.__shared_bases = [
-            multiprocessing.Array(ctype, reduce(operator.mul, shape, 1), lock=self.lock)
-            for (base, ctype, shape) in zip(self.__shared_bases, ctypes, shapes)
-        ]
-        self.point_properties = [np.ctypeslib.as_array(base.get_obj()).reshape(*shape)
-                                 for (base, shape) in zip(self.__shared_bases, shapes)]
-
-class DoubleBuffer(parallelism.DoubleBuffer):
-    def __init__(self, num_components=2):
-        super(DoubleBuffer, self).__init__()
-        self._point_clouds = [SynchronizedBuffer(num_components),
-                              SynchronizedBuffer(num_components)]
+        layout = []
+        size = _ALIGNMENT
+        for (ctype, shape) in zip(ctypes, shapes):
+            dtype = np.dtype(ctype)
+            layout.append((dtype, shape, size))
+            size += dtype.itemsize * reduce(operator.mul, shape, 1)
+            size += -size % _ALIGNMENT
+        self.__attach(parallelism.SharedMemory(size), layout)
+
+    def __attach(self, shared_base, layout):
+        self.__shared_base = shared_base
+        self.__layout = layout
+        self.num_points = shared_base.as_value(ctypes.c_int)
+        self.point_properties = [shared_base.as_array(dtype, shape, offset)
+                                 for (dtype, shape, offset) in layout]
+
+    def __getstate__(self):
+        if self.__shared_base is None:
+            return len(self.point_properties)
+        return (self.__shared_base, self.__layout)
+
+    def __setstate__(self, state):
+        if isinstance(state, int):
+            self.__init__(state)
+        else:
+            self.__init__(len(state[1]))
+            self.__attach(*state)
+
+class MultipleBuffer(parallelism.MultipleBuffer):
+    def __init__(self, num_slots, num_components=2):
+        super(MultipleBuffer, self).__init__(num_slots)
+        self._point_clouds = [SynchronizedBuffer(num_components) for _ in range(num_slots)]
 
     def initialize(self, ctypes, shapes):
         for point_cloud in self._point_clouds:
             point_cloud.initialize(ctypes, shapes)
 
-    # From parallelism.DoubleBuffer
+    # From parallelism.MultipleBuffer
 
     def get_buffer(self, buffer_id):
         return self._point_clouds[buffer_id]
 
+class DoubleBuffer(parallelism.DoubleBuffer, MultipleBuffer):
+    def __init__(self, num_components=2):
+        super(DoubleBuffer, self).__init__(num_components=num_components)
+
 class ParallelLoader(parallelism.LoaderGeneratorProcess, arrays.ArraysSource):
-    """Generates point clouds sequentially in a separate process into shared memory."""
-    def __init__(self, PointCloudLoaderGeneratorFactory, *args, **kwargs):
+    """Generates point clouds sequentially in a separate process into shared memory.
+    num_slots is the number of point clouds in shared memory, so the child can load up to
+    num_slots - 1 point clouds ahead of the parent.
+    """
+    def __init__(self, PointCloudLoaderGeneratorFactory, num_slots=2, *args, **kwargs):
         super(ParallelLoader, self).__init__(
-            PointCloudLoaderGeneratorFactory, DoubleBuffer, *args, **kwargs)
+            PointCloudLoaderGeneratorFactory, lambda: MultipleBuffer(num_slots),
+            *args, **kwargs)
 
         self.loader.load()  # Sometimes needed to calculate the array shape
         self.loader.stop_loading()  # We want to start the loader from our child process so we can join it
         self.loader.reset()
-        self.double_buffer.initialize(self.loader.array_ctypes,
-                                      self.loader.array_shapes)
+        self.multiple_buffer.initialize(self.loader.array_ctypes,
+                                        self.loader.array_shapes)
 
     @property
     def time_range(self):
@@ -91,20 +128,17 @@ class ParallelLoader(parallelism.LoaderGeneratorProcess, arrays.ArraysSource):
     def get_times(self):
         return self.loader.get_times()
 
-    # From DoubleBufferedProcess
+    # From MultipleBufferedProcess
 
     def on_write_to_buffer(self, point_cloud, write_buffer):
-        num_allowed_points = self.array_shapes[0][0]
-        num_points = min(point_cloud.num_points, num_allowed_points)
-        write_buffer.num_points.value = num_points
-        util.update_list_data_buffer(
-            write_buffer.point_properties[0], point_cloud.points, point_cloud.num_points)
-        util.update_list_data_buffer(
-            write_buffer.point_properties[1], point_cloud.colors, point_cloud.num_points)
+        # Points past num_points are stale, so they don't need to be cleared
+        util.update_list_data_buffer(write_buffer.point_properties[0], point_cloud.points)
+        write_buffer.num_points.value = util.update_list_data_buffer(
+            write_buffer.point_properties[1], point_cloud.colors)
 
     # From LoaderGeneratorProcess
 
-    def unmarshal_output(self, marshalled, read_buffer):
+    def on_read_from_buffer(self, read_buffer):
         num_points = read_buffer.num_points.value
         point_cloud = PointCloud()
         point_cloud.points = read_buffer.point_properties[0][:num_points, :]
@@ -121,3 +155,93 @@ class ParallelLoader(parallelism.LoaderGeneratorProcess, arrays.ArraysSource):
     def array_shapes(self):
         return self.loader.array_shapes
 
+
+class PooledParallelLoader(data.DataLoader, data.DataGenerator, arrays.ArraysSource):
+    """Generates point clouds in order from a pool of separate processes into shared memory.
+    Each worker is a ParallelLoader which loads every num_workers-th point cloud, so
+    point clouds are decoded concurrently across num_workers cores. Point clouds are
+    taken from the workers in round-robin order, which restores the sequence order.
+    StridedPointCloudLoaderGeneratorFactory needs to return an object which is a Loader,
+    a Generator, and an ArraysSource when called with the keyword arguments offset and
+    stride; the object should generate every stride-th point cloud, starting from the
+    point cloud at position offset.
+    Each point cloud returned by next() remains valid until next() has been called
+    num_workers more times.
+    Times and the time range are those of the whole sequence, which are taken from an
+    unstrided object returned by StridedPointCloudLoaderGeneratorFactory with offset 0
+    and stride 1; that object is only created when needed, and is never loaded.
+    """
+    def __init__(self, StridedPointCloudLoaderGeneratorFactory,
+                 num_workers=(multiprocessing.cpu_count() - 1), num_slots=2):
+        num_workers = max(num_workers, 1)
+        self._workers = [
+            ParallelLoader(functools.partial(StridedPointCloudLoaderGeneratorFactory,
+                                             offset=worker_id, stride=num_workers),
+                           num_slots)
+            for worker_id in range(num_workers)
+        ]
+        self._next_worker_id = 0
+        self._sequence_factory = functools.partial(
+            StridedPointCloudLoaderGeneratorFactory, offset=0, stride=1)
+        self._sequence = None
+
+    @property
+    def num_workers(self):
+        return len(self._workers)
+
+    @property
+    def profilers(self):
+        return [worker.profiler for worker in self._workers]
+
+    def enable_profiling(self, trace_length=1024):
+        """Starts recording stage latencies of each worker into a separate profiler.
+        Call this before load()."""
+        for (worker_id, worker) in enumerate(self._workers):
+            worker.enable_profiling(trace_length, 'ParallelLoader ' + str(worker_id))
+
+    @property
+    def sequence(self):
+        """The unstrided point cloud sequence generated by all workers together."""
+        if self._sequence is None:
+            self._sequence = self._sequence_factory()
+        return self._sequence
+
+    @property
+    def time_range(self):
+        return self.sequence.time_range
+
+    def get_times(self):
+        return self.sequence.get_times()
+
+    # From DataLoader
+
+    def load(self):
+        for worker in self._workers:
+            worker.load()
+
+    def stop_loading(self):
+        for worker in self._workers:
+            worker.stop_loading()
+
+    # From DataGenerator
+
+    def reset(self):
+        for worker in self._workers:
+            worker.reset()
+        self._next_worker_id = 0
+
+    def next(self):
+        # Propagate StopIteration without advancing, so that later calls also stop
+        point_cloud = next(self._workers[self._next_worker_id])
+        self._next_worker_id = (self._next_worker_id + 1) % self.num_workers
+        return point_cloud
+
+    # From ArraySource
+
+    @property
+    def array_ctypes(self):
+        return self._workers[0].array_ctypes
+
+    @property
+    def array_shapes(self):
+        return self._workers[0].array_shapes
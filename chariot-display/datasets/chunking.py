@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+"""Command-line conversion of FileSequences into hdf5 chunk archives.
+
+Example, which packs every image in a directory into an archive of 32-frame chunks
+downsampled by a factor of 2, using 7 worker processes:
+    python -m datasets.chunking images path/to/images path/to/images_chunked.hdf5 \\
+        --suffix .png --downsampling 2 --num-processes 7
+Run the same command again to resume an interrupted conversion.
+"""
+import argparse
+import functools
+import multiprocessing
+
+import numpy as np
+
+from utilities import parallelism
+from data import chunks, images, point_clouds
+from datasets import sequences
+
+def load_point_cloud_frame(file_path, array_name='S'):
+    """Loads a point cloud as a single array of points followed by colors."""
+    point_cloud = point_clouds.PointCloud()
+    point_cloud.load_from_mat(file_path, array_name)
+    return np.hstack((point_cloud.points, point_cloud.colors))
+
+def chunking_workset(sequence_type, parent_path, archive_path, prefix='', suffix='',
+                     chunk_size=32, downsampling=1, array_name='S', max_num_points=None,
+                     **kwargs):
+    """Returns a ChunkingWorkset for the frames of the FileSequence in parent_path.
+    Other keyword arguments are passed to the ChunkingWorkset."""
+    sequence = sequences.FileSequence(parent_path, prefix, suffix)
+    if sequence_type == 'images':
+        load_frame = functools.partial(images.load_image, downsampling=downsampling)
+        chunk_attributes = {'downsampling': downsampling}
+    elif sequence_type == 'point_clouds':
+        if max_num_points is None:
+            raise ValueError('Chunking point clouds requires max_num_points!')
+        load_frame = functools.partial(load_point_cloud_frame, array_name=array_name)
+        chunk_attributes = {}
+    else:
+        raise ValueError('Unknown sequence type!', sequence_type)
+    return chunks.ChunkingWorkset(
+        archive_path, sequence.file_paths, load_frame, chunk_size, chunk_attributes,
+        max_num_points, **kwargs)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a sequence of image or point cloud files into an hdf5 chunk archive.')
+    parser.add_argument('sequence_type', choices=['images', 'point_clouds'])
+    parser.add_argument('parent_path', help='the directory of the sequence files')
+    parser.add_argument('archive_path', help='the path of the chunk archive to write')
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--suffix', default='')
+    parser.add_argument('--chunk-size', type=int, default=32, help='frames per chunk')
+    parser.add_argument('--downsampling', type=int, default=1,
+                        help='the factor by which to downsample images')
+    parser.add_argument('--array-name', default='S',
+                        help='the name of the point cloud array in each .mat file')
+    parser.add_argument('--max-num-points', type=int,
+                        help='the number of points to which each point cloud is padded')
+    parser.add_argument('--compression', choices=['lzf', 'gzip'])
+    parser.add_argument('--compression-level', type=int)
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--contiguous', action='store_true',
+                        help='store uncompressed chunks contiguously, so they can be memory-mapped')
+    parser.add_argument('--num-processes', type=int,
+                        default=max(multiprocessing.cpu_count() - 1, 1))
+    args = parser.parse_args()
+
+    workset = chunking_workset(
+        args.sequence_type, args.parent_path, args.archive_path, args.prefix, args.suffix,
+        args.chunk_size, args.downsampling, args.array_name, args.max_num_points,
+        compression=args.compression, compression_level=args.compression_level,
+        shuffle=args.shuffle, frame_chunking=not args.contiguous)
+    print('Converting ' + str(len(workset.frame_ids)) + ' frames into ' +
+          str(workset.num_chunks) + ' chunks...')
+    with parallelism.WorkerPool(args.num_processes) as pool:
+        failed_work_ids = workset.convert(pool)
+    if failed_work_ids:
+        print('Failed to convert chunks ' +
+              ', '.join(str(chunk_index) for (chunk_index, _) in failed_work_ids) +
+              '. Run the conversion again to retry them.')
+    else:
+        print('Finished conversion.')
+
+if __name__ == '__main__':
+    main()
@@ -45,8 +45,8 @@ class PointCloudSequence(sequences.FileSequence, point_clouds.Sequence):
 # SEQUENCE LOADERS
 
 class PointCloudSequenceLoader(sequences.FileSequenceLoader, arrays.ArraysSource):
-    def __init__(self, sequence, max_num_points=None):
-        super(PointCloudSequenceLoader, self).__init__(sequence)
+    def __init__(self, sequence, max_num_points=None, offset=0, stride=1):
+        super(PointCloudSequenceLoader, self).__init__(sequence, offset, stride)
         self.max_num_points = max_num_points
 
     # From ArraysSource
@@ -61,9 +61,9 @@ class PointCloudSequenceLoader(sequences.FileSequenceLoader, arrays.ArraysSource
 
 class PointCloudSequenceConcurrentLoader(sequences.FileSequenceConcurrentLoader,
                                          arrays.ArraysSource):
-    def __init__(self, sequence, max_size=10, max_num_points=None):
+    def __init__(self, sequence, max_size=10, max_num_points=None, offset=0, stride=1):
         super(PointCloudSequenceConcurrentLoader, self).__init__(
-            sequence, max_size)
+            sequence, max_size, offset=offset, stride=stride)
         self.max_num_points = max_num_points
 
     # From ArraysSource
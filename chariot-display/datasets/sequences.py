@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 """Functions and classes for loading of data from Oxford datasets."""
 from os import path
+import itertools
 
 from utilities import files
 from data import data, concurrent
@@ -45,11 +46,19 @@ class FileSequence(Sequence):
         return files.paths(self.parent_path, self.indices, self.prefix, self.suffix)
 
 class FileSequenceLoader(data.DataLoader, data.DataGenerator):
-    """Class for synchronous loading of FileSequences."""
-    def __init__(self, sequence, *args, **kwargs):
+    """Class for synchronous loading of FileSequences.
+    Only every stride-th file of the sequence is loaded, starting with the file at
+    position offset; by default, every file is loaded.
+    """
+    def __init__(self, sequence, offset=0, stride=1, *args, **kwargs):
         super(FileSequenceLoader, self).__init__(*args, **kwargs)
         self.sequence = sequence
-        self._indices = self.sequence.indices
+        self.offset = offset
+        self.stride = stride
+        self._indices = self._sequence_indices()
+
+    def _sequence_indices(self):
+        return itertools.islice(self.sequence.indices, self.offset, None, self.stride)
 
     def load_next(self):
         """Loads the data at the next time point specified by the indices and returns it.
@@ -74,11 +83,11 @@ class FileSequenceLoader(data.DataLoader, data.DataGenerator):
 
     def reset(self):
         """Resets the loader to start loading from the top."""
-        self._indices = self.sequence.indices
+        self._indices = self._sequence_indices()
 
     def __len__(self):
-        """Returns the number of time points of data in the sequence."""
-        return self.sequence.num_samples
+        """Returns the number of time points of data loaded from the sequence."""
+        return len(range(self.offset, self.sequence.num_samples, self.stride))
 
 class FileSequenceConcurrentLoader(concurrent.Loader, FileSequenceLoader):
     def __init__(self, sequence, max_size, *args, **kwargs):
@@ -5,13 +5,17 @@ import data
 # Image Display
 
 class ImageDisplayer(data.images.ImageLoaderClient):
+    """Displays images in OpenCV windows.
+    If image_rotation_angle is nonzero, images are rotated by an ImageRotation in the
+    image loader, so that next() and redraw only need to display them."""
     def __init__(self, image_rotation_angle, *args, **kwargs):
+        if image_rotation_angle:
+            kwargs['image_transform'] = data.images.ImageRotation(image_rotation_angle)
         super(ImageDisplayer, self).__init__(*args, **kwargs)
         self.windows = []
         self.updated_state = False
         self.images = []
         self.image_rotation_angle = image_rotation_angle
-        self.image_rotation = None
 
     def redraw(self):
         # This needs to be called in the main thread for thread-safety!
@@ -24,11 +28,6 @@ class ImageDisplayer(data.images.ImageLoaderClient):
     def load(self):
         super(ImageDisplayer, self).load()
 
-        # Initialize rotation
-        if self.image_rotation_angle:
-            image_shape = self.get_image_shape()
-            self.image_rotation = cv2.getRotationMatrix2D((image_shape[0] / 2, image_shape[0] / 2), self.image_rotation_angle, 1)
-
         # Initialize windows
         self.windows = [str(sequence) for sequence in self.sequences]
         cv2.startWindowThread()
@@ -50,6 +49,4 @@ class ImageDisplayer(data.images.ImageLoaderClient):
 
     def next(self):
         self.images = super(ImageDisplayer, self).next()
-        if self.image_rotation is not None:
-            self.images = [cv2.warpAffine(image, self.image_rotation, self.get_image_shape()) for image in self.images]
         self.updated_state = True
@@ -11,7 +11,7 @@ class Animator(scene.SceneAnimator):
         self.sequence = self.dataset.sequences['point_cloud']['mrf']['files']
         self.point_cloud_loader = point_clouds.ParallelLoader(
             lambda: omnistereo.PointCloudSequenceConcurrentLoader(
-                self.sequence, max_num_points=300000))
+                self.sequence, max_num_points=300000), num_slots=8)
 
     def register_canvas(self, canvas):
         super(Animator, self).register_canvas(canvas)
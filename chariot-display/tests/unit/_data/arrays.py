@@ -2,6 +2,7 @@
 import unittest
 import time
 import ctypes
+import pickle
 
 import numpy as np
 
@@ -11,6 +12,15 @@ from data import data, arrays
 def make_small_array(i):
     return np.array([[i, i + 1], [i + 2, i + 3]]).astype(int)
 
+class TestArraySynchronizedBuffer(unittest.TestCase):
+    def test_pickle(self):
+        buffer = arrays.SynchronizedBuffer()
+        buffer.initialize(ctypes.c_int, (2, 2))
+        unpickled = pickle.loads(pickle.dumps(buffer))
+        np.copyto(unpickled.buffer, make_small_array(1))
+        self.assertEqual(buffer.buffer.tolist(), [[1, 2], [3, 4]],
+                         'Incorrect sharing of unpickled buffer')
+
 class ArrayDoubleBufferClient(parallelism.DoubleBufferedProcess):
     def __init__(self, *args, **kwargs):
         super(ArrayDoubleBufferClient, self).__init__(
@@ -119,8 +129,7 @@ class TestArrayParallelLoader(unittest.TestCase):
     def setUp(self):
         self.loader = None
 
-    def test_generation(self):
-        self.loader = arrays.ParallelLoader(lambda: ArrayLoader(20))
+    def assert_generation(self):
         for _ in range(5):
             self.loader.load()
             for i in range(20):
@@ -134,7 +143,72 @@ class TestArrayParallelLoader(unittest.TestCase):
             self.loader.stop_loading()
             self.loader.reset()
 
+    def test_generation(self):
+        self.loader = arrays.ParallelLoader(lambda: ArrayLoader(20))
+        self.assert_generation()
+
+    def test_multiple_buffered_generation(self):
+        self.loader = arrays.ParallelLoader(lambda: ArrayLoader(20), num_slots=4)
+        self.assert_generation()
+
     def tearDown(self):
         if self.loader is not None:
             self.loader.stop_loading()
 
+
+class SmallArrayWorkset(arrays.ArrayWorkset):
+    def __init__(self, num_work_units):
+        super(SmallArrayWorkset, self).__init__()
+        self.num_work_units = num_work_units
+
+    # From ArrayWorkset
+
+    def work_array(self, work_id, output_array):
+        np.copyto(output_array, make_small_array(work_id))
+
+    # From Workset
+
+    def work_ids(self):
+        return range(self.num_work_units)
+
+    def handle_progress(self, num_finished, num_work_units, elapsed_time):
+        pass
+
+    # From ArraySource
+
+    @property
+    def array_ctype(self):
+        return ctypes.c_int
+
+    @property
+    def array_shape(self):
+        return (2, 2)
+
+class TestArrayWorkset(unittest.TestCase):
+    def setUp(self):
+        self.workset = SmallArrayWorkset(20)
+
+    def assert_output(self):
+        self.assertEqual(self.workset.output.shape, (20, 2, 2), 'Incorrect output shape')
+        for i in range(20):
+            self.assertEqual(self.workset.output[i].tolist(), make_small_array(i).tolist(),
+                             'Incorrect output')
+        self.assertEqual(self.workset.failed_work_ids, [], 'Incorrect failed work units')
+
+    def test_sequential(self):
+        self.workset.execute_sequential()
+        self.assert_output()
+
+    def test_parallel(self):
+        self.workset.execute_parallel(2, chunksize=4)
+        self.assert_output()
+
+    def test_persistent_pool(self):
+        with parallelism.WorkerPool(2) as pool:
+            self.workset.execute_parallel(pool=pool)
+            self.assert_output()
+            output = self.workset.output
+            self.workset.output[:] = 0
+            self.workset.execute_parallel(pool=pool)
+            self.assertIs(self.workset.output, output, 'Output was not reused')
+            self.assert_output()
@@ -0,0 +1,537 @@
+#!/usr/bin/env python2
+import unittest
+import os
+import shutil
+import tempfile
+import multiprocessing
+import pickle
+import ctypes
+
+import numpy as np
+import h5py
+
+from utilities import parallelism
+from data import chunks
+
+def make_chunk(chunk_index, chunk_size=4):
+    return (np.arange(chunk_size * 6 * 8).reshape(chunk_size, 6, 8) + chunk_index).astype(np.uint8)
+
+def write_chunks(writer, chunk_indices):
+    for chunk_index in chunk_indices:
+        writer.write(chunk_index, make_chunk(chunk_index), {'id': chunk_index})
+
+def make_frame(frame_id):
+    if frame_id == 'broken':
+        raise IOError('Broken frame')
+    return np.full((frame_id % 3 + 1, 2), frame_id, dtype=np.int16)
+
+class TestChunkWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive.hdf5')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_chunks(self, chunk_indices):
+        with h5py.File(self.archive_path, 'r') as hf:
+            self.assertEqual(sorted(int(name) for name in hf['chunks'].keys()),
+                             sorted(chunk_indices), 'Incorrect chunk names')
+            for chunk_index in chunk_indices:
+                chunk = hf['chunks'][str(chunk_index)]
+                self.assertTrue(np.array_equal(chunk[:], make_chunk(chunk_index)),
+                                'Incorrect chunk data')
+                self.assertEqual(chunk.attrs['id'], chunk_index, 'Incorrect chunk attributes')
+
+    def test_batches(self):
+        with chunks.ChunkWriter(self.archive_path, batch_size=3) as writer:
+            write_chunks(writer, range(4))
+            self.assertEqual(len(writer._pending_chunks), 1, 'Incorrect batching')
+        self.assert_chunks(range(4))
+
+    def test_compression(self):
+        with chunks.ChunkWriter(self.archive_path, compression='gzip',
+                                compression_level=4, shuffle=True) as writer:
+            write_chunks(writer, range(2))
+        self.assert_chunks(range(2))
+        with h5py.File(self.archive_path, 'r') as hf:
+            chunk = hf['chunks']['0']
+            self.assertEqual(chunk.compression, 'gzip', 'Incorrect compression')
+            self.assertEqual(chunk.compression_opts, 4, 'Incorrect compression level')
+            self.assertTrue(chunk.shuffle, 'Incorrect shuffle filter')
+            self.assertEqual(chunk.chunks, (1, 6, 8), 'Incorrect frame chunking')
+
+    def test_save_chunk(self):
+        chunks.save_chunk(self.archive_path, make_chunk(0), 0, {'id': 0})
+        chunks.save_chunk(self.archive_path, make_chunk(1), 1, {'id': 1})
+        self.assert_chunks(range(2))
+        with h5py.File(self.archive_path, 'r') as hf:
+            self.assertIsNone(hf['chunks']['0'].chunks, 'Incorrect contiguous layout')
+
+    def test_writer_process(self):
+        with chunks.ChunkWriterProcess(self.archive_path, compression='lzf') as writer:
+            producers = [multiprocessing.Process(target=write_chunks,
+                                                 args=(writer, range(i, 12, 3)))
+                         for i in range(3)]
+            for producer in producers:
+                producer.start()
+            for producer in producers:
+                producer.join()
+        self.assert_chunks(range(12))
+
+class TestFrameIndex(unittest.TestCase):
+    def test_locate(self):
+        frame_index = chunks.FrameIndex(['0', '1', '2'], [4, 4, 2])
+        self.assertEqual(len(frame_index), 10, 'Incorrect number of frames')
+        self.assertEqual(frame_index.locate(0), (0, 0), 'Incorrect frame location')
+        self.assertEqual(frame_index.locate(5), (1, 1), 'Incorrect frame location')
+        self.assertEqual(frame_index.locate(9), (2, 1), 'Incorrect frame location')
+        self.assertEqual(frame_index.locate(-1), (2, 1), 'Incorrect negative frame location')
+        with self.assertRaises(IndexError):
+            frame_index.locate(10)
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive.hdf5')
+        with chunks.ChunkWriter(self.archive_path) as writer:
+            write_chunks(writer, range(12))
+        self.loader = chunks.Loader(self.archive_path)
+        self.loader.load()
+
+    def tearDown(self):
+        self.loader.stop_loading()
+        shutil.rmtree(self.directory)
+
+    def test_frame_index(self):
+        frame_index = self.loader.frame_index
+        self.assertEqual(len(frame_index), 48, 'Incorrect number of frames')
+        self.assertEqual(frame_index.chunk_names[:3], ['0', '1', '2'],
+                         'Incorrect natural ordering of chunks')
+
+    def test_seek(self):
+        next(self.loader)
+        next(self.loader)
+        offset = self.loader.seek(6)
+        self.assertEqual(offset, 2, 'Incorrect seek offset')
+        (chunk, chunk_array) = next(self.loader)
+        self.assertEqual(chunk.attrs['id'], 1, 'Incorrect backwards seek')
+        self.assertEqual(len([next(self.loader) for _ in range(10)]), 10,
+                         'Incorrect chunks after seek')
+        with self.assertRaises(StopIteration):
+            next(self.loader)
+
+    def test_load_frame(self):
+        for frame in [45, 3, 30]:
+            self.assertTrue(np.array_equal(self.loader.load_frame(frame),
+                                           make_chunk(frame // 4)[frame % 4]),
+                            'Incorrect frame data')
+
+class TestChunkCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = chunks.ChunkCache(2 * make_chunk(0).nbytes)
+        for chunk_index in range(3):
+            cache.put(chunk_index, make_chunk(chunk_index))
+        self.assertEqual(len(cache), 2, 'Incorrect cache size')
+        self.assertEqual(cache.num_bytes, 2 * make_chunk(0).nbytes, 'Incorrect cache size')
+        self.assertIsNone(cache.get(0), 'Incorrect eviction')
+        self.assertIsNotNone(cache.get(1), 'Incorrect eviction')
+        cache.put(3, make_chunk(3))
+        self.assertIsNone(cache.get(2), 'Incorrect least-recently-used eviction')
+        self.assertTrue(np.array_equal(cache.get(1), make_chunk(1)), 'Incorrect cached data')
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 2, 2),
+                         'Incorrect counters')
+        self.assertFalse(cache.get(1).flags.writeable, 'Incorrect read-only cached data')
+
+    def test_oversized(self):
+        cache = chunks.ChunkCache(make_chunk(0).nbytes - 1)
+        cache.put(0, make_chunk(0))
+        self.assertEqual(len(cache), 0, 'Incorrect caching of oversized chunk')
+
+class TestSynchronizedLoaders(unittest.TestCase):
+    read_concurrency = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_paths = [os.path.join(self.directory, name + '.hdf5')
+                              for name in ['left', 'right']]
+        for archive_path in self.archive_paths:
+            with chunks.ChunkWriter(archive_path) as writer:
+                write_chunks(writer, range(4))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def loop(self, loaders, num_loops):
+        loaders.load()
+        for _ in range(num_loops):
+            loaders.reset()
+            for chunk_index in range(4):
+                for (chunk, chunk_array) in next(loaders):
+                    self.assertTrue(np.array_equal(chunk_array, make_chunk(chunk_index)),
+                                    'Incorrect chunk data')
+        loaders.stop_loading()
+
+    def test_fitting_loop(self):
+        loaders = chunks.SynchronizedLoaders(self.archive_paths,
+                                             cache_bytes=8 * make_chunk(0).nbytes,
+                                             read_concurrency=self.read_concurrency)
+        self.loop(loaders, 3)
+        self.assertEqual((loaders.cache.misses, loaders.cache.hits), (8, 16),
+                         'Incorrect caching of looped playback')
+        self.assertEqual(loaders.cache.evictions, 0, 'Incorrect eviction')
+
+    def test_overflowing_loop(self):
+        loaders = chunks.SynchronizedLoaders(self.archive_paths,
+                                             cache_bytes=4 * make_chunk(0).nbytes,
+                                             read_concurrency=self.read_concurrency)
+        self.loop(loaders, 2)
+        self.assertEqual(len(loaders.cache), 4, 'Incorrect cache size')
+        self.assertEqual(loaders.cache.evictions, 12, 'Incorrect eviction')
+
+    def test_uncached_loop(self):
+        loaders = chunks.SynchronizedLoaders(self.archive_paths,
+                                             read_concurrency=self.read_concurrency)
+        self.loop(loaders, 2)
+
+    def test_load_chunk(self):
+        loaders = chunks.SynchronizedLoaders(self.archive_paths,
+                                             read_concurrency=self.read_concurrency)
+        loaders.load()
+        out = loaders.allocate_chunk_buffers()
+        for chunk_index in [2, 0]:
+            loaded = loaders.load_chunk(chunk_index, out)
+            for (chunk_array, chunk_out) in zip(loaded, out):
+                self.assertTrue(np.array_equal(chunk_array, make_chunk(chunk_index)),
+                                'Incorrect chunk data')
+                self.assertIs(chunk_array.base, chunk_out, 'Incorrect read into chunk buffer')
+        loaded = loaders.load_chunk(1)
+        self.assertTrue(np.array_equal(loaded[1], make_chunk(1)), 'Incorrect chunk data')
+        loaders.stop_loading()
+
+class TestThreadedSynchronizedLoaders(TestSynchronizedLoaders):
+    read_concurrency = 'threads'
+
+class TestMultiprocessSynchronizedLoaders(TestSynchronizedLoaders):
+    read_concurrency = 'processes'
+
+class TestDirectReads(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive.hdf5')
+        with chunks.ChunkWriter(self.archive_path, compression='lzf') as writer:
+            write_chunks(writer, range(2))
+            writer.write(2, make_chunk(2, chunk_size=2))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_direct_reads(self, loader):
+        loader.load()
+        out = loader.allocate_chunk_buffer()
+        self.assertEqual(out.shape, (4, 6, 8), 'Incorrect chunk buffer shape')
+        for chunk_index in [1, 2, 0]:
+            loaded = loader.load_chunk(chunk_index, out)
+            chunk_size = 2 if chunk_index == 2 else 4
+            self.assertTrue(np.array_equal(loaded, make_chunk(chunk_index, chunk_size)),
+                            'Incorrect chunk data')
+            self.assertIs(loaded.base, out, 'Incorrect read into chunk buffer')
+        loader.stop_loading()
+
+    def test_uncached(self):
+        self.check_direct_reads(chunks.Loader(self.archive_path))
+
+    def test_cached(self):
+        cache = chunks.ChunkCache(16 * make_chunk(0).nbytes)
+        self.check_direct_reads(chunks.Loader(self.archive_path, cache=cache))
+        self.check_direct_reads(chunks.Loader(self.archive_path, cache=cache))
+        self.assertEqual((cache.misses, cache.hits), (3, 3), 'Incorrect caching')
+
+class ProgressChunkingWorkset(chunks.ChunkingWorkset):
+    def __init__(self, *args, **kwargs):
+        chunks.ChunkingWorkset.__init__(self, *args, **kwargs)
+        self.progress = []
+
+    def handle_progress(self, num_finished, num_work_units, elapsed_time):
+        self.progress.append(self._num_frames_converted)
+
+class TestChunkingWorkset(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive.hdf5')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_convert(self):
+        workset = chunks.ChunkingWorkset(self.archive_path, range(10), make_frame, chunk_size=4,
+                                         chunk_attributes={'downsampling': 2}, frame_length=3,
+                                         compression='lzf')
+        self.assertEqual(workset.num_chunks, 3, 'Incorrect number of chunks')
+        with parallelism.WorkerPool(2) as pool:
+            self.assertEqual(workset.convert(pool, progress_interval=None), [],
+                             'Incorrect failed chunks')
+        loader = chunks.Loader(self.archive_path)
+        loader.load()
+        self.assertEqual(len(loader.frame_index), 10, 'Incorrect number of frames')
+        for frame_id in range(10):
+            self.assertTrue(np.array_equal(loader.load_frame(frame_id)[:frame_id % 3 + 1],
+                                           make_frame(frame_id)), 'Incorrect frame data')
+        attrs = loader[2].attrs
+        self.assertEqual((attrs['id'], attrs['size'], attrs['downsampling']), (2, 2, 2),
+                         'Incorrect chunk attributes')
+        self.assertEqual(list(attrs['frame_lengths']), [3, 1], 'Incorrect frame lengths')
+        loader.stop_loading()
+
+    def test_resume(self):
+        frame_ids = list(range(4)) + ['broken'] + list(range(5, 12))
+        workset = chunks.ChunkingWorkset(self.archive_path, frame_ids, make_frame,
+                                         chunk_size=4, frame_length=3)
+        with parallelism.WorkerPool(2) as pool:
+            failed_work_ids = workset.convert(pool, progress_interval=None)
+            self.assertEqual([chunk_index for (chunk_index, _) in failed_work_ids], [1],
+                             'Incorrect failed chunks')
+            self.assertEqual(workset.written_chunks(), set([0, 2]), 'Incorrect written chunks')
+            workset.frame_ids = list(range(12))
+            self.assertEqual([chunk_index for (chunk_index, _) in workset.work_ids()], [1],
+                             'Incorrect resumed chunks')
+            workset.convert(pool, progress_interval=None)
+        self.assertEqual(workset.written_chunks(), set([0, 1, 2]), 'Incorrect resumed conversion')
+
+    def test_progress(self):
+        workset = ProgressChunkingWorkset(self.archive_path, range(10), make_frame,
+                                          chunk_size=4, frame_length=3)
+        with parallelism.WorkerPool(2) as pool:
+            workset.convert(pool, progress_interval=0)
+        self.assertEqual(workset.progress[-1], 10, 'Incorrect number of converted frames')
+
+    def test_pickle(self):
+        workset = chunks.ChunkingWorkset(self.archive_path, range(1000), make_frame,
+                                         chunk_size=4, frame_length=3)
+        unpickled = pickle.loads(pickle.dumps(workset))
+        self.assertIsNone(unpickled.frame_ids, 'Incorrect pickling of frame ids')
+        (chunk, frame_lengths) = unpickled.work((1, (4, 5, 6, 7)))
+        self.assertEqual(frame_lengths, [2, 3, 1, 2], 'Incorrect work on unpickled workset')
+
+class TestChunksSynchronizedBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = chunks.SynchronizedBuffer()
+        self.buffer.initialize([np.uint8, np.float64], [(4, 6, 8), (4, 2)],
+                               max_attributes_size=256)
+
+    def test_pickle(self):
+        unpickled = pickle.loads(pickle.dumps(self.buffer))
+        unpickled.arrays[1][:] = 1.5
+        unpickled.chunk_lengths[:] = [4, 3]
+        unpickled.write_attributes([{'id': 1}, {'id': 1}])
+        self.assertEqual(self.buffer.arrays[1].tolist(), [[1.5, 1.5] for _ in range(4)],
+                         'Incorrect sharing of unpickled chunk arrays')
+        self.assertEqual(self.buffer.chunk_lengths.tolist(), [4, 3],
+                         'Incorrect sharing of unpickled chunk lengths')
+        self.assertEqual(self.buffer.read_attributes(), [{'id': 1}, {'id': 1}],
+                         'Incorrect sharing of unpickled chunk attributes')
+
+    def test_oversized_attributes(self):
+        with self.assertRaises(ValueError):
+            self.buffer.write_attributes([{'frame_lengths': list(range(256))}])
+
+class TestParallelLoader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_paths = [os.path.join(self.directory, name + '.hdf5')
+                              for name in ['left', 'right']]
+        for archive_path in self.archive_paths:
+            with chunks.ChunkWriter(archive_path, compression='lzf') as writer:
+                write_chunks(writer, range(3))
+                writer.write(3, make_chunk(3, chunk_size=2), {'id': 3})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_loading(self, loader):
+        self.assertEqual(loader.array_shapes, [(4, 6, 8), (4, 6, 8)], 'Incorrect array shapes')
+        for _ in range(2):
+            loader.load()
+            for chunk_index in range(4):
+                loaded = next(loader)
+                self.assertEqual(len(loaded), 2, 'Incorrect number of archives')
+                for (chunk, chunk_array) in loaded:
+                    chunk_size = 2 if chunk_index == 3 else 4
+                    self.assertTrue(np.array_equal(chunk_array, make_chunk(chunk_index, chunk_size)),
+                                    'Incorrect chunk data')
+                    self.assertEqual(chunk.attrs['id'], chunk_index, 'Incorrect chunk attributes')
+            with self.assertRaises(StopIteration):
+                next(loader)
+            loader.reset()
+        loader.stop_loading()
+
+    def test_loading(self):
+        self.check_loading(chunks.ParallelLoader(self.archive_paths, num_slots=3))
+
+    def test_no_parent_allocation(self):
+        def allocate_chunk_buffer(loader):
+            raise AssertionError('Chunk buffer allocated in the parent')
+        original = chunks.Loader.allocate_chunk_buffer
+        chunks.Loader.allocate_chunk_buffer = allocate_chunk_buffer
+        try:
+            loader = chunks.ParallelLoader(self.archive_paths)
+        finally:
+            chunks.Loader.allocate_chunk_buffer = original
+        self.assertEqual(loader.array_shapes, [(4, 6, 8), (4, 6, 8)], 'Incorrect array shapes')
+        self.assertEqual(loader.array_ctypes, [ctypes.c_uint8, ctypes.c_uint8],
+                         'Incorrect array ctypes')
+
+    def test_multiprocess_reads(self):
+        self.check_loading(chunks.ParallelLoader(self.archive_paths, read_concurrency='processes',
+                                                 cache_bytes=2 * make_chunk(0).nbytes))
+
+class TestMemoryMapping(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive.hdf5')
+        self.contiguous_archive_path = os.path.join(self.directory, 'contiguous.hdf5')
+        with chunks.ChunkWriter(self.archive_path, compression='gzip') as writer:
+            write_chunks(writer, range(3))
+        chunks.export_contiguous(self.archive_path, self.contiguous_archive_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_map(self):
+        loader = chunks.Loader(self.contiguous_archive_path, memory_map=True)
+        loader.load()
+        for chunk_index in range(3):
+            (chunk, chunk_array) = next(loader)
+            self.assertIsInstance(chunk_array, np.memmap, 'Incorrect memory mapping')
+            self.assertFalse(chunk_array.flags.writeable, 'Incorrect read-only memory mapping')
+            self.assertTrue(np.array_equal(chunk_array, make_chunk(chunk_index)),
+                            'Incorrect chunk data')
+            self.assertEqual(chunk.attrs['id'], chunk_index, 'Incorrect exported attributes')
+        self.assertTrue(np.array_equal(loader.load_frame(5), make_chunk(1)[1]),
+                        'Incorrect frame data')
+        out = loader.allocate_chunk_buffer()
+        self.assertTrue(np.array_equal(loader.load_chunk(2, out), make_chunk(2)),
+                        'Incorrect chunk data')
+        loader.stop_loading()
+        self.assertTrue(np.array_equal(chunk_array, make_chunk(2)),
+                        'Incorrect chunk data after closing archive')
+
+    def test_fallback(self):
+        loader = chunks.Loader(self.archive_path, memory_map=True)
+        loader.load()
+        chunk_array = loader.load_chunk(1)
+        self.assertNotIsInstance(chunk_array, np.memmap, 'Incorrect memory mapping')
+        self.assertTrue(np.array_equal(chunk_array, make_chunk(1)), 'Incorrect chunk data')
+        loader.stop_loading()
+
+class TestArchiveMetadata(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive.hdf5')
+        with chunks.ChunkWriter(self.archive_path) as writer:
+            write_chunks(writer, range(11))
+            writer.write(11, make_chunk(11, chunk_size=2), {'id': 11})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sort_chunk_names(self):
+        self.assertEqual(chunks.sort_chunk_names(['10', '2', '1']), ['1', '2', '10'],
+                         'Incorrect numeric chunk order')
+        self.assertEqual(chunks.sort_chunk_names(['a10', 'a2']), ['a2', 'a10'],
+                         'Incorrect natural chunk order')
+
+    def test_written_metadata(self):
+        with h5py.File(self.archive_path, 'r') as hf:
+            metadata = chunks.ArchiveMetadata.read(hf)
+        self.assertIsNotNone(metadata, 'Incorrect metadata writing')
+        self.assertEqual(metadata.chunk_names, [str(i) for i in range(12)],
+                         'Incorrect chunk names')
+        self.assertEqual(metadata.chunk_lengths.tolist(), [4] * 11 + [2],
+                         'Incorrect chunk lengths')
+        self.assertEqual((metadata.chunk_shape, metadata.dtype), ((4, 6, 8), np.uint8),
+                         'Incorrect chunk shape')
+        self.assertEqual(metadata.chunk_attributes['id'], 0, 'Incorrect chunk attributes')
+
+    def test_stale_metadata(self):
+        chunks.save_chunk(self.archive_path, make_chunk(12, chunk_size=2), 12, {'id': 12})
+        with h5py.File(self.archive_path, 'r') as hf:
+            self.assertIsNone(chunks.ArchiveMetadata.read(hf), 'Incorrect stale metadata')
+        loader = chunks.Loader(self.archive_path)
+        self.assertEqual(loader.metadata.num_chunks, 13, 'Incorrect scanned metadata')
+        with h5py.File(self.archive_path, 'r') as hf:
+            self.assertEqual(chunks.ArchiveMetadata.read(hf).num_chunks, 13,
+                             'Incorrect written-back metadata')
+
+    def test_replaced_chunk(self):
+        chunks.save_chunk(self.archive_path, make_chunk(5, chunk_size=3), 5, {'id': 5})
+        with h5py.File(self.archive_path, 'r') as hf:
+            self.assertIsNone(chunks.ArchiveMetadata.read(hf), 'Incorrect stale metadata')
+        metadata = chunks.load_metadata(self.archive_path)
+        self.assertEqual(metadata.chunk_lengths.tolist(), [4] * 5 + [3] + [4] * 5 + [2],
+                         'Incorrect scanned chunk lengths')
+        with h5py.File(self.archive_path, 'r') as hf:
+            self.assertEqual(chunks.ArchiveMetadata.read(hf).chunk_lengths[5], 3,
+                             'Incorrect written-back metadata')
+
+    def test_loader(self):
+        loader = chunks.Loader(self.archive_path)
+        self.assertEqual(loader.array_shape, (4, 6, 8), 'Incorrect array shape')
+        self.assertEqual(loader.array_ctype, ctypes.c_ubyte, 'Incorrect array ctype')
+        loader.load()
+        self.assertEqual(len(loader.frame_index), 46, 'Incorrect number of frames')
+        for chunk_index in range(12):
+            (chunk, _) = next(loader)
+            self.assertEqual(chunk.attrs['id'], chunk_index, 'Incorrect chunk order')
+        loader.stop_loading()
+
+class TestChunkReadAhead(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive_paths = [os.path.join(self.directory, name + '.hdf5')
+                              for name in ['left', 'right']]
+        for archive_path in self.archive_paths:
+            with chunks.ChunkWriter(archive_path) as writer:
+                write_chunks(writer, range(12))
+        self.loaders = chunks.SynchronizedLoaders(self.archive_paths, lazy=True)
+        self.loaders.load()
+
+    def tearDown(self):
+        self.loaders.stop_loading()
+        shutil.rmtree(self.directory)
+
+    def test_policy(self):
+        read_ahead = chunks.ChunkReadAhead(self.loaders, range(48), 0.5)
+        for position in range(2):
+            read_ahead.advance_to(position)
+            self.assertIsNone(read_ahead._requested_position, 'Incorrect early read-ahead')
+        read_ahead.advance_to(2)
+        self.assertEqual(read_ahead._requested_position, 1, 'Incorrect read-ahead')
+        read_ahead.request(5)
+        read_ahead.advance_to(3)
+        self.assertEqual(read_ahead._requested_position, 5, 'Incorrect repeated read-ahead')
+
+    def test_strided_policy(self):
+        read_ahead = chunks.ChunkReadAhead(self.loaders, range(0, 48, 6), 0.5)
+        read_ahead.advance_to(0)
+        self.assertEqual(read_ahead._requested_position, 1, 'Incorrect strided read-ahead')
+        read_ahead.advance_to(1)
+        self.assertEqual(read_ahead._requested_position, 3,
+                         'Incorrect strided read-ahead across skipped chunk')
+        read_ahead.advance_to(7)
+        self.assertEqual(read_ahead._requested_position, 3, 'Incorrect read-ahead past the end')
+
+    def test_get(self):
+        read_ahead = chunks.ChunkReadAhead(self.loaders, range(48), 0.5)
+        read_ahead.run_concurrent()
+        for position in range(48):
+            read_ahead.advance_to(position)
+            chunk_index = position // 4 + 1
+            if position % 4 == 2 and chunk_index < 12:
+                for chunk_array in read_ahead.get(chunk_index):
+                    self.assertTrue(np.array_equal(chunk_array, make_chunk(chunk_index)),
+                                    'Incorrect read-ahead chunk data')
+        for chunk_array in read_ahead.get(0):
+            self.assertTrue(np.array_equal(chunk_array, make_chunk(0)),
+                            'Incorrect direct chunk data')
+        read_ahead.terminate()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+import unittest
+import os
+import gc
+import time
+import threading
+
+from utilities import concurrency
+from data import concurrent
+
+class CountingLoader(concurrent.Loader):
+    def __init__(self, max_size=2):
+        super(CountingLoader, self).__init__(max_size)
+        self.counter = 0
+
+    def load_next(self):
+        self.counter += 1
+        return self.counter
+
+class StoppingNotifier(concurrency.Notifier):
+    """Stops the loader from another thread right before it's cleared while the loader's
+    queue is full, so that the stopping notification arrives before the clear."""
+    def __init__(self, loader):
+        super(StoppingNotifier, self).__init__()
+        self.loader = loader
+        self.stopper = None
+
+    def clear(self):
+        if self.stopper is None and self.loader._data_queue.full():
+            self.stopper = threading.Thread(target=self.loader.stop_loading)
+            self.stopper.daemon = True
+            self.stopper.start()
+            while not self.is_set():
+                time.sleep(0.001)
+        super(StoppingNotifier, self).clear()
+
+def num_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+class TestLoader(unittest.TestCase):
+    def assert_stops(self, loader):
+        thread = threading.Thread(target=loader.stop_loading)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'Loader did not stop')
+
+    def test_next(self):
+        loader = CountingLoader()
+        loader.load()
+        try:
+            self.assertEqual([next(loader) for _ in range(5)], [1, 2, 3, 4, 5],
+                             'Incorrect loaded data')
+        finally:
+            self.assert_stops(loader)
+
+    def test_stop_while_full(self):
+        loader = CountingLoader(max_size=1)
+        loader._space_available.close()
+        loader._space_available = StoppingNotifier(loader)
+        loader.load()
+        while loader._space_available.stopper is None:
+            time.sleep(0.01)
+        loader._space_available.stopper.join(5)
+        self.assertFalse(loader._space_available.stopper.is_alive(), 'Loader did not stop')
+        self.assertEqual(loader._data_queue.qsize(), 1, 'Incorrect queue state')
+
+    def test_reload(self):
+        loader = CountingLoader()
+        loader.load()
+        self.assertEqual(next(loader), 1, 'Incorrect loaded data')
+        loader.reset()
+        loader.load()
+        try:
+            self.assertIsNotNone(next(loader), 'Incorrect reloaded data')
+        finally:
+            self.assert_stops(loader)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Needs /proc/self/fd')
+    def test_fd_release(self):
+        initial_num_fds = num_open_fds()
+        for _ in range(20):
+            loader = CountingLoader()
+            loader.load()
+            next(loader)
+            loader.stop_loading()
+        self.assertEqual(num_open_fds(), initial_num_fds, 'Leaked notifier pipes')
+        loaders = [CountingLoader() for _ in range(20)]
+        del loaders
+        gc.collect()
+        self.assertEqual(num_open_fds(), initial_num_fds, 'Leaked unused notifier pipes')
@@ -0,0 +1,418 @@
+#!/usr/bin/env python2
+import unittest
+import os
+import shutil
+import tempfile
+import warnings
+
+import pickle
+
+import numpy as np
+import skimage
+import skimage.transform
+import PIL.Image
+import cv2
+
+from data import images, chunks
+
+def reference_downscale(image, downsampling):
+    rescaled = skimage.transform.downscale_local_mean(
+        skimage.img_as_float(image), (downsampling, downsampling) + (1,) * (image.ndim - 2))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return skimage.img_as_ubyte(rescaled)
+
+class TestDownscaleLocalMean(unittest.TestCase):
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+
+    def assert_matches_reference(self, image, downsampling):
+        downscaled = images.downscale_local_mean(image, downsampling)
+        reference = reference_downscale(image, downsampling)
+        self.assertEqual(downscaled.dtype, np.uint8, 'Incorrect downscaled dtype')
+        self.assertEqual(downscaled.shape, reference.shape, 'Incorrect downscaled shape')
+        self.assertLessEqual(
+            np.abs(downscaled.astype(int) - reference.astype(int)).max(), 1,
+            'Incorrect downscaled image')
+
+    def test_color(self):
+        image = self.random.randint(0, 256, (48, 64, 3)).astype(np.uint8)
+        for downsampling in [2, 4, 8, 16]:
+            self.assert_matches_reference(image, downsampling)
+
+    def test_grayscale(self):
+        image = self.random.randint(0, 256, (48, 64)).astype(np.uint8)
+        self.assert_matches_reference(image, 4)
+
+    def test_uneven(self):
+        image = self.random.randint(0, 256, (45, 61, 3)).astype(np.uint8)
+        for downsampling in [2, 3, 4]:
+            self.assert_matches_reference(image, downsampling)
+
+    def test_large_factor(self):
+        image = np.full((64, 96, 3), 255, dtype=np.uint8)
+        downscaled = images.downscale_local_mean(image, 32)
+        self.assertEqual(downscaled.shape, (2, 3, 3), 'Incorrect downscaled shape')
+        self.assertTrue(np.all(downscaled == 255), 'Incorrect downscaled sum overflow')
+
+class TestDecodeImage(unittest.TestCase):
+    def setUp(self):
+        (image_file, self.image_path) = tempfile.mkstemp(suffix='.jpg')
+        os.close(image_file)
+        image = np.zeros((96, 128, 3), dtype=np.uint8)
+        image[:, 64:] = 200
+        PIL.Image.fromarray(image).save(self.image_path, 'JPEG', quality=95)
+
+    def tearDown(self):
+        os.remove(self.image_path)
+
+    def test_decode(self):
+        (image, downsampling) = images.decode_image(self.image_path, 4)
+        self.assertEqual((image.shape, downsampling), ((24, 32, 3), 1),
+                         'Incorrect reduced-resolution decode')
+        (image, downsampling) = images.decode_image(self.image_path, 32)
+        self.assertEqual((image.shape, downsampling), ((12, 16, 3), 4),
+                         'Incorrect reduced-resolution decode')
+        (image, downsampling) = images.decode_image(self.image_path, 6)
+        self.assertEqual((image.shape, downsampling), ((48, 64, 3), 3),
+                         'Incorrect reduced-resolution decode')
+
+    def test_load_image(self):
+        for downsampling_mode in ['downscale_local_mean', 'decode']:
+            image = images.load_image(self.image_path, 4, downsampling_mode)
+            self.assertEqual(image.shape, (24, 32, 3), 'Incorrect downsampled shape')
+            self.assertLess(np.abs(image[:, :15].astype(int)).max(), 8,
+                            'Incorrect downsampled image')
+            self.assertLess(np.abs(image[:, 17:].astype(int) - 200).max(), 8,
+                            'Incorrect downsampled image')
+
+def write_stereo_images(parent_path, num_frames, shape=(20, 24, 3)):
+    random = np.random.RandomState(0)
+    file_paths = []
+    for i in range(num_frames):
+        frame_file_paths = tuple(os.path.join(parent_path, side + str(i) + '.png')
+                                 for side in ['left', 'right'])
+        for file_path in frame_file_paths:
+            PIL.Image.fromarray(random.randint(0, 256, shape).astype(np.uint8)).save(file_path)
+        file_paths.append(frame_file_paths)
+    return file_paths
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.parent_path = tempfile.mkdtemp()
+        self.file_paths = write_stereo_images(self.parent_path, 3)
+        self.cache_path = os.path.join(self.parent_path, 'cache')
+        self.cache = images.ImageCache(self.cache_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.parent_path)
+
+    def test_load_image(self):
+        file_path = self.file_paths[0][0]
+        for _ in range(2):
+            image = self.cache.load_image(file_path, 2)
+            self.assertTrue(np.array_equal(image, images.load_image(file_path, 2)),
+                            'Incorrect cached image')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1), 'Incorrect cache hits')
+        self.cache.load_image(file_path, 1)
+        self.assertEqual(self.cache.misses, 2, 'Incorrect cache key for downsampling')
+        cache = images.ImageCache(self.cache_path)
+        self.assertIsNotNone(cache.get(file_path, 2), 'Incorrect persistence')
+
+    def test_modified_file(self):
+        file_path = self.file_paths[0][0]
+        self.cache.load_image(file_path)
+        image = np.zeros((20, 24, 3), dtype=np.uint8)
+        PIL.Image.fromarray(image).save(file_path)
+        os.utime(file_path, (0, 0))
+        self.assertIsNone(self.cache.get(file_path), 'Incorrect cache key for modified file')
+        self.assertTrue(np.array_equal(self.cache.load_image(file_path), image),
+                        'Incorrect reloading of modified file')
+
+    def test_eviction(self):
+        entry_size = 20 * 24 * 3 + 128  # .npy header
+        for (i, (file_path, _)) in enumerate(self.file_paths):
+            self.cache.load_image(file_path)
+            os.utime(self.cache._entry_path(file_path, 1, 'downscale_local_mean'), (i, i))
+        self.cache.get(self.file_paths[0][0])  # makes it the most recently used
+        self.cache.max_bytes = 2 * entry_size
+        self.cache.load_image(self.file_paths[0][1])
+        self.assertEqual(len(os.listdir(self.cache_path)), 2, 'Incorrect eviction')
+        self.assertEqual(self.cache.evictions, 2, 'Incorrect eviction')
+        self.assertIsNotNone(self.cache.get(self.file_paths[0][0]), 'Incorrect eviction order')
+        self.assertIsNone(self.cache.get(self.file_paths[1][0]), 'Incorrect eviction order')
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.cache_path), [], 'Incorrect clearing')
+
+    def test_image_loader(self):
+        loader = images.PreloadingImageLoader(self.file_paths, downsampling=2,
+                                              image_cache=self.cache)
+        loader.load()
+        self.assertEqual(self.cache.misses, 6, 'Incorrect caching of loaded images')
+        loader = images.ParallelImageLoader(self.file_paths, downsampling=2, num_processes=1,
+                                            image_cache=self.cache)
+        loader.load()
+        try:
+            for frame_file_paths in self.file_paths:
+                for (image, file_path) in zip(next(loader), frame_file_paths):
+                    self.assertTrue(np.array_equal(image, images.load_image(file_path, 2)),
+                                    'Incorrect image')
+        finally:
+            loader.stop_loading()
+        self.assertEqual(len(os.listdir(self.cache_path)), 6, 'Incorrect cache entries')
+
+class TestPreloadingImageLoader(unittest.TestCase):
+    def setUp(self):
+        self.parent_path = tempfile.mkdtemp()
+        self.file_paths = write_stereo_images(self.parent_path, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.parent_path)
+
+    def assert_frames(self, loader):
+        for frame_file_paths in self.file_paths:
+            frame = next(loader)
+            self.assertEqual(len(frame), 2, 'Incorrect number of stereo images')
+            for (image, file_path) in zip(frame, frame_file_paths):
+                self.assertTrue(np.array_equal(image, images.load_image(file_path, 2)),
+                                'Incorrect image')
+        with self.assertRaises(StopIteration):
+            next(loader)
+
+    def test_frames(self):
+        loader = images.PreloadingImageLoader(self.file_paths, downsampling=2)
+        with self.assertRaises(RuntimeError):
+            next(loader)
+        loader.load()
+        self.assertEqual(loader.frames.shape, (4, 2, 10, 12, 3), 'Incorrect frames shape')
+        self.assertTrue(loader.frames.flags.c_contiguous, 'Incorrect frames layout')
+        self.assert_frames(loader)
+        loader.reset()
+        self.assertTrue(np.may_share_memory(next(loader)[1], loader.frames),
+                        'Incorrect copying of frames')
+
+    def test_parallel(self):
+        loader = images.PreloadingImageLoader(self.file_paths, downsampling=2,
+                                              num_processes=2)
+        loader.load()
+        self.assert_frames(loader)
+
+    def test_memmap(self):
+        memmap_path = os.path.join(self.parent_path, 'frames.bin')
+        loader = images.PreloadingImageLoader(self.file_paths, downsampling=2,
+                                              num_processes=2, memmap_path=memmap_path)
+        loader.load()
+        self.assert_frames(loader)
+        self.assertEqual(os.path.getsize(memmap_path), loader.frames.nbytes,
+                         'Incorrect memory-mapped frames')
+
+    def test_budget(self):
+        loader = images.PreloadingImageLoader(self.file_paths, downsampling=2,
+                                              max_bytes=3 * 2 * 10 * 12 * 3)
+        loader.load()
+        self.assertTrue(loader.streaming, 'Incorrect budget enforcement')
+        self.assertIsNone(loader.frames, 'Incorrect budget enforcement')
+        self.assert_frames(loader)
+        loader.reset()
+        self.assert_frames(loader)
+
+class AllocatingImageRotation(images.ImageRotation):
+    """Counts the rotated images which weren't written into an output buffer."""
+    def __init__(self, angle):
+        super(AllocatingImageRotation, self).__init__(angle)
+        self.num_allocations = 0
+
+    def __call__(self, image, out=None):
+        if out is None:
+            self.num_allocations += 1
+        return super(AllocatingImageRotation, self).__call__(image, out)
+
+class LoggingImageRotation(images.ImageRotation):
+    """Appends the id of the process to a log file whenever it computes maps."""
+    def __init__(self, angle, log_path):
+        super(LoggingImageRotation, self).__init__(angle)
+        self.log_path = log_path
+
+    def maps(self, shape):
+        if shape[:2] not in self._maps:
+            with open(self.log_path, 'a') as f:
+                f.write(str(os.getpid()) + '\n')
+        return super(LoggingImageRotation, self).maps(shape)
+
+    def __getstate__(self):
+        return (self.angle, self.log_path)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+class TestImageRotation(unittest.TestCase):
+    def setUp(self):
+        self.image = np.random.RandomState(0).randint(0, 256, (20, 24, 3)).astype(np.uint8)
+
+    def test_rotation(self):
+        rotation = images.ImageRotation(30)
+        matrix = cv2.getRotationMatrix2D((11.5, 9.5), 30, 1)
+        reference = cv2.warpAffine(self.image, matrix, (24, 20))
+        rotated = rotation(self.image)
+        self.assertEqual(rotated.shape, self.image.shape, 'Incorrect rotated shape')
+        self.assertLessEqual(np.abs(rotated.astype(int) - reference.astype(int)).max(), 1,
+                             'Incorrect rotated image')
+
+    def test_reuse(self):
+        rotation = images.ImageRotation(90)
+        self.assertIs(rotation.maps(self.image.shape), rotation.maps(self.image.shape),
+                      'Incorrect reuse of maps')
+        out = np.empty_like(self.image)
+        self.assertIs(rotation(self.image, out), out, 'Incorrect output buffer')
+        self.assertTrue(np.array_equal(out, rotation(self.image)),
+                        'Incorrect rotated image')
+        unpickled = pickle.loads(pickle.dumps(rotation))
+        self.assertEqual((unpickled.angle, unpickled._maps), (90, {}), 'Incorrect pickling')
+
+    def test_loaders(self):
+        parent_path = tempfile.mkdtemp()
+        try:
+            file_paths = write_stereo_images(parent_path, 3)
+            rotation = images.ImageRotation(45)
+            expected = [[rotation(images.load_image(file_path, 2)) for file_path in frame]
+                        for frame in file_paths]
+            loaders = [
+                images.PreloadingImageLoader(file_paths, 2, image_transform=rotation),
+                images.PreloadingImageLoader(file_paths, 2, num_processes=2,
+                                             image_transform=rotation),
+                images.ParallelImageLoader(file_paths, 2, num_processes=2,
+                                           image_transform=rotation)
+            ]
+            for loader in loaders:
+                loader.load()
+                try:
+                    for expected_frame in expected:
+                        for (image, expected_image) in zip(next(loader), expected_frame):
+                            self.assertTrue(np.array_equal(image, expected_image),
+                                            'Incorrect rotated image')
+                finally:
+                    loader.stop_loading()
+        finally:
+            shutil.rmtree(parent_path)
+
+    def test_output_reuse(self):
+        parent_path = tempfile.mkdtemp()
+        try:
+            file_paths = write_stereo_images(parent_path, 6)
+            rotation = images.ImageRotation(45)
+            expected = [[rotation(images.load_image(file_path, 2)) for file_path in frame]
+                        for frame in file_paths]
+            loaders = [
+                (images.PreloadingImageLoader(file_paths, 2,
+                                              image_transform=AllocatingImageRotation(45)), 2),
+                (images.ConcurrentImageLoader(file_paths, 2, max_size=1,
+                                              image_transform=AllocatingImageRotation(45)),
+                 (1 + 2) * 2)
+            ]
+            for (loader, num_allocations) in loaders:
+                loader.load()
+                try:
+                    for expected_frame in expected:
+                        for (image, expected_image) in zip(next(loader), expected_frame):
+                            self.assertTrue(np.array_equal(image, expected_image),
+                                            'Incorrect rotated image')
+                    with self.assertRaises(StopIteration):
+                        next(loader)
+                finally:
+                    loader.stop_loading()
+                self.assertEqual(loader.image_transform.num_allocations, num_allocations,
+                                 'Incorrect reuse of output buffers')
+        finally:
+            shutil.rmtree(parent_path)
+
+    def test_worker_maps(self):
+        parent_path = tempfile.mkdtemp()
+        try:
+            file_paths = write_stereo_images(parent_path, 6)
+            for (i, Loader) in enumerate([images.PreloadingImageLoader,
+                                          images.ParallelImageLoader]):
+                log_path = os.path.join(parent_path, str(i) + '.log')
+                loader = Loader(file_paths, 2, num_processes=2,
+                                image_transform=LoggingImageRotation(45, log_path))
+                loader.load()
+                try:
+                    for _ in file_paths:
+                        next(loader)
+                finally:
+                    loader.stop_loading()
+                with open(log_path) as f:
+                    process_ids = f.read().split()
+                self.assertEqual(len(process_ids), len(set(process_ids)),
+                                 'Incorrect reuse of maps in a worker process')
+                self.assertLessEqual(len(process_ids), 2 + 1,
+                                     'Incorrect number of worker maps')
+        finally:
+            shutil.rmtree(parent_path)
+
+    def test_chunked_image_loader(self):
+        parent_path = tempfile.mkdtemp()
+        archive_path = os.path.join(parent_path, 'images.hdf5')
+        try:
+            with chunks.ChunkWriter(archive_path) as writer:
+                writer.write(0, np.stack([self.image, self.image[::-1]]), {'downsampling': 1})
+            rotation = images.ImageRotation(45)
+            loader = images.ChunkedImageLoader([archive_path], [0, 1],
+                                               image_transform=rotation)
+            loader.load()
+            try:
+                first_image = next(loader)[0]
+                self.assertTrue(np.array_equal(first_image, rotation(self.image)),
+                                'Incorrect rotated image')
+                second_image = next(loader)[0]
+                self.assertTrue(np.array_equal(second_image, rotation(self.image[::-1])),
+                                'Incorrect rotated image')
+                self.assertIs(first_image, second_image, 'Incorrect output buffer reuse')
+            finally:
+                loader.stop_loading()
+        finally:
+            shutil.rmtree(parent_path)
+
+class TestParallelImageLoader(unittest.TestCase):
+    def setUp(self):
+        self.parent_path = tempfile.mkdtemp()
+        self.file_paths = write_stereo_images(self.parent_path, 5)
+        self.loader = images.ParallelImageLoader(self.file_paths, downsampling=2,
+                                                 num_processes=2, num_slots=3)
+
+    def tearDown(self):
+        self.loader.stop_loading()
+        shutil.rmtree(self.parent_path)
+
+    def assert_frames(self, frame_ids):
+        for frame_id in frame_ids:
+            frame = next(self.loader)
+            self.assertEqual(len(frame), 2, 'Incorrect number of stereo images')
+            for (image, file_path) in zip(frame, self.file_paths[frame_id]):
+                self.assertTrue(np.array_equal(image, images.load_image(file_path, 2)),
+                                'Incorrect image')
+        with self.assertRaises(StopIteration):
+            next(self.loader)
+
+    def test_next(self):
+        with self.assertRaises(RuntimeError):
+            next(self.loader)
+        self.loader.load()
+        self.assert_frames(range(5))
+        self.loader.reset()
+        self.assert_frames(range(5))
+
+    def test_single_images(self):
+        self.loader = images.ParallelImageLoader(
+            [left_path for (left_path, _) in self.file_paths], downsampling=1,
+            num_processes=2)
+        self.loader.load()
+        frame = next(self.loader)
+        self.assertEqual(len(frame), 1, 'Incorrect number of images')
+        self.assertEqual(frame[0].shape, (20, 24, 3), 'Incorrect image shape')
+
+    def test_inconsistent_shape(self):
+        PIL.Image.fromarray(np.zeros((10, 10, 3), dtype=np.uint8)).save(self.file_paths[1][1])
+        self.loader.load()
+        next(self.loader)
+        with self.assertRaises(ValueError):
+            next(self.loader)
@@ -4,6 +4,7 @@ import sys
 import time
 import ctypes
 import os
+import pickle
 
 import numpy as np
 
@@ -39,6 +40,21 @@ def make_point_cloud(num_points, i):
                   for n in range(num_points)]).astype(float)
     ]
 
+class TestPointCloudSynchronizedBuffer(unittest.TestCase):
+    def test_pickle(self):
+        buffer = point_clouds.SynchronizedBuffer()
+        buffer.initialize((ctypes.c_int, ctypes.c_double), ((4, 3), (4, 2)))
+        unpickled = pickle.loads(pickle.dumps(buffer))
+        unpickled.num_points.value = 3
+        for (dest, source) in zip(unpickled.point_properties, make_point_cloud(4, 1)):
+            np.copyto(dest, source)
+        self.assertEqual(buffer.num_points.value, 3,
+                         'Incorrect sharing of unpickled buffer')
+        for (array, reference_array) in zip(buffer.point_properties,
+                                            make_point_cloud(4, 1)):
+            self.assertEqual(array.tolist(), reference_array.tolist(),
+                             'Incorrect sharing of unpickled buffer')
+
 class PointCloudDoubleBufferClient(parallelism.DoubleBufferedProcess):
     def __init__(self, *args, **kwargs):
         super(PointCloudDoubleBufferClient, self).__init__(
@@ -99,17 +115,11 @@ class TestPointCloudDoubleBuffer(unittest.TestCase):
         read_result = self.round_trip('read')
         self.assertEqual(read_result['num_points'], num_points,
                          'Read/write inconsistency')
+        num_valid_points = min(num_points, buffer_size)
         properties = make_point_cloud(num_points, i)
-        if num_points > buffer_size:
-            properties = (array[:buffer_size] for array in properties)
-        elif num_points < buffer_size:
-            padding_height = buffer_size - num_points
-            properties = [np.concatenate([array, np.zeros((padding_height,
-                                                           array.shape[1])).astype(int)],
-                                         axis=0)
-                          for array in properties]
         for (reference_array, child_array) in zip(properties, read_result['properties']):
-            self.assertEqual(child_array.tolist(), reference_array.tolist(),
+            self.assertEqual(child_array[:num_valid_points].tolist(),
+                             reference_array[:num_valid_points].tolist(),
                              'Point properties inconsistency')
 
     def test_child_writes(self):
@@ -187,8 +197,7 @@ class TestPointCloudParallelLoader(unittest.TestCase):
     def setUp(self):
         self.loader = None
 
-    def test_generation(self):
-        self.loader = point_clouds.ParallelLoader(lambda: PointCloudLoader(10, 5))
+    def assert_generation(self):
         for _ in range(5):
             self.loader.load()
             for num_points in range(int(0.25 * 10), 10):
@@ -211,7 +220,108 @@ class TestPointCloudParallelLoader(unittest.TestCase):
             self.loader.stop_loading()
             self.loader.reset()
 
+    def test_generation(self):
+        self.loader = point_clouds.ParallelLoader(lambda: PointCloudLoader(10, 5))
+        self.assert_generation()
+
+    def test_multiple_buffered_generation(self):
+        self.loader = point_clouds.ParallelLoader(lambda: PointCloudLoader(10, 5), num_slots=4)
+        self.assert_generation()
+
     def tearDown(self):
         if self.loader is not None:
             self.loader.stop_loading()
 
+
+class StridedPointCloudLoader(data.DataLoader, data.DataGenerator, arrays.ArraysSource):
+    def __init__(self, length, num_points, offset=0, stride=1):
+        self.length = length
+        self.num_points = num_points
+        self.offset = offset
+        self.stride = stride
+        self.i = offset
+
+    # From DataGenerator
+
+    def next(self):
+        if self.i >= self.length:
+            raise StopIteration
+        time.sleep(0.01)
+        properties = make_point_cloud(self.num_points, self.i)
+        self.i += self.stride
+        point_cloud = point_clouds.PointCloud()
+        (point_cloud.points, point_cloud.colors) = properties
+        return point_cloud
+
+    def reset(self):
+        self.i = self.offset
+
+    @property
+    def time_range(self):
+        times = list(self.get_times())
+        return (times[0], times[-1])
+
+    def get_times(self):
+        return iter([0.5 * i for i in range(self.offset, self.length, self.stride)])
+
+    # From ArraysSource
+
+    @property
+    def array_ctypes(self):
+        return (ctypes.c_int, ctypes.c_double)
+
+    @property
+    def array_shapes(self):
+        return ((self.num_points, 3), (self.num_points, 2))
+
+class TestPointCloudPooledParallelLoader(unittest.TestCase):
+    def setUp(self):
+        self.loader = None
+
+    def assert_generation(self, length):
+        for _ in range(3):
+            self.loader.load()
+            for i in range(length):
+                properties = make_point_cloud(4, i)
+                result = next(self.loader)
+                self.assertEqual(result.points.tolist(), properties[0].tolist(),
+                                 'Incorrect point generation order')
+                self.assertEqual(result.colors.tolist(), properties[1].tolist(),
+                                 'Incorrect color generation order')
+            for _ in range(2):
+                try:
+                    next(self.loader)
+                    self.assertFalse(True, 'Incorrect stopping behavior')
+                except StopIteration:
+                    pass
+            self.loader.stop_loading()
+            self.loader.reset()
+
+    def test_single_worker(self):
+        self.loader = point_clouds.PooledParallelLoader(
+            lambda **kwargs: StridedPointCloudLoader(10, 4, **kwargs), num_workers=1)
+        self.assert_generation(10)
+
+    def test_generation(self):
+        self.loader = point_clouds.PooledParallelLoader(
+            lambda **kwargs: StridedPointCloudLoader(10, 4, **kwargs), num_workers=3)
+        self.assertEqual(self.loader.num_workers, 3, 'Incorrect number of workers')
+        self.assert_generation(10)
+
+    def test_multiple_buffered_generation(self):
+        self.loader = point_clouds.PooledParallelLoader(
+            lambda **kwargs: StridedPointCloudLoader(11, 4, **kwargs),
+            num_workers=4, num_slots=3)
+        self.assert_generation(11)
+
+    def test_times(self):
+        self.loader = point_clouds.PooledParallelLoader(
+            lambda **kwargs: StridedPointCloudLoader(11, 4, **kwargs), num_workers=3)
+        self.assertEqual(list(self.loader.get_times()), [0.5 * i for i in range(11)],
+                         'Incorrect times')
+        self.assertEqual(self.loader.time_range, (0, 5),
+                         'Incorrect time range')
+
+    def tearDown(self):
+        if self.loader is not None:
+            self.loader.stop_loading()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 import unittest
 import os
+import time
 
 from datasets import sequences
 
@@ -92,6 +93,26 @@ class TestFileSequenceLoader(unittest.TestCase):
         self.loader.reset()
         self.test_next()
 
+class TestStridedFileSequenceLoader(unittest.TestCase):
+    def setUp(self):
+        self.sequence = TextFileSequence(SEQUENCE_PARENT_PATH, suffix='.txt')
+
+    def test_stride(self):
+        loader = sequences.FileSequenceLoader(self.sequence, stride=2)
+        self.assertEqual(list(iter(loader.load_next, None)), ['foo', 'foobar'],
+                         'Incorrect strided loading')
+        loader.reset()
+        self.assertEqual(list(iter(loader.load_next, None)), ['foo', 'foobar'],
+                         'Incorrect strided loading')
+
+    def test_offset(self):
+        loader = sequences.FileSequenceLoader(self.sequence, offset=1, stride=2)
+        self.assertEqual(list(iter(loader.load_next, None)), ['bar'],
+                         'Incorrect offset loading')
+        loader = sequences.FileSequenceLoader(self.sequence, offset=1)
+        self.assertEqual(list(iter(loader.load_next, None)), ['bar', 'foobar'],
+                         'Incorrect offset loading')
+
 class TestFileSequenceConcurrentLoader(unittest.TestCase):
     def setUp(self):
         self.sequence = TextFileSequence(SEQUENCE_PARENT_PATH, suffix='.txt')
@@ -132,6 +153,14 @@ class TestFileSequenceConcurrentLoader(unittest.TestCase):
         self.loader.load()
         self.test_next()
 
+    def test_stop_loading_latency(self):
+        self.loader = sequences.FileSequenceConcurrentLoader(self.sequence, 1)
+        self.loader.load()
+        time.sleep(0.1)  # Let the loading thread block on the full queue
+        start_time = time.time()
+        self.loader.stop_loading()
+        self.assertLess(time.time() - start_time, 0.05, 'Stopping was too slow')
+
     def tearDown(self):
         self.loader.stop_loading()
 
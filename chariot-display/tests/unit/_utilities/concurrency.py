@@ -1,7 +1,12 @@
 #!/usr/bin/env python2
 import unittest
 import sys
+import os
 import time
+import gc
+import signal
+import threading
+import multiprocessing
 
 from utilities import concurrency
 
@@ -121,3 +126,98 @@ class TestThreading(unittest.TestCase):
         self.thread.terminate()
         self.assert_thread_state()
 
+
+    def test_early_terminate(self):
+        for _ in range(20):
+            self.thread = TightThread()
+            self.thread.run_concurrent()
+            self.thread.terminate()
+            self.assertIsNone(self.thread._thread,
+                              'Incorrect thread state')
+        print()
+
+def notify_later(notifier, delay):
+    time.sleep(delay)
+    notifier.notify()
+
+class TestNotifier(unittest.TestCase):
+    def setUp(self):
+        self.notifier = concurrency.Notifier()
+
+    def test_notify(self):
+        self.assertFalse(self.notifier.is_set(), 'Incorrect initial state')
+        self.notifier.notify()
+        self.assertTrue(self.notifier.is_set(), 'Incorrect notification')
+        self.assertTrue(self.notifier.wait(0), 'Incorrect notification')
+        self.notifier.notify()
+        self.assertTrue(self.notifier.is_set(), 'Incorrect repeated notification')
+        self.notifier.clear()
+        self.assertFalse(self.notifier.is_set(), 'Incorrect clearing')
+
+    def test_timeout(self):
+        start_time = time.time()
+        self.assertFalse(self.notifier.wait(0.1), 'Incorrect timeout')
+        self.assertGreaterEqual(time.time() - start_time, 0.09, 'Timeout was too short')
+
+    def test_many_notifications(self):
+        for _ in range(100000):
+            self.notifier.notify()
+        self.assertTrue(self.notifier.wait(0), 'Incorrect notification')
+        self.notifier.clear()
+        self.assertFalse(self.notifier.is_set(), 'Incorrect clearing')
+
+    def assert_prompt_wakeup(self, notify_delay=0.2):
+        start_time = time.time()
+        self.assertTrue(self.notifier.wait(5), 'Missing notification')
+        self.assertLess(time.time() - start_time, notify_delay + 0.05,
+                        'Notification wakeup was too slow')
+
+    def test_thread_wakeup(self):
+        thread = threading.Thread(target=notify_later, args=(self.notifier, 0.2))
+        thread.start()
+        self.assert_prompt_wakeup()
+        thread.join()
+
+    def test_process_wakeup(self):
+        process = multiprocessing.Process(target=notify_later, args=(self.notifier, 0.2))
+        process.start()
+        self.assert_prompt_wakeup()
+        process.join()
+
+    def test_interrupt(self):
+        timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGINT))
+        timer.start()
+        start_time = time.time()
+        try:
+            self.notifier.wait()
+            self.assertFalse(True, 'Uncaught interrupt')
+        except KeyboardInterrupt:
+            pass
+        self.assertLess(time.time() - start_time, 0.25, 'Interrupt was too slow')
+        timer.join()
+
+    def test_reopen(self):
+        self.notifier.notify()
+        self.notifier.close()
+        self.assertTrue(self.notifier.closed, 'Incorrect closing')
+        self.notifier.notify()
+        self.notifier.clear()
+        self.notifier.close()
+        self.notifier.open()
+        self.assertFalse(self.notifier.is_set(), 'Incorrect reopening')
+        self.notifier.notify()
+        self.assertTrue(self.notifier.is_set(), 'Incorrect reopening')
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Needs /proc/self/fd')
+    def test_garbage_collection(self):
+        initial_num_fds = len(os.listdir('/proc/self/fd'))
+        notifiers = [concurrency.Notifier() for _ in range(20)]
+        self.assertEqual(len(os.listdir('/proc/self/fd')), initial_num_fds + 40,
+                         'Incorrect notifier pipes')
+        del notifiers
+        gc.collect()
+        self.assertEqual(len(os.listdir('/proc/self/fd')), initial_num_fds,
+                         'Leaked notifier pipes')
+
+    def tearDown(self):
+        self.notifier.close()
@@ -3,6 +3,9 @@ import unittest
 import time
 import random
 import sys
+import os
+import subprocess
+import pickle
 import ctypes
 import multiprocessing
 from multiprocessing import Value
@@ -14,6 +17,75 @@ except ImportError:
 from data import data
 from utilities import parallelism
 
+class SquaresWorkset(parallelism.Workset):
+    max_attempts = 2
+
+    def __init__(self, num_work_units):
+        self.num_work_units = num_work_units
+        self.attempted_work_ids = set()
+        self.progress = []
+
+    def work(self, work_id):
+        if work_id == 3:
+            raise ValueError('Permanent failure')
+        elif work_id == 5 and work_id not in self.attempted_work_ids:
+            self.attempted_work_ids.add(work_id)
+            raise ValueError('Transient failure')
+        return (work_id ** 2, os.getpid())
+
+    def work_ids(self):
+        return range(self.num_work_units)
+
+    def handle_progress(self, num_finished, num_work_units, elapsed_time):
+        self.progress.append((num_finished, num_work_units))
+
+class FailingProgressWorkset(SquaresWorkset):
+    def handle_progress(self, num_finished, num_work_units, elapsed_time):
+        raise RuntimeError('Progress failure')
+
+class TestWorkset(unittest.TestCase):
+    def setUp(self):
+        self.workset = SquaresWorkset(20)
+
+    def assert_results(self, results):
+        self.assertEqual(sorted(results.keys()), [i for i in range(20) if i != 3],
+                         'Incorrect work results')
+        for (work_id, (square, _)) in results.items():
+            self.assertEqual(square, work_id ** 2, 'Incorrect work results')
+        self.assertEqual(self.workset.failed_work_ids, [3], 'Incorrect failed work units')
+        self.assertEqual(self.workset.progress[-1], (20, 20), 'Incorrect progress')
+
+    def test_sequential(self):
+        self.assert_results(self.workset.execute_sequential())
+
+    def test_parallel(self):
+        self.assert_results(self.workset.execute_parallel(2))
+
+    def test_persistent_pool(self):
+        with parallelism.WorkerPool(2) as pool:
+            self.assert_results(self.workset.execute_parallel(pool=pool, chunksize=4))
+            first_pids = set(pid for (_, pid) in self.workset.execute_parallel(
+                pool=pool, progress_interval=None).values())
+            second_pids = set(pid for (_, pid) in self.workset.execute_parallel(
+                pool=pool, progress_interval=None).values())
+        self.assertLessEqual(len(first_pids | second_pids), 2, 'Pool was not reused')
+        self.assertFalse(pool.running, 'Pool was not closed')
+
+    def test_persistent_pool_exception(self):
+        with parallelism.WorkerPool(2) as pool:
+            with self.assertRaises(RuntimeError):
+                FailingProgressWorkset(20).execute_parallel(pool=pool)
+            self.assertTrue(pool.running, 'Caller pool was terminated')
+            self.assert_results(self.workset.execute_parallel(pool=pool))
+
+    def test_stream(self):
+        with parallelism.WorkerPool(2) as pool:
+            results = self.workset.execute_stream(pool, chunksize=3, ordered=True,
+                                                  progress_interval=None)
+            self.assertEqual([work_id for (work_id, _) in results],
+                             [i for i in range(20) if i != 3], 'Incorrect result order')
+        self.assertEqual(self.workset.progress, [], 'Incorrect disabled progress')
+
 class TestPollingQueue(unittest.TestCase):
     def setUp(self):
         self.queue = multiprocessing.Queue(1)
@@ -81,6 +153,17 @@ class TestExceptionListener(unittest.TestCase):
         self.assertIsNotNone(self.listener._thread)
         self.listener.terminate()
         self.assertIsNone(self.listener._thread)
+        self.assertTrue(self.listener._stop_notifier.closed, 'Leaked notifier pipe')
+        self.listener.run_concurrent()
+        self.assertFalse(self.listener._stop_notifier.closed, 'Incorrect reopening')
+
+    def test_terminate_latency(self):
+        for _ in range(10):
+            self.listener.run_concurrent()
+            time.sleep(0.01)
+            start_time = time.time()
+            self.listener.terminate()
+            self.assertLess(time.time() - start_time, 0.02, 'Termination was too slow')
 
     def test_raise(self):
         try:
@@ -319,6 +402,49 @@ class TestProcess(unittest.TestCase):
         if self.hanging_process.process_running:
             self.hanging_process.terminate(force_terminate=True)
 
+_PACKAGE_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(parallelism.__file__)))
+
+class TestSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.shared_memory = parallelism.SharedMemory(64)
+        self.array = self.shared_memory.as_array(ctypes.c_int, (4, 2))
+
+    def test_attach(self):
+        attached = parallelism.SharedMemory(name=self.shared_memory.name)
+        self.assertEqual(attached.size, 64, 'Incorrect attachment')
+        attached.as_array(ctypes.c_int, (4, 2))[:] = 1
+        attached.as_value(ctypes.c_int, 32).value = 2
+        self.assertEqual(self.array.tolist(), [[1, 1], [1, 1], [1, 1], [1, 1]],
+                         'Incorrect attachment')
+        self.assertEqual(self.shared_memory.as_value(ctypes.c_int, 32).value, 2,
+                         'Incorrect attachment')
+
+    def test_pickle(self):
+        unpickled = pickle.loads(pickle.dumps(self.shared_memory))
+        self.assertEqual(unpickled.name, self.shared_memory.name, 'Incorrect pickling')
+        unpickled.as_array(ctypes.c_int, (4, 2))[2, 1] = 3
+        self.assertEqual(self.array[2, 1], 3, 'Incorrect pickling')
+        del unpickled  # attached copies don't own the segment
+        parallelism.SharedMemory(name=self.shared_memory.name)
+
+    def test_unforked_process(self):
+        subprocess.check_call([
+            sys.executable, '-c',
+            'import sys, ctypes, pickle; from utilities import parallelism; '
+            'pickle.loads(sys.argv[1]).as_array(ctypes.c_int, (4, 2))[:] = 4',
+            pickle.dumps(self.shared_memory)
+        ], cwd=_PACKAGE_ROOT_PATH)
+        self.assertEqual(self.array.tolist(), [[4, 4], [4, 4], [4, 4], [4, 4]],
+                         'Incorrect sharing with unforked process')
+
+    def test_unlink(self):
+        name = self.shared_memory.name
+        del self.shared_memory
+        with self.assertRaises(OSError):
+            parallelism.SharedMemory(name=name)
+        self.assertEqual(self.array.tolist(), [[0, 0], [0, 0], [0, 0], [0, 0]],
+                         'Incorrect unlinking')
+
 class ValueDoubleBuffer(parallelism.DoubleBuffer):
     def __init__(self):
         super(ValueDoubleBuffer, self).__init__()
@@ -662,6 +788,172 @@ class TestDoubleBufferedProcess(unittest.TestCase):
         if self.process.process_running:
             self.process.terminate()
 
+class ValueMultipleBuffer(parallelism.MultipleBuffer):
+    def __init__(self, num_slots=4):
+        super(ValueMultipleBuffer, self).__init__(num_slots)
+        self._values = [Value(ctypes.c_int) for _ in range(num_slots)]
+        for value in self._values:
+            value.value = 0
+
+    def get_buffer(self, buffer_id):
+        return self._values[buffer_id]
+
+class TestMultipleBuffer(unittest.TestCase):
+    def setUp(self):
+        self.multiple_buffer = ValueMultipleBuffer(4)
+
+    def test_init(self):
+        self.assertEqual(self.multiple_buffer.read_id, 0,
+                         'Incorrect initialization')
+        self.assertEqual(self.multiple_buffer.write_id, 1,
+                         'Incorrect initialization')
+        self.assertEqual(self.multiple_buffer.next_read_id, 1,
+                         'Incorrect initialization')
+
+    def test_too_few_slots(self):
+        with self.assertRaises(ValueError):
+            ValueMultipleBuffer(1)
+
+    def test_fifo_order(self):
+        for i in range(3):
+            self.multiple_buffer.write_buffer.value = i
+            self.multiple_buffer.advance_write()
+        for i in range(3):
+            self.multiple_buffer.advance_read()
+            self.assertEqual(self.multiple_buffer.read_buffer.value, i,
+                             'Incorrect multiple buffer order')
+
+    def test_wraparound(self):
+        for i in range(10):
+            self.multiple_buffer.write_buffer.value = i
+            self.multiple_buffer.advance_write()
+            self.multiple_buffer.advance_read()
+            self.assertEqual(self.multiple_buffer.read_buffer.value, i,
+                             'Incorrect multiple buffer wraparound')
+        self.assertEqual(self.multiple_buffer.read_id, 10 % 4,
+                         'Incorrect multiple buffer wraparound')
+
+    def test_reset(self):
+        self.multiple_buffer.advance_write()
+        self.multiple_buffer.advance_read()
+        self.multiple_buffer.write_readable.set()
+        self.multiple_buffer.reset()
+        self.assertEqual(self.multiple_buffer.read_id, 0, 'Incorrect reset')
+        self.assertEqual(self.multiple_buffer.write_id, 1, 'Incorrect reset')
+        self.assertFalse(self.multiple_buffer.write_readable.is_set(), 'Incorrect reset')
+
+    def test_handoff(self):
+        for i in range(3):
+            self.assertTrue(self.multiple_buffer.writable, 'Incorrect handoff')
+            self.multiple_buffer.write_buffer.value = i
+            self.multiple_buffer.publish_write()
+        self.assertFalse(self.multiple_buffer.writable, 'Incorrect handoff')
+        for i in range(3):
+            self.assertTrue(self.multiple_buffer.unread, 'Incorrect handoff')
+            self.multiple_buffer.consume_read()
+            self.assertEqual(self.multiple_buffer.read_buffer.value, i,
+                             'Incorrect handoff')
+            self.assertTrue(self.multiple_buffer.writable, 'Incorrect handoff')
+        self.assertFalse(self.multiple_buffer.unread, 'Incorrect handoff')
+        self.assertFalse(self.multiple_buffer.ended, 'Incorrect handoff')
+        self.multiple_buffer.publish_end()
+        self.assertTrue(self.multiple_buffer.ended, 'Incorrect handoff')
+        self.multiple_buffer.reset()
+        self.assertFalse(self.multiple_buffer.ended, 'Incorrect reset')
+        self.assertEqual(self.multiple_buffer.num_written, 0, 'Incorrect reset')
+
+    def test_handoff_wakeup(self):
+        start_time = time.time()
+        self.multiple_buffer.wait_unread(1)
+        self.assertGreater(time.time() - start_time, 0.9, 'Incorrect unread wait')
+        self.multiple_buffer.publish_write()
+        start_time = time.time()
+        self.multiple_buffer.wait_unread(1)
+        self.assertLess(time.time() - start_time, 0.1, 'Incorrect unread wakeup')
+        self.multiple_buffer.publish_write()
+        self.multiple_buffer.publish_write()
+        process = multiprocessing.Process(target=self.multiple_buffer.consume_read)
+        process.start()
+        start_time = time.time()
+        self.multiple_buffer.wait_writable(1)
+        self.assertLess(time.time() - start_time, 0.5, 'Incorrect writable wakeup')
+        self.assertTrue(self.multiple_buffer.writable, 'Incorrect writable wakeup')
+        process.join()
+
+class ValueMultipleBufferedProcess(parallelism.MultipleBufferedProcess):
+    def __init__(self, *args, **kwargs):
+        super(ValueMultipleBufferedProcess, self).__init__(ValueMultipleBuffer, 4, 4)
+
+    # From MultipleBufferedProcess
+
+    def on_write_to_buffer(self, data, write_buffer):
+        write_buffer.value = data
+
+    # From Process
+
+    def on_run_start(self):
+        self.send_output('started')
+
+    def execute(self, next_input):
+        if next_input[0] == 'double':
+            self.write_to_buffer(next_input[1] * 2)
+            self.send_output('double')
+        elif next_input[0] == 'delayed_double':
+            time.sleep(0.5)
+            self.write_to_buffer(next_input[1] * 2)
+
+    def on_run_parent_start(self):
+        parallelism.acquire_lock_poll(self.multiple_buffer.read_lock, block=True, timeout=1)
+
+class TestMultipleBufferedProcess(unittest.TestCase):
+    def parallelsafe_setUp(self):
+        self.process = ValueMultipleBufferedProcess()
+        self.process.run_parallel()
+        self.assertEqual(self.process.receive_output(), 'started',
+                         'Incorrect initialization')
+
+    def round_trip(self, *input_args):
+        self.process.send_input(input_args)
+        return self.process.receive_output()
+
+    def test_write_ahead(self):
+        self.parallelsafe_setUp()
+        for i in range(3):
+            self.assertEqual(self.round_trip('double', i), 'double', 'Incorrect synchronization')
+        for i in range(3):
+            self.process.swap_buffers()
+            self.assertEqual(self.process.read_buffer.value, 2 * i, 'Incorrect write-ahead')
+
+    def test_interleaved(self):
+        self.parallelsafe_setUp()
+        for i in range(3):
+            self.round_trip('double', i)
+        for i in range(3, 20):
+            self.process.swap_buffers()
+            self.assertEqual(self.process.read_buffer.value, 2 * (i - 3), 'Incorrect order')
+            self.round_trip('double', i)
+
+    def test_delayed_double(self):
+        self.parallelsafe_setUp()
+        self.process.send_input(('delayed_double', 8))
+        self.process.swap_buffers()
+        self.assertEqual(self.process.read_buffer.value, 16, 'Incorrect synchronization')
+
+    def test_restart(self):
+        self.parallelsafe_setUp()
+        self.process.terminate()
+        self.assertTrue(self.process.multiple_buffer._written_notifier.closed,
+                        'Leaked notifier pipes')
+        self.process.multiple_buffer.reset()
+        self.parallelsafe_setUp()
+        self.round_trip('double', 5)
+        self.process.swap_buffers()
+        self.assertEqual(self.process.read_buffer.value, 10, 'Incorrect restart')
+
+    def tearDown(self):
+        if self.process.process_running:
+            self.process.terminate()
+
 class ValueLoader(data.DataLoader, data.DataGenerator):
     def __init__(self, length, random_floor=0,
                  loader_initialization_delay=0, generation_delay=0):
@@ -703,10 +995,22 @@ class ValueLoaderGeneratorProcess(parallelism.LoaderGeneratorProcess):
 
     # From LoaderGeneratorProcess
 
-    def marshal_output(self, output):
-        return output
+    def on_read_from_buffer(self, read_buffer):
+        return read_buffer.value
+
+class QuadrupleBufferedValueLoaderGeneratorProcess(parallelism.LoaderGeneratorProcess):
+    def __init__(self, *args, **kwargs):
+        super(QuadrupleBufferedValueLoaderGeneratorProcess, self).__init__(
+            lambda: ValueLoader(*args, **kwargs), lambda: ValueMultipleBuffer(4))
+
+    # From MultipleBufferedProcess
+
+    def on_write_to_buffer(self, data, write_buffer):
+        write_buffer.value = data
+
+    # From LoaderGeneratorProcess
 
-    def unmarshal_output(self, marshalled, read_buffer):
+    def on_read_from_buffer(self, read_buffer):
         return read_buffer.value
 
 class TestLoaderGeneratorProcess(unittest.TestCase):
@@ -822,6 +1126,96 @@ class TestLoaderGeneratorProcess(unittest.TestCase):
                     sys.stdout.write(']')
         print(']')
 
+    def test_multiple_buffered_generation(self):
+        sys.stdout.write('multiple[')
+        for generation_delay in self.generation_delays:
+            self.loader = QuadrupleBufferedValueLoaderGeneratorProcess(
+                10, generation_delay=generation_delay)
+            for consecutive_next_delay in self.consecutive_next_delays:
+                sys.stdout.write('[')
+                for _ in range(self.repetitions):
+                    self.loader.load()
+                    self.assert_short_generation(
+                        10, 1, consecutive_next_delay=consecutive_next_delay)
+                    self.loader.reset()
+                    sys.stdout.write('.')
+                sys.stdout.write(']')
+        print(']')
+
+    def test_restart_latency(self):
+        self.loader = ValueLoaderGeneratorProcess(10)
+        for _ in range(self.repetitions):
+            start_time = time.time()
+            self.loader.load()
+            self.assertEqual(next(self.loader), 0, 'Incorrect generation')
+            self.loader.reset()
+            self.assertLess(time.time() - start_time, 0.05, 'Restart was too slow')
+
+    def test_on_demand_generation(self):
+        self.loader = QuadrupleBufferedValueLoaderGeneratorProcess(10)
+        self.loader.lookahead = 0
+        for _ in range(self.repetitions):
+            self.loader.load()
+            time.sleep(0.05)
+            self.assertEqual(self.loader.multiple_buffer.num_written, 0,
+                             'Child loaded without credits')
+            for i in range(10):
+                self.assertEqual(next(self.loader), 2 * i, 'Incorrect generation')
+                time.sleep(0.01)
+                self.assertEqual(self.loader.multiple_buffer.num_written, i + 1,
+                                 'Child loaded without credits')
+            self.assert_stopiteration('Missing StopIteration')
+            self.loader.reset()
+
+    def test_lookahead(self):
+        self.loader = QuadrupleBufferedValueLoaderGeneratorProcess(10)
+        with self.assertRaises(ValueError):
+            self.loader.lookahead = 4
+        self.loader.lookahead = 1
+        self.loader.load()
+        time.sleep(0.05)
+        self.assertEqual(self.loader.multiple_buffer.num_written, 1, 'Incorrect lookahead')
+        self.assertEqual(next(self.loader), 0, 'Incorrect generation')
+        time.sleep(0.05)
+        self.assertEqual(self.loader.multiple_buffer.num_written, 2, 'Incorrect lookahead')
+        self.loader.lookahead = 3
+        time.sleep(0.05)
+        self.assertEqual(self.loader.multiple_buffer.num_written, 4, 'Incorrect lookahead')
+        for i in range(1, 10):
+            self.assertEqual(next(self.loader), 2 * i, 'Incorrect generation')
+        self.assert_stopiteration('Missing StopIteration')
+        self.loader.stop_loading()
+
+    def test_profiling(self):
+        self.loader = QuadrupleBufferedValueLoaderGeneratorProcess(10)
+        self.loader.enable_profiling()
+        self.loader.load()
+        self.assert_short_generation(10, 1)
+        self.loader.stop_loading()
+        for stage_name in ['load_next', 'write_to_buffer', 'wait_unread', 'read_from_buffer']:
+            self.assertGreaterEqual(self.loader.profiler.count(stage_name), 10,
+                                    'Incorrect profiling of ' + stage_name)
+
+    def test_handoff_overhead(self):
+        self.loader = QuadrupleBufferedValueLoaderGeneratorProcess(1001)
+        self.loader.load()
+        next(self.loader)
+        start_time = time.time()
+        for i in range(1, 1001):
+            self.assertEqual(next(self.loader), 2 * i, 'Incorrect generation')
+        self.assertLess(time.time() - start_time, 0.06, 'Handoff was too slow')
+        self.loader.stop_loading()
+
+    def test_multiple_buffered_lookahead(self):
+        self.loader = QuadrupleBufferedValueLoaderGeneratorProcess(10, generation_delay=0.2)
+        self.loader.load()
+        time.sleep(1.5)  # Let the child fill all 3 writable slots
+        start_time = time.time()
+        for i in range(3):
+            self.assertEqual(next(self.loader), 2 * i, 'Incorrect generation')
+        self.assertLess(time.time() - start_time, 0.2, 'Child did not load ahead')
+        self.assertEqual(next(self.loader), 6, 'Incorrect generation')
+
     def tearDown(self):
         if self.loader.process_running:
             self.loader.stop_loading()
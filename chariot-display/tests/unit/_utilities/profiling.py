@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+import unittest
+import os
+import json
+import tempfile
+import multiprocessing
+
+from utilities import profiling
+
+class TestHistogram(unittest.TestCase):
+    def test_bins(self):
+        self.assertEqual(profiling.histogram_bin(0), 0, 'Incorrect histogram bin')
+        self.assertEqual(profiling.histogram_bin(1e-3), 61, 'Incorrect histogram bin')
+        self.assertEqual(profiling.histogram_bin(1e6), profiling.NUM_HISTOGRAM_BINS - 1,
+                         'Incorrect histogram bin')
+        for latency in [2e-6, 1.5e-4, 3e-2, 7.0]:
+            bin_id = profiling.histogram_bin(latency)
+            self.assertLess(profiling.histogram_bin_edge(bin_id - 1), latency,
+                            'Incorrect histogram bin edge')
+            self.assertGreaterEqual(profiling.histogram_bin_edge(bin_id), latency,
+                                    'Incorrect histogram bin edge')
+
+    def test_percentiles(self):
+        histogram = [0 for _ in range(profiling.NUM_HISTOGRAM_BINS)]
+        self.assertEqual(profiling.histogram_percentiles(histogram), [None, None, None],
+                         'Incorrect percentiles of empty histogram')
+        histogram[profiling.histogram_bin(1e-3)] = 90
+        histogram[profiling.histogram_bin(1e-2)] = 9
+        histogram[profiling.histogram_bin(1e-1)] = 1
+        percentiles = profiling.histogram_percentiles(histogram, (50, 95, 100))
+        for (percentile, latency) in zip(percentiles, [1e-3, 1e-2, 1e-1]):
+            self.assertGreaterEqual(percentile, latency, 'Incorrect percentile')
+            self.assertLess(percentile, latency * 1.2, 'Incorrect percentile')
+
+def record_stage(profiler, stage_name, num_intervals):
+    for i in range(num_intervals):
+        profiler.record(stage_name, i, i + 1e-3)
+
+class TestStageProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = profiling.StageProfiler(['child', 'parent'], trace_length=4,
+                                                name='test')
+
+    def test_null_profiler(self):
+        profiled = profiling.Profiled()
+        with profiled.profiler.time('stage'):
+            pass
+        profiled.profiled_stages = ('stage',)
+        profiled.enable_profiling()
+        with profiled.profiler.time('stage'):
+            pass
+        self.assertEqual(profiled.profiler.count('stage'), 1, 'Incorrect stage timing')
+        self.assertEqual(profiled.profiler.name, 'Profiled', 'Incorrect profiler name')
+
+    def test_time(self):
+        with self.profiler.time('parent'):
+            pass
+        self.assertEqual(self.profiler.count('parent'), 1, 'Incorrect stage timing')
+        self.assertEqual(self.profiler.count('child'), 0, 'Incorrect stage timing')
+        self.assertLess(self.profiler.percentiles('parent')[2], 1e-3,
+                        'Incorrect stage timing')
+
+    def test_child_process(self):
+        process = multiprocessing.Process(target=record_stage,
+                                          args=(self.profiler, 'child', 10))
+        process.start()
+        process.join()
+        record_stage(self.profiler, 'parent', 2)
+        self.assertEqual(self.profiler.count('child'), 10, 'Incorrect collection from child')
+        self.assertEqual(self.profiler.count('parent'), 2, 'Incorrect collection from parent')
+        intervals = self.profiler.intervals('child')
+        self.assertEqual([start_time for (_, start_time, _) in intervals], [6, 7, 8, 9],
+                         'Incorrect trace ring buffer')
+        self.assertEqual(set(pid for (pid, _, _) in intervals), set([process.pid]),
+                         'Incorrect trace pids')
+        self.profiler.reset()
+        self.assertEqual(self.profiler.count('child'), 0, 'Incorrect reset')
+        self.assertEqual(self.profiler.intervals('child'), [], 'Incorrect reset')
+
+    def test_report(self):
+        record_stage(self.profiler, 'parent', 2)
+        report = profiling.report([self.profiler])
+        self.assertIn('test parent (n=2): p50 ', report, 'Incorrect report')
+        self.assertNotIn('child', report, 'Incorrect report of empty stage')
+
+    def test_export_chrome_trace(self):
+        record_stage(self.profiler, 'child', 2)
+        record_stage(self.profiler, 'parent', 1)
+        (trace_file, trace_path) = tempfile.mkstemp(suffix='.json')
+        os.close(trace_file)
+        try:
+            profiling.export_chrome_trace([self.profiler], trace_path)
+            with open(trace_path) as trace_file:
+                events = json.load(trace_file)['traceEvents']
+        finally:
+            os.remove(trace_path)
+        intervals = [event for event in events if event['ph'] == 'X']
+        self.assertEqual([event['name'] for event in intervals], ['child', 'child', 'parent'],
+                         'Incorrect trace events')
+        self.assertEqual(intervals[1]['ts'], 1e6, 'Incorrect trace event start')
+        self.assertAlmostEqual(intervals[1]['dur'], 1e3, 3, 'Incorrect trace event duration')
+        self.assertEqual(len(set(event['tid'] for event in intervals)), 2,
+                         'Incorrect trace threads')
+        self.assertEqual(len([event for event in events if event['ph'] == 'M']), 2,
+                         'Incorrect trace thread names')
@@ -137,45 +137,68 @@ class TestUpdateListDataBuffer(unittest.TestCase):
                                     [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0]])
 
     def test_update(self):
-        for i in range(20):
-            util.update_list_data_buffer(self.small_buffer, self.small_list, i)
-            self.assertEqual(
-                self.small_buffer.tolist(), self.small_list.tolist(),
-                'Incorrect update of small buffer with larger list'
-            )
+        num_items = util.update_list_data_buffer(self.small_buffer, self.small_list)
+        self.assertEqual(num_items, 5, 'Incorrect number of items in small buffer')
+        self.assertEqual(
+            self.small_buffer.tolist(), self.small_list.tolist(),
+            'Incorrect update of small buffer with list of same size'
+        )
 
     def test_oversized_update(self):
-        for i in range(20):
-            util.update_list_data_buffer(self.small_buffer, self.list, i)
-            self.assertEqual(
-                self.small_buffer.tolist(), self.small_list.tolist(),
-                'Incorrect update of small buffer with larger list'
-            )
+        num_items = util.update_list_data_buffer(self.small_buffer, self.list)
+        self.assertEqual(num_items, 5, 'Incorrect number of items in small buffer')
+        self.assertEqual(
+            self.small_buffer.tolist(), self.small_list.tolist(),
+            'Incorrect update of small buffer with larger list'
+        )
 
     def test_undersized_update(self):
-        for i in range(20):
-            util.update_list_data_buffer(self.large_buffer, self.list, i)
-            self.assertEqual(
-                self.large_buffer.tolist(), self.large_list.tolist(),
-                'Incorrect update of small buffer with larger list'
-            )
+        num_items = util.update_list_data_buffer(self.large_buffer, self.list)
+        self.assertEqual(num_items, 6, 'Incorrect number of items in large buffer')
+        self.assertEqual(
+            self.large_buffer.tolist(), self.large_list.tolist(),
+            'Incorrect update of large buffer with smaller list'
+        )
 
     def test_downsized_update(self):
-        util.update_list_data_buffer(self.small_buffer, self.small_list, 5)
-        util.update_list_data_buffer(self.small_buffer, self.small_list[:3, :], 5)
+        util.update_list_data_buffer(self.small_buffer, self.small_list)
+        num_items = util.update_list_data_buffer(self.small_buffer, self.small_list[:3, :])
+        self.assertEqual(num_items, 3, 'Incorrect number of items in small buffer')
         self.assertEqual(
-            self.small_buffer.tolist(), self.tiny_list.tolist(),
-            'Incorrect update of small buffer with larger list'
+            self.small_buffer[:num_items].tolist(), self.tiny_list[:num_items].tolist(),
+            'Incorrect update of small buffer with smaller list'
         )
 
     def test_downsized_update_parsimony(self):
-        util.update_list_data_buffer(self.small_buffer, self.small_list, 5)
-        util.update_list_data_buffer(self.small_buffer, self.small_list[:3, :], 3)
+        util.update_list_data_buffer(self.small_buffer, self.small_list)
+        util.update_list_data_buffer(self.small_buffer, self.small_list[:3, :] * 2)
         self.assertEqual(
-            self.small_buffer.tolist(), self.small_list.tolist(),
-            'Incorrect update of small buffer with larger list'
+            self.small_buffer[3:].tolist(), self.small_list[3:].tolist(),
+            'Unnecessary update of stale items in small buffer'
         )
 
+class TestListDataBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = util.ListDataBuffer(np.zeros((5, 3)))
+        self.list = np.arange(18).reshape(6, 3)
+
+    def test_init(self):
+        self.assertEqual((self.buffer.capacity, self.buffer.num_items), (5, 0),
+                         'Incorrect initialization')
+        self.assertEqual(self.buffer.valid.shape, (0, 3), 'Incorrect initialization')
+
+    def test_update(self):
+        self.assertEqual(self.buffer.update(self.list[:4]), 4, 'Incorrect number of items')
+        self.assertEqual(self.buffer.valid.tolist(), self.list[:4].tolist(),
+                         'Incorrect valid items')
+        self.assertEqual(self.buffer.update(self.list[:2] * 2), 2, 'Incorrect number of items')
+        self.assertEqual(self.buffer.valid.tolist(), (self.list[:2] * 2).tolist(),
+                         'Incorrect valid items')
+        self.assertEqual(self.buffer.data[2:4].tolist(), self.list[2:4].tolist(),
+                         'Unnecessary update of stale items')
+        self.assertEqual(self.buffer.update(self.list), 5, 'Incorrect number of items')
+        self.assertIs(self.buffer.valid.base, self.buffer.data, 'Incorrect valid view')
+
 class TestTimeRange(unittest.TestCase):
     def test_init(self):
         time_range = util.TimeRange()
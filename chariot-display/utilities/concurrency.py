@@ -1,7 +1,100 @@
 #!/usr/bin/env python2
 """Classes to enable painless process-level parallelism."""
+import os
+import errno
+import fcntl
+import select
 import threading
 
+# INTERRUPT-SAFE NOTIFICATION
+
+def wait_readable(readables, timeout=None):
+    """Sleeps until any of the readables can be read from, without polling.
+    readables is a list of file descriptors or of objects with a fileno method, such
+    as Notifiers or multiprocessing Connections.
+    Signals such as Ctrl+C still interrupt the main thread while it waits.
+    Returns the list of readables which can be read from; it's empty if the timeout
+    elapsed first.
+    """
+    while True:
+        try:
+            return select.select(readables, [], [], timeout)[0]
+        except select.error as e:
+            # If a signal handler didn't raise an exception, keep waiting
+            if e.args[0] != errno.EINTR:
+                raise
+
+class Notifier(object):
+    """A wake-up notification implemented as a self-pipe.
+    The notification is shared with threads and with processes forked after the
+    Notifier is created. Waiting is done with select, so waiters wake up as soon as
+    notify is called and the main thread can still be interrupted with Ctrl+C.
+    Notifications are level-triggered: the Notifier stays notified until it's cleared.
+    The pipe is opened upon creation; owners should close it when they stop using it and
+    reopen it before using it again. Notifying or clearing a closed Notifier does nothing.
+    """
+    def __init__(self):
+        self._read_fd = None
+        self._write_fd = None
+        self.open()
+
+    @property
+    def closed(self):
+        return self._read_fd is None
+
+    def open(self):
+        """Opens a new pipe, unless the Notifier is already open."""
+        if not self.closed:
+            return
+        (self._read_fd, self._write_fd) = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._read_fd
+
+    def notify(self):
+        if self.closed:
+            return
+        try:
+            os.write(self._write_fd, b'!')
+        except OSError as e:
+            # If the pipe is full, the notifier has already been notified
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear(self):
+        if self.closed:
+            return
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def is_set(self):
+        return bool(wait_readable([self], 0))
+
+    def wait(self, timeout=None):
+        """Sleeps until the notifier is notified.
+        Returns whether the notifier was notified before the timeout elapsed."""
+        return bool(wait_readable([self], timeout))
+
+    def close(self):
+        if self.closed:
+            return
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        self._read_fd = None
+        self._write_fd = None
+
+    def __del__(self):
+        self.close()
+
+# THREADS
+
 class Thread(object):
     """Abstract convenience class for work done concurrently in a thread."""
     def __init__(self):
@@ -33,14 +126,17 @@ class Thread(object):
         Implement this."""
         pass
 
-    def run_serial(self):
-        """Perform the work in the current execution thread."""
-        self._run = True
+    def _run_loop(self):
         self.on_run_start()
         while self._run:
             self.execute()
         self.on_run_finish()
 
+    def run_serial(self):
+        """Perform the work in the current execution thread."""
+        self._run = True
+        self._run_loop()
+
     # Parent methods
 
     def on_run_parent_start(self):
@@ -52,7 +148,9 @@ class Thread(object):
         """Perform the work in a new concurrent thread."""
         if self._thread is not None:
             return
-        self._thread = threading.Thread(target=self.run_serial, name=self.name)
+        # Start running before the thread starts, so an early terminate isn't overridden
+        self._run = True
+        self._thread = threading.Thread(target=self._run_loop, name=self.name)
         self.on_run_parent_start()
         self._thread.start()
 
@@ -2,9 +2,16 @@
 """Classes to enable painless process-level parallelism."""
 import traceback
 import os
+import time
+import errno
 import signal
+import itertools
+import mmap
+import tempfile
+import uuid
+import operator
 import multiprocessing
-from multiprocessing import Value
+from multiprocessing import RawValue
 import ctypes
 try:
     from Queue import Empty, Full
@@ -15,8 +22,11 @@ try:
 except ImportError:
     from thread import interrupt_main
 
+import numpy as np
+
 from data import data
 import concurrency
+import profiling
 
 # WORKER POOLS
 
@@ -26,17 +36,138 @@ class EarlyTermination(Exception):
     """
     pass
 
+def imap_poll(iterator, timeout=1):
+    """Yields the results from the iterator returned by a Pool's imap or imap_unordered.
+    Periodically polls for interrupts while waiting so interrupts can be caught.
+    """
+    while True:
+        try:
+            yield iterator.next(timeout)
+        except multiprocessing.TimeoutError:
+            pass
+        except StopIteration:
+            return
+
+def get_async_poll(async_result, timeout=1):
+    """Returns the result of an AsyncResult, or raises the exception raised by its function.
+    Periodically polls for interrupts while waiting so interrupts can be caught.
+    """
+    while True:
+        try:
+            return async_result.get(timeout)
+        except multiprocessing.TimeoutError:
+            pass
+
+def chunks(iterable, chunksize):
+    """Yields lists of up to chunksize consecutive items from the iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+class ChunkFunction(object):
+    """A picklable function which applies the function to each item in a chunk."""
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, chunk):
+        return [self.function(item) for item in chunk]
+
+class WorkerPool(object):
+    """A long-lived pool of worker processes which can execute many Worksets.
+    The worker processes are started on the first execution and stay alive until the
+    pool is closed or terminated, so later executions don't pay for starting them.
+    This can also be used as a context manager, which closes the pool on exit.
+    If initializer is not None, each worker process calls it with initargs when it starts,
+    e.g. to set up state which would be expensive to send with every task.
+    """
+    def __init__(self, num_processes=(multiprocessing.cpu_count() - 1),
+                 initializer=None, initargs=()):
+        self.num_processes = max(num_processes, 1)
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pool = None
+
+    @property
+    def running(self):
+        return self._pool is not None
+
+    def start(self):
+        if self.running:
+            return
+        print('Initializing pool of ' + str(self.num_processes) + ' worker processes...')
+        self._pool = multiprocessing.Pool(processes=self.num_processes,
+                                          initializer=self.initializer,
+                                          initargs=self.initargs)
+
+    def imap(self, function, iterable, chunksize=1, ordered=False):
+        """Yields the results of the function on each item of the iterable as they finish.
+        Items are sent to the workers in chunks of chunksize items. If ordered is False,
+        results are yielded in the order in which their chunks finish.
+        """
+        self.start()
+        # Pool's own chunking can't be waited on with a timeout, so we chunk ourselves
+        if ordered:
+            iterator = self._pool.imap(ChunkFunction(function), chunks(iterable, chunksize))
+        else:
+            iterator = self._pool.imap_unordered(ChunkFunction(function),
+                                                 chunks(iterable, chunksize))
+        return (result for chunk in imap_poll(iterator) for result in chunk)
+
+    def apply_async(self, function, *args):
+        """Starts executing the function with the arguments on a worker.
+        Returns an AsyncResult, whose result can be waited for with get_async_poll."""
+        self.start()
+        return self._pool.apply_async(function, args)
+
+    def close(self):
+        """Waits for the workers to finish their work and stops them."""
+        if not self.running:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def terminate(self):
+        """Stops the workers without waiting for them to finish their work."""
+        if not self.running:
+            return
+        print('Terminating work pool...')
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        print('Terminated work pool.')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
 class Workset():
     """An interface for embarrassingly parallelizable work.
     Extend this to implement a set of work units for a worker pool to handle.
+    Each work unit which raises an exception is retried up to max_attempts times in
+    total before it's given up on.
     """
+    max_attempts = 1
 
     def work(self, work_id):
-        """The method which gets executed on each worker, with a unique work_id."""
+        """The method which gets executed on each worker, with a unique work_id.
+        Its return value is collected as the result of the work unit, so it needs to be
+        picklable."""
         pass
 
     def work_ids(self):
-        """The method which defines the immutable work_ids for the work units."""
+        """The method which defines the immutable work_ids for the work units.
+        This may return any iterable, such as a generator, which is only consumed as
+        work units are sent to the workers."""
 
     def handle_early_termination(self, work_id):
         """The method called when a worker is terminated early by Ctrl+C."""
@@ -46,40 +177,101 @@ class Workset():
         """The method called when a worker is terminated early by an exception."""
         pass
 
+    def handle_progress(self, num_finished, num_work_units, elapsed_time):
+        """The method called in the parent process to report progress.
+        num_work_units is None if work_ids doesn't have a length."""
+        if num_work_units is None:
+            progress = str(num_finished)
+        else:
+            progress = str(num_finished) + ' of ' + str(num_work_units)
+        throughput = num_finished / elapsed_time if elapsed_time else 0
+        print('Finished ' + progress + ' work units (' +
+              '{:.1f}'.format(throughput) + ' units/s).')
+
     def __call__(self, work_id):
+        """Executes the work unit.
+        Returns a tuple of the work_id, the result, and whether the work unit failed."""
+        for attempt in range(self.max_attempts):
+            try:
+                return (work_id, self.work(work_id), False)
+            except EarlyTermination:
+                self.handle_early_termination(work_id)
+                break
+            except Exception as e:
+                if attempt + 1 == self.max_attempts:
+                    self.handle_exception(work_id, e)
+        return (work_id, None, True)
+
+    def _collect(self, outcomes, progress_interval):
+        """Yields the work_ids and results of work units which didn't fail.
+        Reports progress at most every progress_interval seconds, and at the end."""
+        work_ids = self.work_ids()
         try:
-            self.work(work_id)
-        except EarlyTermination:
-            self.handle_early_termination(work_id)
-        except Exception as e:
-            self.handle_exception(work_id, e)
-
-    def execute_sequential(self):
-        """Executes work sequentially in the current process."""
-        for work_id in self.work_ids():
-            self(work_id)
-
-    def execute_parallel(self, num_processes=(multiprocessing.cpu_count() - 1)):
-        print('Initializing pool of ' + str(num_processes) + ' worker processes...')
-        pool = multiprocessing.Pool(processes=num_processes)
+            num_work_units = len(work_ids)
+        except TypeError:
+            num_work_units = None
+        self.failed_work_ids = []
+        num_finished = 0
+        start_time = time.time()
+        last_report_time = start_time
+        for (work_id, result, failed) in outcomes(work_ids):
+            num_finished += 1
+            if failed:
+                self.failed_work_ids.append(work_id)
+            else:
+                yield (work_id, result)
+            current_time = time.time()
+            if (progress_interval is not None and
+                    current_time - last_report_time >= progress_interval):
+                self.handle_progress(num_finished, num_work_units, current_time - start_time)
+                last_report_time = current_time
+        if progress_interval is not None:
+            self.handle_progress(num_finished, num_work_units, time.time() - start_time)
+
+    def execute_sequential(self, progress_interval=1):
+        """Executes work sequentially in the current process.
+        Returns a dict of the results of the work units which didn't fail; the work_ids of
+        the work units which failed are in failed_work_ids."""
+        return dict(self._collect(
+            lambda work_ids: (self(work_id) for work_id in work_ids), progress_interval))
+
+    def execute_stream(self, pool, chunksize=1, ordered=False, progress_interval=1):
+        """Executes work on the WorkerPool, yielding results as work units finish.
+        Yields the work_id and result of each work unit which didn't fail; the work_ids of
+        the work units which failed are in failed_work_ids after the last result.
+        Larger chunksizes reduce the overhead of sending many small work units."""
+        return self._collect(
+            lambda work_ids: pool.imap(self, work_ids, chunksize, ordered),
+            progress_interval)
+
+    def execute_parallel(self, num_processes=(multiprocessing.cpu_count() - 1), pool=None,
+                         chunksize=1, progress_interval=1):
+        """Executes work in parallel on the WorkerPool, or on a new pool of num_processes
+        workers which is closed afterwards if pool is None.
+        Returns a dict of the results of the work units which didn't fail; the work_ids of
+        the work units which failed are in failed_work_ids. Returns None if the work
+        was terminated early, in which case a new pool is terminated; a pool passed in
+        is left running for the caller, and the interruption or exception is re-raised.
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = WorkerPool(num_processes)
         try:
             print('Distributing work across workers...')
-            pool.map(self, self.work_ids())
-            pool.close()
+            results = dict(self.execute_stream(pool, chunksize, False, progress_interval))
             print('Finished work.')
+            if own_pool:
+                pool.close()
+            return results
         except (KeyboardInterrupt, EarlyTermination):
-            print('Terminating work pool...')
+            if not own_pool:
+                raise
             pool.terminate()
-            print('Terminated work pool.')
         except Exception as e:
+            if not own_pool:
+                raise
             print(e)
-            print('Terminating pool...')
             pool.terminate()
-            print('Terminated pool.')
-        finally:
-            print('Joining workers.')
-            pool.join()
-            print('Finished.')
 
 # SYNCHRONIZATION WITH POLLING
 
@@ -133,9 +325,10 @@ def acquire_lock_poll(lock, block=True, timeout=None):
 # SYNCHRONIZED PARALLELISM
 
 def flush_queue(queue):
+    """Discards all items in the queue, including any None sentinels."""
     try:
-        for item in iter(queue.get_nowait, None):
-            pass
+        while True:
+            queue.get_nowait()
     except Empty:
         pass
 
@@ -144,38 +337,40 @@ class ExceptionListener(concurrency.Thread):
     Listens for exceptions received by the send method from any process.
     Upon receipt of an exception, saves exception information to the exception
     attribute, and interrupts the main thread with a KeyboardInterrupt.
+    The thread sleeps until an exception is sent or the thread is terminated, so it
+    doesn't need to poll.
     """
     def __init__(self, process_name):
         super(ExceptionListener, self).__init__()
         self.process_name = process_name
-        self.queue = multiprocessing.Queue(1)
+        (self._receiver, self._sender) = multiprocessing.Pipe(False)
+        self._stop_notifier = concurrency.Notifier()
         self.exception = None
 
-    def send(self, child_name, child_pid, e, traceback, block=True, timeout=1):
-        put_queue_poll(self.queue, {
+    def send(self, child_name, child_pid, e, traceback):
+        self._sender.send({
             'child_name': child_name,
             'child_pid': child_pid,
             'exception': e,
             'traceback': traceback
-        }, block, timeout)
+        })
 
-    def receive_exception(self, block=True, timeout=0.1):
-        exception_received = False
-        try:
-            self.exception = self.queue.get(block, timeout)
-            exception_received = True
-        except Empty:
-            pass
-        if exception_received:
-            print('Interrupting main thread from ' +
-                  repr(self.exception['exception']) +
-                  ' raised in child ' + self.exception['child_name'] +
-                  ' (pid ' + str(self.exception['child_pid']) + '):\n' +
-                  self.exception['traceback'])
-            interrupt_main()
+    def receive_exception(self, block=True, timeout=None):
+        readables = concurrency.wait_readable(
+            [self._receiver, self._stop_notifier], timeout if block else 0)
+        if self._receiver not in readables:
+            return
+        self.exception = self._receiver.recv()
+        print('Interrupting main thread from ' +
+              repr(self.exception['exception']) +
+              ' raised in child ' + self.exception['child_name'] +
+              ' (pid ' + str(self.exception['child_pid']) + '):\n' +
+              self.exception['traceback'])
+        interrupt_main()
 
     def reset(self, clear_exception=False):
-        flush_queue(self.queue)
+        while self._receiver.poll():
+            self._receiver.recv()
         if clear_exception:
             self.exception = None
 
@@ -190,6 +385,14 @@ class ExceptionListener(concurrency.Thread):
 
     def on_run_parent_start(self):
         self.exception = None
+        self._stop_notifier.open()
+        self._stop_notifier.clear()
+
+    def on_terminate(self):
+        self._stop_notifier.notify()
+
+    def on_terminate_finish(self):
+        self._stop_notifier.close()
 
 class Process(object):
     """Abstract base class for child processes synchronized over input and output queues.
@@ -333,19 +536,97 @@ class Process(object):
         flush_queue(self._input_queue)
         flush_queue(self._output_queue)
 
-# DOUBLE-BUFFERED SYNCHRONIZATION
+# SHARED MEMORY
+
+if os.path.isdir('/dev/shm'):
+    _SHARED_MEMORY_PATH = '/dev/shm'
+else:
+    _SHARED_MEMORY_PATH = tempfile.gettempdir()
+
+class SharedMemory(object):
+    """A named segment of shared memory which any process can attach to by name.
+    The segment is a memory-mapped file in /dev/shm (or in the temporary directory if
+    /dev/shm doesn't exist), so unlike a multiprocessing.Array it doesn't need to be
+    inherited by forking, and it doesn't have a lock. Pickling only saves the name, so
+    unpickling attaches to the same segment instead of copying its contents.
+    If name is None, creates a new segment of the specified size in bytes; the process
+    which created it removes its name when it's unlinked or garbage-collected, though
+    processes which have already attached to it can keep using it.
+    """
+    def __init__(self, size=0, name=None):
+        self._owner_pid = None
+        if name is None:
+            name = 'chariot-' + str(os.getpid()) + '-' + uuid.uuid4().hex
+            fd = os.open(os.path.join(_SHARED_MEMORY_PATH, name),
+                         os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            self._owner_pid = os.getpid()
+            os.ftruncate(fd, max(size, 1))  # mmap can't map an empty file
+        else:
+            fd = os.open(os.path.join(_SHARED_MEMORY_PATH, name), os.O_RDWR)
+            size = os.fstat(fd).st_size
+        try:
+            self.buffer = mmap.mmap(fd, max(size, 1))
+        finally:
+            os.close(fd)
+        self.name = name
+        self.size = size
+
+    def as_array(self, dtype, shape, offset=0):
+        """Returns a numpy array of the specified dtype and shape backed by the segment."""
+        num_elements = reduce(operator.mul, shape, 1)
+        return np.frombuffer(self.buffer, dtype, num_elements, offset).reshape(*shape)
+
+    def as_value(self, ctype, offset=0):
+        """Returns a ctypes object of the specified ctype backed by the segment."""
+        return ctype.from_buffer(self.buffer, offset)
+
+    def unlink(self):
+        """Removes the name of the segment, so that no more processes can attach to it."""
+        self._owner_pid = None
+        try:
+            os.unlink(os.path.join(_SHARED_MEMORY_PATH, self.name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
-class DoubleBuffer(object):
-    """Abstract base class for double buffering.
+    def __del__(self):
+        if self._owner_pid is not None and self._owner_pid == os.getpid():
+            self.unlink()
+
+    def __getstate__(self):
+        return self.name
+
+    def __setstate__(self, name):
+        self.__init__(name=name)
+
+# MULTIPLE-BUFFERED SYNCHRONIZATION
+
+class MultipleBuffer(object):
+    """Abstract base class for multiple buffering over a fixed number of slots.
     The read buffer is used for reading, while the write buffer is used for writing
-    the next read buffer.
-    Note that only the locks and event are synchronized across processes.
+    a later read buffer. Slots are written and read in the same circular order, so the
+    writer can work ahead of the reader by up to num_slots - 1 slots.
+    Slots can be handed off either with the per-slot locks and readable events, or,
+    for a single writer and a single reader, with the lock-free sequence counters
+    (publish_write, publish_end and consume_read), which only need a pipe write to
+    wake up the other side.
+    Note that only the ids, counters, locks and events are synchronized across processes.
     """
-    def __init__(self):
-        self._buffer_id = Value(ctypes.c_int)
-        self._buffer_id.value = 0
-        self._buffer_locks = [multiprocessing.Lock(), multiprocessing.Lock()]
-        self._buffer_readable_events = [multiprocessing.Event(), multiprocessing.Event()]
+    def __init__(self, num_slots):
+        if num_slots < 2:
+            raise ValueError('MultipleBuffer needs at least two slots!')
+        self.num_slots = num_slots
+        self._read_id = RawValue(ctypes.c_int, 0)
+        self._write_id = RawValue(ctypes.c_int, 1)
+        self._buffer_locks = [multiprocessing.Lock() for _ in range(num_slots)]
+        self._buffer_readable_events = [multiprocessing.Event() for _ in range(num_slots)]
+        # Each counter is only ever incremented by one side, so they don't need locks
+        self._num_written = RawValue(ctypes.c_long, 0)
+        self._num_read = RawValue(ctypes.c_long, 0)
+        self._num_written_at_end = RawValue(ctypes.c_long, -1)
+        self._write_limit = RawValue(ctypes.c_long, -1)
+        self._written_notifier = concurrency.Notifier()
+        self._read_notifier = concurrency.Notifier()
 
     def get_buffer(self, buffer_id):
         """Gets the buffer at the specified id.
@@ -353,16 +634,32 @@ class DoubleBuffer(object):
         """
         pass
 
-    def swap(self):
-        self._buffer_id.value = 1 - self._buffer_id.value
+    def get_lock(self, buffer_id):
+        return self._buffer_locks[buffer_id]
+
+    def get_readable(self, buffer_id):
+        return self._buffer_readable_events[buffer_id]
+
+    def advance_read(self):
+        """Makes the next slot in the circular order the read buffer."""
+        self._read_id.value = self.next_read_id
+
+    def advance_write(self):
+        """Makes the next slot in the circular order the write buffer."""
+        self._write_id.value = (self._write_id.value + 1) % self.num_slots
 
     @property
     def read_id(self):
-        return self._buffer_id.value
+        return self._read_id.value
+
+    @property
+    def next_read_id(self):
+        """The id of the slot which will become the read buffer after the next advance."""
+        return (self._read_id.value + 1) % self.num_slots
 
     @property
     def write_id(self):
-        return 1 - self._buffer_id.value
+        return self._write_id.value
 
     @property
     def read_buffer(self):
@@ -374,19 +671,19 @@ class DoubleBuffer(object):
 
     @property
     def read_lock(self):
-        return self._buffer_locks[self.read_id]
+        return self.get_lock(self.read_id)
 
     @property
     def write_lock(self):
-        return self._buffer_locks[self.write_id]
+        return self.get_lock(self.write_id)
 
     @property
     def read_readable(self):
-        return self._buffer_readable_events[self.read_id]
+        return self.get_readable(self.read_id)
 
     @property
     def write_readable(self):
-        return self._buffer_readable_events[self.write_id]
+        return self.get_readable(self.write_id)
 
     def release_locks(self):
         for lock in self._buffer_locks:
@@ -396,110 +693,320 @@ class DoubleBuffer(object):
                 pass
 
     def reset(self):
-        self.read_readable.clear()
-        self.write_readable.clear()
+        for readable in self._buffer_readable_events:
+            readable.clear()
         self.release_locks()
-        self._buffer_id.value = 0
+        self._read_id.value = 0
+        self._write_id.value = 1
+        self._num_written.value = 0
+        self._num_read.value = 0
+        self._num_written_at_end.value = -1
+        self._write_limit.value = -1
+        self._written_notifier.clear()
+        self._read_notifier.clear()
+
+    def open(self):
+        """Reopens the notifiers after close.
+        Call this before forking the processes which share the buffer."""
+        self._written_notifier.open()
+        self._read_notifier.open()
+
+    def close(self):
+        """Releases the pipes of the notifiers once no process is using the buffer."""
+        self._written_notifier.close()
+        self._read_notifier.close()
+
+    # Lock-free handoff
 
-class DoubleBufferedProcess(Process):
-    """A Process which supports double-buffering.
-    Assumes the child writes to the buffer and the parent reads and swaps the buffer,
+    @property
+    def num_written(self):
+        return self._num_written.value
+
+    @property
+    def num_read(self):
+        return self._num_read.value
+
+    @property
+    def write_limit(self):
+        return self._write_limit.value
+
+    @property
+    def writable(self):
+        """Whether the write buffer can be written without overwriting unread data or
+        going past the write limit."""
+        num_written = self._num_written.value
+        write_limit = self._write_limit.value
+        return (num_written - self._num_read.value < self.num_slots - 1 and
+                (write_limit < 0 or num_written < write_limit))
+
+    @property
+    def unread(self):
+        """Whether a written slot is waiting to become the read buffer."""
+        return self._num_written.value > self._num_read.value
+
+    @property
+    def ended(self):
+        """Whether the writer has ended and the reader has read everything it wrote."""
+        return self._num_written_at_end.value == self._num_read.value
+
+    def grant_writes(self, write_limit):
+        """Lets the writer write until num_written reaches write_limit.
+        So write_limit - num_written is the number of credits which the writer has left.
+        If write_limit is negative, the number of writes is only limited by the slots.
+        Call this from the reader."""
+        previous_write_limit = self._write_limit.value
+        self._write_limit.value = write_limit
+        num_written = self._num_written.value
+        if (0 <= previous_write_limit <= num_written and
+                num_written - self._num_read.value < self.num_slots - 1):
+            self.notify_writer()  # the writer might be waiting only for credits
+
+    def publish_write(self):
+        """Hands off the write buffer to the reader and advances it to the next slot.
+        Call this from the writer after it has finished writing to the write buffer."""
+        self.advance_write()
+        self._num_written.value += 1
+        self._written_notifier.notify()
+
+    def publish_end(self):
+        """Tells the reader that nothing else will be written."""
+        self._num_written_at_end.value = self._num_written.value
+        self._written_notifier.notify()
+
+    def consume_read(self):
+        """Advances the read buffer to the next unread slot.
+        Call this from the reader once it no longer needs the data in the read buffer;
+        the old read buffer is then free for the writer to write to."""
+        self.advance_read()
+        self._num_read.value += 1
+        self._read_notifier.notify()
+
+    def wait_writable(self, timeout=None):
+        """Sleeps until the buffer might be writable or the timeout elapses."""
+        self._read_notifier.clear()
+        if not self.writable:
+            self._read_notifier.wait(timeout)
+
+    def wait_unread(self, timeout=None):
+        """Sleeps until the buffer might be unread or ended, or the timeout elapses."""
+        self._written_notifier.clear()
+        if not (self.unread or self.ended):
+            self._written_notifier.wait(timeout)
+
+    def notify_writer(self):
+        """Wakes up the writer if it's sleeping in wait_writable."""
+        self._read_notifier.notify()
+
+class DoubleBuffer(MultipleBuffer):
+    """Abstract base class for double buffering.
+    The read buffer is used for reading, while the write buffer is used for writing
+    the next read buffer. Unlike in a general MultipleBuffer, the write buffer is always
+    the buffer which is not being read, so consecutive writes overwrite each other
+    until the buffers are swapped.
+    Note that only the locks and event are synchronized across processes.
+    """
+    def __init__(self, *args, **kwargs):
+        super(DoubleBuffer, self).__init__(2, *args, **kwargs)
+
+    def swap(self):
+        self.advance_read()
+
+    # From MultipleBuffer
+
+    def advance_write(self):
+        pass
+
+    @property
+    def write_id(self):
+        return 1 - self.read_id
+
+class MultipleBufferedProcess(Process, profiling.Profiled):
+    """A Process which supports multiple-buffering.
+    Assumes the child writes to the buffers and the parent reads and swaps the buffers,
     though other configurations might also work well with this interface.
-    DoubleBufferFactory needs to return an object which is a DoubleBuffer without any
+    MultipleBufferFactory needs to return an object which is a MultipleBuffer without any
     calling arguments.
     """
-    def __init__(self, DoubleBufferFactory, max_input_queue_size, max_output_queue_size,
+    profiled_stages = ('write_to_buffer', 'swap_buffers')
+
+    def __init__(self, MultipleBufferFactory, max_input_queue_size, max_output_queue_size,
                  *args, **kwargs):
-        super(DoubleBufferedProcess, self).__init__(
+        super(MultipleBufferedProcess, self).__init__(
             max_input_queue_size, max_output_queue_size, *args, **kwargs)
-        self.double_buffer = DoubleBufferFactory()
+        self.multiple_buffer = MultipleBufferFactory()
 
     @property
     def read_buffer(self):
-        return self.double_buffer.read_buffer
+        return self.multiple_buffer.read_buffer
 
     # Child methods
 
     def on_write_to_buffer(self, data, write_buffer):
-        """Write the data to the double buffer's write buffer.
+        """Write the data to the multiple buffer's write buffer.
         Impelement this."""
         pass
 
     def write_to_buffer(self, data):
-        acquire_lock_poll(self.double_buffer.write_lock, block=True, timeout=None)
-        self.on_write_to_buffer(data, self.double_buffer.write_buffer)
-        self.double_buffer.write_readable.set()
-        self.double_buffer.write_lock.release()
+        with self.profiler.time('write_to_buffer'):
+            acquire_lock_poll(self.multiple_buffer.write_lock, block=True, timeout=None)
+            self.on_write_to_buffer(data, self.multiple_buffer.write_buffer)
+            self.multiple_buffer.write_readable.set()
+            self.multiple_buffer.write_lock.release()
+            self.multiple_buffer.advance_write()
+
+    def skip_write_buffer(self):
+        """Marks the write buffer as readable without writing anything to it.
+        This lets the parent swap past the buffer, e.g. at the end of a sequence."""
+        acquire_lock_poll(self.multiple_buffer.write_lock, block=True, timeout=None)
+        self.multiple_buffer.write_readable.set()
+        self.multiple_buffer.write_lock.release()
+        self.multiple_buffer.advance_write()
 
     # Parent methods
 
+    def run_parallel(self):
+        self.multiple_buffer.open()  # before forking, so that the child shares it
+        super(MultipleBufferedProcess, self).run_parallel()
+
+    def terminate(self, force_terminate=False):
+        super(MultipleBufferedProcess, self).terminate(force_terminate)
+        self.multiple_buffer.close()
+
     def swap_buffers(self):
-        """Swaps the read and write buffers.
+        """Advances the read buffer to the next slot.
         Upon completion, the parent is ready to read from the new read buffer and the
-        child is ready to write to the new write buffer.
+        child is free to write to the old read buffer once it gets there.
         Assumes the parent has the lock on the old read buffer and no longer needs the
         data in the buffer, so that it's ready for the child to start writing to it.
-        Before swapping, waits for the write buffer to become readable and lockable.
-        Upon completion, the parent has the lock on the new read buffer, the new
-        write buffer is no longer marked as readable, and the child is free to lock
-        the new write buffer.
+        Before advancing, waits for the next slot to become readable and lockable.
+        Upon completion, the parent has the lock on the new read buffer, and the old read
+        buffer is unlocked and no longer marked as readable.
         """
-        # Assumes the parent has the read lock and no longer needs the read buffer's data
-        wait_event_poll(self.double_buffer.write_readable)
-        # Lock the write buffer so we can read from it when it becomes a read buffer
-        acquire_lock_poll(self.double_buffer.write_lock, block=True, timeout=1)
-        # Swap buffers, so that our locked buffer becomes the new read buffer
-        self.double_buffer.swap()
-        # Reset and release our unneeded buffer as the new write buffer
-        self.double_buffer.write_readable.clear()
-        self.double_buffer.write_lock.release()
-
-class LoaderGeneratorProcess(DoubleBufferedProcess, data.DataLoader, data.DataGenerator):
+        multiple_buffer = self.multiple_buffer
+        previous_id = multiple_buffer.read_id
+        next_id = multiple_buffer.next_read_id
+        with self.profiler.time('swap_buffers'):
+            # Assumes the parent has the read lock and no longer needs the read buffer's data
+            wait_event_poll(multiple_buffer.get_readable(next_id))
+            # Lock the next buffer so we can read from it when it becomes the read buffer
+            acquire_lock_poll(multiple_buffer.get_lock(next_id), block=True, timeout=1)
+            # Advance, so that our locked buffer becomes the new read buffer
+            multiple_buffer.advance_read()
+            # Reset and release our unneeded buffer so that the child can write to it
+            multiple_buffer.get_readable(previous_id).clear()
+            multiple_buffer.get_lock(previous_id).release()
+
+class DoubleBufferedProcess(MultipleBufferedProcess):
+    """A Process which supports double-buffering.
+    Assumes the child writes to the buffer and the parent reads and swaps the buffer,
+    though other configurations might also work well with this interface.
+    DoubleBufferFactory needs to return an object which is a DoubleBuffer without any
+    calling arguments.
+    """
+    def __init__(self, DoubleBufferFactory, max_input_queue_size, max_output_queue_size,
+                 *args, **kwargs):
+        super(DoubleBufferedProcess, self).__init__(
+            DoubleBufferFactory, max_input_queue_size, max_output_queue_size,
+            *args, **kwargs)
+
+    @property
+    def double_buffer(self):
+        return self.multiple_buffer
+
+class LoaderGeneratorProcess(MultipleBufferedProcess, data.DataLoader, data.DataGenerator):
     """Abstract base class for a Loader/Generator which runs in a separate process.
-    Implementation requires implementing the on_write_to_buffer, marshal_output, and
-    unmarshal_output methods.
+    Implementation requires implementing the on_write_to_buffer and on_read_from_buffer
+    methods.
+    The child loads ahead of the parent into every slot of the multiple buffer except
+    the one which the parent is reading from, so a DoubleBuffer gives one frame of
+    lookahead while a MultipleBuffer with more slots can absorb jitter in loading times.
+    The child continuously loads as long as it has credits, which the parent grants
+    to keep the child up to lookahead frames ahead of it. lookahead defaults to, and
+    can't exceed, the number of slots minus one; if it's 0, the child only loads
+    each frame once next() asks for it.
+    Slots are handed off with the multiple buffer's sequence counters rather than with
+    locks, events and queue messages, so everything which next() needs to return must
+    be stored in the buffers.
     LoaderGeneratorFactory needs to return an object which is a Loader and a Generator
     without any calling arguments.
-    DoubleBufferFactory needs to return an object which is a DoubleBuffer without any
-    calling arguments.
+    MultipleBufferFactory needs to return an object which is a MultipleBuffer (such as a
+    DoubleBuffer) without any calling arguments.
+    The child records the load_next, write_to_buffer and wait_writable stages, while
+    the parent records the wait_unread and read_from_buffer stages.
     """
-    def __init__(self, LoaderGeneratorFactory, DoubleBufferFactory, *args, **kwargs):
+    profiled_stages = ('load_next', 'write_to_buffer', 'wait_writable',
+                       'wait_unread', 'read_from_buffer')
+
+    def __init__(self, LoaderGeneratorFactory, MultipleBufferFactory, lookahead=None,
+                 *args, **kwargs):
+        # The queues only carry the exit sentinel
         super(LoaderGeneratorProcess, self).__init__(
-            DoubleBufferFactory, 1, 1, *args, **kwargs)
+            MultipleBufferFactory, 0, 0, *args, **kwargs)
         self.loader = LoaderGeneratorFactory()
+        self._stopping = RawValue(ctypes.c_bool, False)
+        self._loaded_all = False
+        self._lookahead = None
+        if lookahead is None:
+            lookahead = self.multiple_buffer.num_slots - 1
+        self.lookahead = lookahead
 
-    # Child methods
+    @property
+    def lookahead(self):
+        """The number of frames which the child may load ahead of the parent."""
+        return self._lookahead
 
-    def marshal_output(self, loaded_next):
-        """Generate the contents of the output queue message.
-        Override this to pass custom picklable data over the output queue without
-        having to store it into the double buffer."""
-        return True
+    @lookahead.setter
+    def lookahead(self, lookahead):
+        if not 0 <= lookahead < self.multiple_buffer.num_slots:
+            raise ValueError('Lookahead must be between 0 and the number of slots minus one!')
+        self._lookahead = lookahead
+        self._grant_credits()
+
+    def _grant_credits(self, num_requested=0):
+        multiple_buffer = self.multiple_buffer
+        multiple_buffer.grant_writes(multiple_buffer.num_read + num_requested + self.lookahead)
+
+    # Child methods
 
     def _load_next(self):
         try:
-            loaded_next = next(self.loader)
-            self.write_to_buffer(loaded_next)
-            self.send_output({
-                'next': self.marshal_output(loaded_next)
-            })
+            with self.profiler.time('load_next'):
+                loaded_next = next(self.loader)
         except StopIteration:
-            self.double_buffer.write_readable.set()
-            self.send_output(None)
+            self._loaded_all = True
+            self.multiple_buffer.publish_end()
+            return
+        with self.profiler.time('write_to_buffer'):
+            self.on_write_to_buffer(loaded_next, self.multiple_buffer.write_buffer)
+        self.multiple_buffer.publish_write()
 
     # From Process
 
-    def on_run_parent_start(self):
-        # Set up assumptions/loop invariants of the next() call
-        acquire_lock_poll(self.double_buffer.read_lock, block=True, timeout=1)
-        self.send_input('next')  # let child load the first value into the write buffer
+    def on_terminate(self):
+        if not self.process_running:
+            return
+        # Make the child stop loading ahead and wait for the exit sentinel
+        self._stopping.value = True
+        self.multiple_buffer.notify_writer()
 
     def on_terminate_finish(self):
+        self._stopping.value = False
         super(LoaderGeneratorProcess, self).stop_loading()
 
     def on_run_start(self):
+        self._loaded_all = False
         self.loader.load()
 
+    def receive_input(self, block=True, timeout=1):
+        # Load into every free slot until the loader runs out or the parent stops us
+        multiple_buffer = self.multiple_buffer
+        while not (self._loaded_all or self._stopping.value):
+            if multiple_buffer.writable:
+                return 'next'
+            with self.profiler.time('wait_writable'):
+                multiple_buffer.wait_writable(timeout)
+        return super(LoaderGeneratorProcess, self).receive_input(block, timeout)
+
     def execute(self, next_input):
         if next_input == 'next':
             self._load_next()
@@ -509,30 +1016,36 @@ class LoaderGeneratorProcess(DoubleBufferedProcess, data.DataLoader, data.DataGe
 
     # From DataGenerator
 
-    def unmarshal_output(self, marshalled, read_buffer):
-        """Given the marshalled data and the read buffer, reconstruct the data.
+    def on_read_from_buffer(self, read_buffer):
+        """Given the read buffer, reconstruct the data.
         Implement this to reconstruct the data to be returned from next()."""
         pass
 
-    def next(self):
-        self.swap_buffers()
-        self.send_input('next')  # let the child start writing to the new write buffer
-        output = self.receive_output()  # receive the output associated with the new read buffer
-        if output is not None:
-            return self.unmarshal_output(output['next'], self.double_buffer.read_buffer)
-        else:
+    def next(self, timeout=1):
+        """Returns the data in the next slot written by the child.
+        By default, this periodically polls with a timeout of 1 so that interrupts
+        can be caught while waiting for the child."""
+        multiple_buffer = self.multiple_buffer
+        self._grant_credits(1)  # so the child is lookahead frames ahead after consume_read
+        with self.profiler.time('wait_unread'):
+            while not (multiple_buffer.unread or multiple_buffer.ended):
+                multiple_buffer.wait_unread(timeout)
+        if not multiple_buffer.unread:
             raise StopIteration
+        multiple_buffer.consume_read()  # let the child start writing to the freed buffer
+        with self.profiler.time('read_from_buffer'):
+            return self.on_read_from_buffer(multiple_buffer.read_buffer)
 
     def reset(self):
         self.stop_loading()
-        self.double_buffer.reset()
+        self.multiple_buffer.reset()
         self.flush_queues()
 
     # From DataLoader
 
     def load(self):
+        self._grant_credits()  # before the child starts, so that it doesn't overshoot
         self.run_parallel()
 
     def stop_loading(self):
         self.terminate()
-
@@ -1,4 +1,12 @@
 import time
+import os
+import math
+import json
+import contextlib
+import multiprocessing
+import ctypes
+
+import numpy as np
 
 import util
 
@@ -21,3 +29,179 @@ class FramerateCounter():
 
     def reset(self):
         self._buffer.reset()
+
+# STAGE LATENCIES
+
+HISTOGRAM_MIN_LATENCY = 1e-6  # s
+HISTOGRAM_BINS_PER_DECADE = 20
+HISTOGRAM_NUM_DECADES = 8  # so the largest finite bin edge is 100 s
+NUM_HISTOGRAM_BINS = HISTOGRAM_BINS_PER_DECADE * HISTOGRAM_NUM_DECADES + 1
+
+def histogram_bin(latency):
+    """Returns the index of the latency histogram bin for the latency, in seconds.
+    Bin 0 holds latencies below HISTOGRAM_MIN_LATENCY; the last bin also holds
+    all latencies above its lower edge."""
+    if latency < HISTOGRAM_MIN_LATENCY:
+        return 0
+    bin_id = int(math.log10(latency / HISTOGRAM_MIN_LATENCY) * HISTOGRAM_BINS_PER_DECADE) + 1
+    return min(bin_id, NUM_HISTOGRAM_BINS - 1)
+
+def histogram_bin_edge(bin_id):
+    """Returns the upper edge of the latency histogram bin, in seconds."""
+    return HISTOGRAM_MIN_LATENCY * 10 ** (float(bin_id) / HISTOGRAM_BINS_PER_DECADE)
+
+def histogram_percentiles(histogram, percentiles=(50, 95, 99)):
+    """Returns upper bounds of the percentiles of latencies in the latency histogram.
+    Returns None for each percentile if the histogram is empty."""
+    cumulative = np.cumsum(histogram)
+    if not cumulative[-1]:
+        return [None for _ in percentiles]
+    return [histogram_bin_edge(np.searchsorted(cumulative, cumulative[-1] * percentile / 100.0))
+            for percentile in percentiles]
+
+def _shared_array(ctype, shape):
+    base = multiprocessing.RawArray(ctype, int(np.prod(shape)))
+    return np.ctypeslib.as_array(base).reshape(*shape)
+
+class _NullContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+class NullStageProfiler(object):
+    """A StageProfiler which doesn't record anything."""
+    name = None
+    stage_names = ()
+    _null_context = _NullContext()
+
+    def time(self, stage_name):
+        return self._null_context
+
+    def record(self, stage_name, start_time, end_time):
+        pass
+
+class StageProfiler(object):
+    """Records the latencies of the named stages of a pipeline.
+    Each stage has a histogram of latencies with logarithmically spaced bins and a ring
+    buffer of the trace_length most recent intervals, which are allocated in shared
+    memory. So a profiler created before forking can be recorded to from the child and
+    read from the parent. Each stage should only be recorded to from a single process
+    (or thread), so that recording doesn't need any locks.
+    """
+    def __init__(self, stage_names, trace_length=1024, name=None):
+        self.name = name
+        self.stage_names = tuple(stage_names)
+        self._stage_ids = {stage_name: stage_id
+                           for (stage_id, stage_name) in enumerate(self.stage_names)}
+        num_stages = len(self.stage_names)
+        self._histograms = _shared_array(ctypes.c_long, (num_stages, NUM_HISTOGRAM_BINS))
+        self._intervals = _shared_array(ctypes.c_double, (num_stages, trace_length, 2))
+        self._interval_pids = _shared_array(ctypes.c_int, (num_stages, trace_length))
+        self._num_intervals = _shared_array(ctypes.c_long, (num_stages,))
+
+    @property
+    def trace_length(self):
+        return self._intervals.shape[1]
+
+    @contextlib.contextmanager
+    def time(self, stage_name):
+        """Records the time spent in the with block as the latency of the stage."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage_name, start_time, time.time())
+
+    def record(self, stage_name, start_time, end_time):
+        stage_id = self._stage_ids[stage_name]
+        self._histograms[stage_id, histogram_bin(end_time - start_time)] += 1
+        interval_id = self._num_intervals[stage_id] % self.trace_length
+        self._intervals[stage_id, interval_id] = (start_time, end_time - start_time)
+        self._interval_pids[stage_id, interval_id] = os.getpid()
+        self._num_intervals[stage_id] += 1
+
+    def histogram(self, stage_name):
+        """Returns a copy of the latency histogram of the stage."""
+        return self._histograms[self._stage_ids[stage_name]].copy()
+
+    def count(self, stage_name):
+        return self._num_intervals[self._stage_ids[stage_name]]
+
+    def percentiles(self, stage_name, percentiles=(50, 95, 99)):
+        """Returns upper bounds of the percentiles of the latencies of the stage."""
+        return histogram_percentiles(self.histogram(stage_name), percentiles)
+
+    def intervals(self, stage_name):
+        """Returns the most recent recorded intervals of the stage in time order.
+        Each interval is a tuple of the pid, the start time, and the duration."""
+        stage_id = self._stage_ids[stage_name]
+        num_intervals = self._num_intervals[stage_id]
+        start_id = max(num_intervals - self.trace_length, 0)
+        return [(self._interval_pids[stage_id, interval_id % self.trace_length],
+                 self._intervals[stage_id, interval_id % self.trace_length, 0],
+                 self._intervals[stage_id, interval_id % self.trace_length, 1])
+                for interval_id in range(start_id, num_intervals)]
+
+    def reset(self):
+        self._histograms[:] = 0
+        self._num_intervals[:] = 0
+
+class Profiled(object):
+    """Mix-in for things which can record the latencies of their stages.
+    profiled_stages should be overridden with the names of the stages which get recorded.
+    Until enable_profiling is called, the profiler doesn't record anything.
+    """
+    profiled_stages = ()
+    profiler = NullStageProfiler()
+
+    def enable_profiling(self, trace_length=1024, name=None):
+        """Starts recording stage latencies into a new StageProfiler.
+        If stages are recorded in a child process, call this before starting the child.
+        If name is None, the profiler is named after the class."""
+        if name is None:
+            name = self.__class__.__name__
+        self.profiler = StageProfiler(self.profiled_stages, trace_length, name)
+
+def report(profilers, percentiles=(50, 95, 99)):
+    """Returns a table of latency percentiles, in ms, of each stage of the profilers."""
+    lines = []
+    for profiler in profilers:
+        for stage_name in profiler.stage_names:
+            stage_percentiles = profiler.percentiles(stage_name, percentiles)
+            if stage_percentiles[0] is None:
+                continue
+            lines.append(
+                str(profiler.name) + ' ' + stage_name +
+                ' (n=' + str(profiler.count(stage_name)) + '): ' +
+                ', '.join('p' + str(percentile) + ' ' + '{:.3f}'.format(latency * 1000) + ' ms'
+                          for (percentile, latency) in zip(percentiles, stage_percentiles))
+            )
+    return '\n'.join(lines)
+
+def export_chrome_trace(profilers, path):
+    """Saves the recorded intervals of the profilers as a Chrome trace JSON file.
+    The file can be loaded in chrome://tracing; each stage of each profiler is shown
+    as a separate thread of the process which recorded it.
+    """
+    events = []
+    thread_id = 0
+    for profiler in profilers:
+        for stage_name in profiler.stage_names:
+            pids = set()
+            for (pid, start_time, duration) in profiler.intervals(stage_name):
+                pids.add(pid)
+                events.append({
+                    'name': stage_name, 'cat': str(profiler.name), 'ph': 'X',
+                    'ts': start_time * 1e6, 'dur': duration * 1e6,
+                    'pid': int(pid), 'tid': thread_id
+                })
+            for pid in pids:
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': int(pid), 'tid': thread_id,
+                    'args': {'name': str(profiler.name) + ' ' + stage_name}
+                })
+            thread_id += 1
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events}, trace_file)
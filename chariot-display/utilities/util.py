@@ -72,20 +72,45 @@ def grid_data_to_list_data(data):
     """Reshapes data shaped as a grid (as in an image) to a list array, one row per grid cell."""
     return data.reshape(data.shape[0] * data.shape[1], data.shape[2])
 
-def update_list_data_buffer(list_data_buffer, new_list_data, previous_list_data_size=None):
-    if previous_list_data_size is None:
-        previous_list_data_size = list_data_buffer.shape[0]
-    else:
-        previous_list_data_size = min(previous_list_data_size, list_data_buffer.shape[0])
+def update_list_data_buffer(list_data_buffer, new_list_data):
+    """Copies list data into the start of a preallocated buffer, one item per row.
+    Rows past the new data are left as they were rather than cleared, so only the
+    first rows of the buffer, up to the returned number of items, are valid.
+    Returns the number of items in the buffer.
+    """
     list_data_size = new_list_data.shape[0]
     if list_data_size > list_data_buffer.shape[0]:
         print('Warning: Can only add ' + str(list_data_buffer.shape[0]) + ' of the ' +
               str(list_data_size) + ' requested items!')
-        new_list_data = new_list_data[:list_data_buffer.shape[0]]
+        list_data_size = list_data_buffer.shape[0]
+        new_list_data = new_list_data[:list_data_size]
     np.copyto(list_data_buffer[:list_data_size], new_list_data)
-    if previous_list_data_size > list_data_size:
-        list_data_buffer[list_data_size:previous_list_data_size] = \
-            np.zeros((previous_list_data_size - list_data_size, new_list_data.shape[1]))
+    return list_data_size
+
+class ListDataBuffer(object):
+    """A preallocated buffer of list data, one item per row, which tracks its valid items.
+    update copies new list data into the start of the buffer with update_list_data_buffer,
+    so only the first num_items rows are valid and the rest of the buffer is stale.
+    """
+    def __init__(self, data, num_items=0):
+        self.data = data
+        self.num_items = num_items
+
+    @property
+    def capacity(self):
+        """The maximum number of items in the buffer."""
+        return self.data.shape[0]
+
+    @property
+    def valid(self):
+        """A view of the valid items in the buffer."""
+        return self.data[:self.num_items]
+
+    def update(self, new_list_data):
+        """Replaces the valid items with the new list data.
+        Returns the number of valid items."""
+        self.num_items = update_list_data_buffer(self.data, new_list_data)
+        return self.num_items
 
 class TimeRange:
     def __init__(self, start=None, end=None, reference=None, duration=None):
@@ -3,7 +3,6 @@ import vispy.visuals
 import vispy.io
 import vispy.gloo
 
-from utilities import util
 from utilities import profiling
 import visuals
 
@@ -22,37 +21,42 @@ class MeshVisual(visuals.ShadedVisual):
 
     def initialize_data(self, mesh_name=None, num_vertices=None, num_faces=None):
         if mesh_name is not None:
-            (self.vertices, self.faces, self.normals, _) = visuals.load_model(mesh_name)
-            self.num_vertices = self.vertices.shape[0]
-            self.num_faces = self.faces.shape[0]
-            self.faces_ibo = vispy.gloo.IndexBuffer(self.faces)
+            (vertices, faces, normals, _) = visuals.load_model(mesh_name)
+            (num_valid_vertices, num_valid_faces) = (vertices.shape[0], faces.shape[0])
         else:
-            self.num_vertices = num_vertices
-            self.vertices = np.zeros((num_vertices, 3), dtype=np.float32)
-            self.num_faces = num_faces
-            self.normals = np.zeros((num_vertices, 3), dtype=np.float32)
-            self.faces = np.zeros((num_faces, 3), dtype=np.uint32)
-        self.vertices_vbo = vispy.gloo.VertexBuffer(self.vertices)
-        self.program.vert['position'] = self.vertices_vbo
-        self.normals_vbo = vispy.gloo.VertexBuffer(self.normals)
-        self.program.vert['normal'] = self.normals_vbo
+            vertices = np.zeros((num_vertices, 3), dtype=np.float32)
+            normals = np.zeros((num_vertices, 3), dtype=np.float32)
+            faces = np.zeros((num_faces, 3), dtype=np.uint32)
+            (num_valid_vertices, num_valid_faces) = (0, 0)
+        self.vertices = visuals.ListDataGPUBuffer(vertices, num_valid_vertices)
+        self.normals = visuals.ListDataGPUBuffer(normals, num_valid_vertices)
+        self.faces = visuals.ListDataGPUBuffer(faces, num_valid_faces, vispy.gloo.IndexBuffer)
+        # Faces only index valid vertices, so the vertex buffers are bound whole
+        self.program.vert['position'] = self.vertices.gpu_buffer
+        self.program.vert['normal'] = self.normals.gpu_buffer
+
+    @property
+    def num_vertices(self):
+        return self.vertices.num_items
+
+    @property
+    def num_faces(self):
+        return self.faces.num_items
 
     def update_data(self, vertices, faces):
-        prev_num_vertices = self.num_vertices
-        util.update_list_data_buffer(self.vertices, vertices, prev_num_vertices)
-        prev_num_faces = self.num_faces
-        util.update_list_data_buffer(self.faces, faces, prev_num_faces)
-        self.num_vertices = vertices.shape[0]
-        self.num_faces = faces.shape[0]
+        """Updates the mesh data.
+        Only the first num_vertices vertices and num_faces faces are uploaded and drawn."""
+        self.vertices.update(vertices)
+        self.faces.update(faces)
         self.updated_state = True
-        self.vertices_vbo.set_data(self.vertices)
-        self.faces_ibo = vispy.gloo.IndexBuffer(self.faces)
+        self.vertices.upload()
+        self.faces.upload()
         self.framerate_counter.tick()
 
     def redraw(self):
         if self.updated_state:
             super(MeshVisual, self).redraw()
-            self.program.draw('triangles', self.faces_ibo)
+            self.program.draw('triangles', self.faces.valid_view)
 
     def draw(self, transforms):
         # Note we use the "additive" GL blending settings so that we do not
@@ -61,7 +65,7 @@ class MeshVisual(visuals.ShadedVisual):
 
         self.bind_transforms(transforms)
         # Finally, draw the triangles.
-        self.program.draw('triangles', self.faces_ibo)
+        self.program.draw('triangles', self.faces.valid_view)
 
 class PointCloudMeshVisual(visuals.ShadedVisual):
     def __init__(self):
@@ -70,39 +74,41 @@ class PointCloudMeshVisual(visuals.ShadedVisual):
         self.framerate_counter = profiling.FramerateCounter()
 
     def initialize_data(self, num_vertices, num_faces):
-        self.num_vertices = num_vertices
-        self.vertices = np.zeros((num_vertices, 3), dtype=np.float32)
-        self.vertices_vbo = vispy.gloo.VertexBuffer(self.vertices)
-        self.program.vert['position'] = self.vertices_vbo
-        self.colors = np.zeros((num_vertices, 3), dtype=np.float32)
-        self.colors_vbo = vispy.gloo.VertexBuffer(self.colors)
-        self.program.vert['color'] = self.colors_vbo
-
-        self.num_faces = num_faces
-        self.faces = np.zeros((num_faces, 3), dtype=np.uint32)
-        self.faces_ibo = None
+        self.vertices = visuals.ListDataGPUBuffer(np.zeros((num_vertices, 3), dtype=np.float32))
+        self.colors = visuals.ListDataGPUBuffer(np.zeros((num_vertices, 3), dtype=np.float32))
+        self.faces = visuals.ListDataGPUBuffer(np.zeros((num_faces, 3), dtype=np.uint32),
+                                               Buffer=vispy.gloo.IndexBuffer)
+        # Faces only index valid vertices, so the vertex buffers are bound whole
+        self.program.vert['position'] = self.vertices.gpu_buffer
+        self.program.vert['color'] = self.colors.gpu_buffer
+
+    @property
+    def num_vertices(self):
+        return self.vertices.num_items
+
+    @property
+    def num_faces(self):
+        return self.faces.num_items
 
     def update_data(self, vertices, colors, faces):
-        prev_num_vertices = self.num_vertices
-        util.update_list_data_buffer(self.vertices, vertices, prev_num_vertices)
-        util.update_list_data_buffer(self.colors, colors, prev_num_vertices)
-        prev_num_faces = self.num_faces
-        util.update_list_data_buffer(self.faces, faces, prev_num_faces)
-        self.num_vertices = vertices.shape[0]
-        self.num_faces = faces.shape[0]
+        """Updates the mesh data.
+        Only the first num_vertices vertices and num_faces faces are uploaded and drawn."""
+        self.vertices.update(vertices)
+        self.colors.update(colors)
+        self.faces.update(faces)
         self.updated_state = True
-        self.vertices_vbo.set_data(self.vertices)
-        self.colors_vbo.set_data(self.colors)
-        self.faces_ibo = vispy.gloo.IndexBuffer(self.faces)
+        self.vertices.upload()
+        self.colors.upload()
+        self.faces.upload()
         self.framerate_counter.tick()
 
     def redraw(self):
         if self.updated_state:
             super(PointCloudMeshVisual, self).redraw()
-            if self.faces_ibo is None:
+            if not self.num_faces:
                 print(self.__class__.__name__ + ' Warning: No faces to draw!')
                 return
-            self.program.draw('triangles', self.faces_ibo)
+            self.program.draw('triangles', self.faces.valid_view)
 
     def draw(self, transforms):
         # Note we use the "additive" GL blending settings so that we do not
@@ -110,10 +116,10 @@ class PointCloudMeshVisual(visuals.ShadedVisual):
         # vispy.gloo.set_state('additive', cull_face=False)
 
         self.bind_transforms(transforms)
-        if self.faces_ibo is None:
+        if not self.num_faces:
             print(self.__class__.__name__ + ' Warning: No faces to draw!')
             return
-        self.program.draw('triangles', self.faces_ibo)
+        self.program.draw('triangles', self.faces.valid_view)
 
 class CarModelVisual(MeshVisual):
     def __init__(self, mesh_name='alfa147.obj'):
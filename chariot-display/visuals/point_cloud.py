@@ -1,7 +1,6 @@
 """Classes for rendering point clouds."""
 import numpy as np
 import vispy.visuals
-import vispy.gloo
 
 from utilities import util, profiling
 import visuals
@@ -9,20 +8,28 @@ import visuals
 VERTEX_SHADER_FILENAME = 'point_cloud.vert'
 FRAGMENT_SHADER_FILENAME = 'point_cloud.frag'
 
-class Visual(visuals.ShadedVisual):
+class Visual(visuals.ShadedVisual, profiling.Profiled):
+    profiled_stages = ('update_list_data_buffer', 'set_data')
+
     def __init__(self):
         super(Visual, self).__init__(VERTEX_SHADER_FILENAME, FRAGMENT_SHADER_FILENAME)
         self._initialize_rendering()
         self.framerate_counter = profiling.FramerateCounter()
 
     def initialize_data(self, num_points):
-        self.num_points = num_points
-        self.data = np.zeros(num_points, [('a_position', np.float32, 3),
-                                          ('a_color', np.float32, 3)])
-        self.data_vbo = vispy.gloo.VertexBuffer(self.data)
-        self.program.bind(self.data_vbo)
+        self.positions = visuals.ListDataGPUBuffer(np.zeros((num_points, 3), dtype=np.float32))
+        self.colors = visuals.ListDataGPUBuffer(np.zeros((num_points, 3), dtype=np.float32))
+        self._bind_valid_views()
         self.updated_state = False
 
+    @property
+    def num_points(self):
+        return self.colors.num_items
+
+    def _bind_valid_views(self):
+        self.program['a_position'] = self.positions.valid_view
+        self.program['a_color'] = self.colors.valid_view
+
     def update_data(self, point_cloud):
         self.update_list_data(point_cloud.points, point_cloud.colors)
 
@@ -33,19 +40,21 @@ class Visual(visuals.ShadedVisual):
 
     def update_list_data(self, points, rgb):
         """Updates the point cloud data, given by one point per row, and re-renders it.
-        Data are all assumed to be of the same number of points.
+        Data are all assumed to be of the same number of points. Only the first
+        num_points points of the data are uploaded and drawn.
         """
-        prev_num_points = self.num_points
-        util.update_list_data_buffer(self.data['a_position'], points, prev_num_points)
-        util.update_list_data_buffer(self.data['a_color'], rgb, prev_num_points)
-        self.num_points = points.shape[0]
+        with self.profiler.time('update_list_data_buffer'):
+            self.positions.update(points)
+            self.colors.update(rgb)
         self.updated_state = True
-        self.data_vbo.set_data(self.data)
+        with self.profiler.time('set_data'):
+            self.positions.upload()
+            self.colors.upload()
         self.framerate_counter.tick()
 
     def redraw(self):
         if self.updated_state:
-            self.program.bind(self.data_vbo)
+            self._bind_valid_views()
         super(Visual, self).redraw()
 
     def _initialize_rendering(self):
@@ -4,6 +4,10 @@ import sys
 import vispy.io
 import vispy.visuals
 import vispy.scene
+import vispy.gloo
+import vispy.gloo.buffer
+
+from utilities import util
 
 _PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
 SHADERS_FOLDER = 'shaders'
@@ -35,6 +39,50 @@ class CustomVisual(vispy.visuals.Visual):
             self.transform = self.transform_update
             self.updated_state = False
 
+class _IndexBufferView(vispy.gloo.buffer.DataBufferView, vispy.gloo.IndexBuffer):
+    """A view of the first indices of an IndexBuffer, which Program.draw accepts as indices."""
+    pass
+
+class ListDataGPUBuffer(object):
+    """A ListDataBuffer whose valid items are mirrored into a GPU buffer.
+    The GPU buffer is allocated once at the full capacity of the list data, and upload
+    only writes the valid items into its start, so it's never reallocated as the number of
+    valid items changes. valid_view is a view of the valid items of the GPU buffer, so
+    binding it as an attribute or drawing it as indices only draws the valid items.
+    Buffer is vispy.gloo.VertexBuffer or vispy.gloo.IndexBuffer.
+    """
+    def __init__(self, data, num_items=0, Buffer=vispy.gloo.VertexBuffer):
+        self.list_data = util.ListDataBuffer(data, num_items)
+        self.gpu_buffer = Buffer(data)
+        if issubclass(Buffer, vispy.gloo.IndexBuffer):
+            self._View = _IndexBufferView
+        else:
+            self._View = vispy.gloo.buffer.DataBufferView
+        # Index buffers count each index of an item, and vertex buffers count each item
+        self._gpu_items_per_item = self.gpu_buffer.size // max(self.list_data.capacity, 1)
+        self.valid_view = None
+        self._update_valid_view()
+
+    @property
+    def num_items(self):
+        return self.list_data.num_items
+
+    def _update_valid_view(self):
+        # Made directly instead of by slicing, which would register it in gpu_buffer
+        self.valid_view = self._View(
+            self.gpu_buffer, slice(0, self.num_items * self._gpu_items_per_item))
+
+    def update(self, new_list_data):
+        """Replaces the valid items with the new list data without uploading them.
+        Returns the number of valid items."""
+        return self.list_data.update(new_list_data)
+
+    def upload(self):
+        """Uploads the valid items to the start of the GPU buffer."""
+        if self.num_items:
+            self.gpu_buffer.set_subdata(self.list_data.valid)
+        self._update_valid_view()
+
 class ShadedVisual(CustomVisual):
     def __init__(self, vertex_shader_filename, fragment_shader_filename):
         super(ShadedVisual, self).__init__()